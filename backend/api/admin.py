@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Device, Link
+from .models import Device, Link, Icon
 
 @admin.register(Device)
 class DeviceAdmin(admin.ModelAdmin):
@@ -12,3 +12,7 @@ class LinkAdmin(admin.ModelAdmin):
     list_display = ('source_device', 'source_interface', 'target_device', 'target_interface', 'bandwidth_capacity')
     list_filter = ('source_device', 'target_device')
     search_fields = ('source_interface', 'target_interface')
+
+@admin.register(Icon)
+class IconAdmin(admin.ModelAdmin):
+    list_display = ('hash', 'content_type', 'created_at')
@@ -0,0 +1,123 @@
+# Detail levels for collapsed topology views, coarsest first
+LEVELS = ('site', 'rack')
+
+
+def parse_level(value):
+    """Validate a ?level= value; None (or 'device') means no grouping"""
+    if value in (None, '', 'device'):
+        return None
+    if value not in LEVELS:
+        raise ValueError(f"level must be one of device, {', '.join(LEVELS)}")
+    return value
+
+
+def group_of(node, level):
+    """Id of the group node a device collapses into, or None if it stays a device"""
+    site = node.get('site') or ''
+    rack = node.get('rack') or ''
+    if level == 'rack':
+        return f'rack:{site}/{rack}' if rack else None
+    return f'site:{site}' if site else None
+
+
+def collapse_topology(data, level):
+    """
+    Collapse a topology payload to `level`. Devices without a site (or rack)
+    stay as they are, links inside one group are only counted, and parallel
+    links between the same two nodes become one edge.
+    """
+    groups = {}
+    members = {}
+    nodes = []
+    for node in data['nodes']:
+        key = group_of(node, level)
+        site, rack = node.get('site') or '', node.get('rack') or ''
+        if key is None:
+            members[node['id']] = node['id']
+            nodes.append(node)
+            continue
+        members[node['id']] = key
+        group = groups.get(key)
+        if group is None:
+            group = groups[key] = {
+                'id': key,
+                'label': (f'{site}/{rack}' if site else rack) if level == 'rack' else site,
+                'type': 'group',
+                'level': level,
+                'site': site,
+                'rack': rack if level == 'rack' else '',
+                'devices': 0,
+                'internal_links': 0,
+                'position': {'x': 0, 'y': 0}
+            }
+        group['devices'] += 1
+        group['position']['x'] += node['position']['x']
+        group['position']['y'] += node['position']['y']
+
+    for group in groups.values():
+        # Groups sit at the centre of their devices
+        group['position'] = {
+            'x': round(group['position']['x'] / group['devices']),
+            'y': round(group['position']['y'] / group['devices'])
+        }
+    nodes.extend(groups.values())
+
+    edges = []
+    merged = {}
+    for edge in data['edges']:
+        source, target = members.get(edge['source']), members.get(edge['target'])
+        if source is None or target is None:
+            continue
+        if source == target and source in groups:
+            groups[source]['internal_links'] += 1
+            continue
+        if source not in groups and target not in groups:
+            edges.append(edge)
+            continue
+
+        flipped = str(source) > str(target)
+        if flipped:
+            source, target = target, source
+        # Counters are the measuring interface's: inbound flows into that end.
+        # Merged edges count inbound into their own source.
+        inbound, outbound = edge['bandwidth']['inbound'], edge['bandwidth']['outbound']
+        if flipped != (edge.get('metric_side') == 'target'):
+            inbound, outbound = outbound, inbound
+
+        combined = merged.get((source, target))
+        if combined is None:
+            combined = merged[(source, target)] = {
+                'id': f'{source}~{target}',
+                'source': source,
+                'target': target,
+                'source_interface': '',
+                'target_interface': '',
+                'metric_side': 'source',
+                'links': 0,
+                'bandwidth': {'inbound': 0, 'outbound': 0, 'capacity': 0, 'utilization': 0},
+                'metrics_age': None,
+                'metrics_stale': False
+            }
+        combined['links'] += 1
+        bandwidth = combined['bandwidth']
+        bandwidth['inbound'] += inbound
+        bandwidth['outbound'] += outbound
+        bandwidth['capacity'] += edge['bandwidth']['capacity']
+        if edge['metrics_age'] is not None:
+            combined['metrics_age'] = max(combined['metrics_age'] or 0, edge['metrics_age'])
+        combined['metrics_stale'] = combined['metrics_stale'] or edge['metrics_stale']
+
+    for combined in merged.values():
+        bandwidth = combined['bandwidth']
+        bandwidth['inbound'] = round(bandwidth['inbound'], 2)
+        bandwidth['outbound'] = round(bandwidth['outbound'], 2)
+        capacity = bandwidth['capacity']
+        total = bandwidth['inbound'] + bandwidth['outbound']
+        bandwidth['utilization'] = round(total / (capacity * 2) * 100, 1) if capacity > 0 else 0
+    edges.extend(merged.values())
+
+    return {
+        'nodes': nodes,
+        'edges': edges,
+        'timestamp': data.get('timestamp')
+    }
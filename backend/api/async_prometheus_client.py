@@ -0,0 +1,191 @@
+import asyncio
+import weakref
+import httpx
+from .prometheus_client import PrometheusQueries, PrometheusUnavailable, MAX_SELECTOR_LENGTH, LAST_KNOWN_SIZE
+from .instrumentation import prometheus_query_seconds, prometheus_query_errors
+
+
+class AsyncPrometheusClient(PrometheusQueries):
+    """
+    asyncio-native counterpart to PrometheusClient, with the same queries
+    as coroutines. Uses one pooled keep-alive httpx client per event loop,
+    caps the number of in-flight queries and gives every query its own deadline.
+    """
+
+    def __init__(self, url='http://10.10.1.7:9090', max_connections=20, max_concurrency=10,
+                 query_timeout=5.0, max_selector_length=MAX_SELECTOR_LENGTH, retries=2, breaker=None,
+                 last_known_size=LAST_KNOWN_SIZE):
+        super().__init__(url, max_selector_length=max_selector_length, retries=retries, timeout=query_timeout,
+                         breaker=breaker, last_known_size=last_known_size)
+        self.max_connections = max_connections
+        self.max_concurrency = max_concurrency
+        self.query_timeout = query_timeout
+        # httpx clients and semaphores are bound to the loop that created them
+        self._loop_state = weakref.WeakKeyDictionary()
+
+    def _state(self):
+        loop = asyncio.get_running_loop()
+        state = self._loop_state.get(loop)
+        if state is None:
+            client = httpx.AsyncClient(
+                base_url=self.url,
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_connections
+                ),
+                timeout=self.query_timeout
+            )
+            state = (client, asyncio.Semaphore(self.max_concurrency))
+            self._loop_state[loop] = state
+        return state
+
+    async def _fetch(self, query, endpoint='query', **params):
+        """Execute PromQL query with retries, raising PrometheusUnavailable on failure"""
+        with prometheus_query_seconds.time(endpoint=endpoint):
+            try:
+                return await self._request(query, endpoint, params)
+            except PrometheusUnavailable:
+                prometheus_query_errors.inc(endpoint=endpoint)
+                raise
+
+    async def _request(self, query, endpoint, params):
+        if not self.breaker.allow():
+            raise PrometheusUnavailable('circuit breaker open')
+
+        client, semaphore = self._state()
+        error = None
+        for attempt in range(self.retries + 1):
+            try:
+                async with semaphore:
+                    # Budget is checked once the slot is acquired so queueing counts against it
+                    try:
+                        timeout = self._attempt_timeout()
+                    except PrometheusUnavailable:
+                        self.breaker.release()
+                        raise
+                    response = await asyncio.wait_for(
+                        client.get(f'/api/v1/{endpoint}', params=dict(params, query=query)),
+                        timeout=timeout
+                    )
+                if 400 <= response.status_code < 500:
+                    self.breaker.record_success()
+                    raise PrometheusUnavailable(f'HTTP {response.status_code} for query')
+                response.raise_for_status()
+                result = response.json()
+                self.breaker.record_success()
+                return result
+            except (httpx.HTTPError, asyncio.TimeoutError, ValueError) as e:
+                error = e
+            except asyncio.CancelledError:
+                self.breaker.release()
+                raise
+
+            remaining = self._remaining()
+            if attempt < self.retries and (remaining is None or remaining > self._backoff(attempt)):
+                await asyncio.sleep(self._backoff(attempt))
+
+        self.breaker.record_failure()
+        raise PrometheusUnavailable(repr(error))
+
+    async def query(self, query):
+        """Execute PromQL query"""
+        try:
+            return await self._fetch(query)
+        except PrometheusUnavailable as e:
+            print(f"Prometheus query error: {e}")
+            return {'data': {'result': []}}
+
+    async def get_interface_bandwidth(self, instance, interface):
+        """Get current bandwidth for an interface in Mbps"""
+        inbound, outbound = await asyncio.gather(*map(self.query, self._bandwidth_queries(instance, interface)))
+        return self._bandwidth(inbound, outbound)
+
+    async def get_bulk_interface_bandwidth(self, pairs):
+        """
+        Get current bandwidth in Mbps for many (instance, ifName) pairs at once.
+        All chunked in/out queries are issued concurrently.
+        """
+        async def fetch_chunk(selector, chunk):
+            # Let both halves finish so a half-open breaker trial is never abandoned
+            inbound, outbound = await asyncio.gather(
+                self._fetch(self._bulk_rate_query('ifHCInOctets', selector)),
+                self._fetch(self._bulk_rate_query('ifHCOutOctets', selector)),
+                return_exceptions=True
+            )
+            for response in (inbound, outbound):
+                if isinstance(response, BaseException):
+                    if not isinstance(response, PrometheusUnavailable):
+                        raise response
+                    print(f"Prometheus bulk query error: {response}")
+                    return chunk, None, None
+            return chunk, self._extract_vector(inbound), self._extract_vector(outbound)
+
+        chunks = await asyncio.gather(*(
+            fetch_chunk(selector, chunk) for selector, chunk in self._chunk_selectors(set(pairs))
+        ))
+        return self._merge_bulk(chunks)
+
+    async def _fetch_all(self, queries):
+        """
+        Run (query, params) pairs concurrently. Every query finishes, so a
+        half-open breaker trial is never abandoned; the first
+        PrometheusUnavailable is raised after.
+        """
+        results = await asyncio.gather(
+            *(self._fetch(query, **params) for query, params in queries),
+            return_exceptions=True
+        )
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        return results
+
+    async def get_bulk_interface_history(self, pairs, start, end, step):
+        """
+        Get bandwidth in Mbps between two unix times for many (instance, ifName)
+        pairs, with every query_range call in flight at once.
+        Raises PrometheusUnavailable if any chunk fails, as partial history misleads.
+        """
+        planned = [
+            (chunk, direction, query)
+            for selector, chunk in self._chunk_selectors(set(pairs))
+            for direction, query in self._history_queries(selector, step)
+        ]
+        fetched = await self._fetch_all(
+            (query, {'endpoint': 'query_range', 'start': start, 'end': end, 'step': step})
+            for _, _, query in planned
+        )
+        results = {}
+        for (chunk, direction, _), result in zip(planned, fetched):
+            self._add_history(results, direction, result, chunk)
+        return results
+
+    async def get_lldp_neighbors(self):
+        """
+        LLDP remote table rows from the SNMP exporter, as PrometheusClient.get_lldp_neighbors().
+        Raises PrometheusUnavailable, as a partial table would look like missing links.
+        """
+        return self._join_lldp(await self._fetch_all((metric, {}) for metric in self.LLDP_METRICS))
+
+    async def get_bulk_interface_speed(self, pairs):
+        """Interface speeds in Mbps (ifHighSpeed) for many (instance, ifName) pairs"""
+        chunks = list(self._chunk_selectors(set(pairs)))
+        results = await asyncio.gather(
+            *(self._fetch(self._speed_query(selector)) for selector, _ in chunks),
+            return_exceptions=True
+        )
+        speeds = {}
+        for (_, chunk), result in zip(chunks, results):
+            if isinstance(result, BaseException):
+                if not isinstance(result, PrometheusUnavailable):
+                    raise result
+                print(f"Prometheus speed query error: {result}")
+                continue
+            speeds.update({key: value for key, value in self._extract_vector(result).items() if key in chunk})
+        return speeds
+
+    async def aclose(self):
+        """Close the pooled client for the running loop"""
+        state = self._loop_state.pop(asyncio.get_running_loop(), None)
+        if state:
+            await state[0].aclose()
@@ -0,0 +1,132 @@
+import asyncio
+import threading
+import time
+
+
+class BroadcastScheduler:
+    """
+    Coalesces topology change notifications into few rebuilds.
+
+    mark_dirty() is cheap and safe to call from request threads. The first
+    call in a burst arms a timer; every further call within `window` seconds
+    pushes it back, up to `max_delay` seconds after the first one. The rebuild
+    then runs once, outside the request/response cycle: as a task on the
+    server's event loop when one is bound, otherwise on a timer thread.
+    With a `window` of 0 every call rebuilds straight away, in the calling
+    thread (or as a task when called on an event loop).
+    """
+
+    def __init__(self, async_callback, sync_callback, window=0.25, max_delay=2.0):
+        self.async_callback = async_callback
+        self.sync_callback = sync_callback
+        self.window = window
+        self.max_delay = max_delay
+        self._lock = threading.Lock()
+        self._loop = None
+        self._timer = None
+        self._first_dirty = None
+        self._running = False
+        self._rerun = False
+
+    def bind_loop(self, loop):
+        """Run rebuilds on the given event loop (the ASGI server's), idempotent"""
+        if self._loop is None or self._loop.is_closed():
+            self._loop = loop
+
+    @property
+    def idle(self):
+        """True when no rebuild is pending or running"""
+        with self._lock:
+            return self._timer is None and not self._running and not self._rerun
+
+    def mark_dirty(self):
+        """Note that the topology changed; a rebuild will follow shortly"""
+        if self.window <= 0:
+            self._run_now()
+            return
+        loop = self._loop
+        if loop is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(self._arm)
+        else:
+            self._arm()
+
+    def _delay(self):
+        now = time.monotonic()
+        if self._first_dirty is None:
+            self._first_dirty = now
+        return max(0, min(self.window, self._first_dirty + self.max_delay - now))
+
+    def _arm(self):
+        with self._lock:
+            if self._running:
+                # A rebuild is in progress and may have read old data, go again after it
+                self._rerun = True
+                return
+            if self._timer is not None:
+                self._timer.cancel()
+            delay = self._delay()
+            if self._loop is not None and not self._loop.is_closed():
+                self._timer = self._loop.call_later(delay, self._fire)
+            else:
+                self._timer = threading.Timer(delay, self._fire)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def _fire(self):
+        with self._lock:
+            self._timer = None
+            self._first_dirty = None
+            self._running = True
+        if self._loop is not None and not self._loop.is_closed():
+            self._loop.create_task(self._arun())
+        else:
+            self._run()
+
+    def drain(self):
+        """Run a pending rebuild now, in the calling thread; True if there was one"""
+        with self._lock:
+            timer, self._timer = self._timer, None
+            if timer is None:
+                return False
+            timer.cancel()
+            self._first_dirty = None
+            self._running = True
+        self._run()
+        return True
+
+    def _run_now(self):
+        with self._lock:
+            if self._running:
+                self._rerun = True
+                return
+            self._running = True
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        if loop is not None:
+            # Must not block the loop, nor call async_to_sync on it
+            loop.create_task(self._arun())
+        else:
+            self._run()
+
+    def _run(self):
+        try:
+            self.sync_callback()
+        finally:
+            self._done()
+
+    async def _arun(self):
+        try:
+            await self.async_callback()
+        except Exception as e:
+            print(f"Error broadcasting topology update: {e}")
+        finally:
+            self._done()
+
+    def _done(self):
+        with self._lock:
+            self._running = False
+            rerun, self._rerun = self._rerun, False
+        if rerun:
+            self.mark_dirty()
@@ -0,0 +1,46 @@
+import threading
+
+
+class TopologyCache:
+    """
+    In-memory cache of the topology structure (nodes and edges without metrics).
+    Invalidated by Device/Link save and delete signals (see api/signals.py).
+    Cached values are shared between callers and must be treated as read-only.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._value = None
+        self._generation = 0
+
+    @property
+    def generation(self):
+        """Bumped by every invalidate()"""
+        return self._generation
+
+    def peek(self):
+        """Return the cached structure or None, without building"""
+        return self._value
+
+    def get(self, builder):
+        """Return the cached structure, building it with builder() on a miss"""
+        with self._lock:
+            if self._value is not None:
+                return self._value
+            generation = self._generation
+
+        value = builder()
+
+        with self._lock:
+            # Only keep the result if nothing changed while it was being built
+            if generation == self._generation:
+                self._value = value
+        return value
+
+    def invalidate(self):
+        with self._lock:
+            self._value = None
+            self._generation += 1
+
+
+topology_cache = TopologyCache()
@@ -0,0 +1,122 @@
+import threading
+import time
+import uuid
+from collections import deque
+from django.conf import settings
+
+# Edge fields that only describe live metrics, not the link itself
+METRIC_FIELDS = ('bandwidth', 'metrics_age', 'metrics_stale')
+
+
+class TopologyLog:
+    """
+    Versioned record of the topology sent to clients.
+
+    Every publish() diffs a freshly built topology against the last published
+    one and, if anything changed, stores the patch under the next revision.
+    Clients that know their last revision can catch up from the retained
+    patches instead of downloading a full snapshot.
+    """
+
+    def __init__(self, max_entries=500):
+        self._lock = threading.Lock()
+        # Revisions only mean something within one process; patches relayed
+        # from other workers (see api.layers) carry their origin
+        self.origin = uuid.uuid4().hex[:12]
+        # Start from wall-clock milliseconds so revisions from a previous
+        # process are always older and force a fresh snapshot
+        self.revision = int(time.time() * 1000)
+        self.modified_at = time.time()
+        self._nodes = {}
+        self._edges = {}
+        self._timestamp = None
+        self._entries = deque(maxlen=max_entries)
+        # What the last published build was made from (see views.topology_state())
+        self.source = None
+
+    def publish(self, data, source=None):
+        """
+        Record a full topology build, made from `source`.
+        Returns (revision, base_revision, ops); ops is empty when nothing changed.
+        """
+        nodes = {node['id']: node for node in data['nodes']}
+        edges = {edge['id']: edge for edge in data['edges']}
+
+        with self._lock:
+            ops = self._diff(nodes, edges)
+            self._nodes = nodes
+            self._edges = edges
+            self._timestamp = data.get('timestamp')
+            self.source = source
+
+            base = self.revision
+            if ops:
+                self.revision += 1
+                self.modified_at = time.time()
+                self._entries.append((self.revision, ops))
+            return self.revision, base, ops
+
+    def since(self, revision):
+        """
+        Return [(revision, ops), ...] published after `revision`, or None when
+        the client is too far behind (or ahead) and needs a full snapshot.
+        """
+        with self._lock:
+            if revision == self.revision:
+                return []
+            if revision > self.revision or not self._entries or revision < self._entries[0][0] - 1:
+                return None
+            return [entry for entry in self._entries if entry[0] > revision]
+
+    def known_nodes(self, node_ids):
+        """The ids among `node_ids` that are nodes of the last published topology"""
+        with self._lock:
+            return {node_id for node_id in node_ids if node_id in self._nodes}
+
+    def snapshot(self):
+        """Return (revision, data) for the last published topology"""
+        with self._lock:
+            return self.revision, {
+                'nodes': list(self._nodes.values()),
+                'edges': list(self._edges.values()),
+                'timestamp': self._timestamp
+            }
+
+    def _diff(self, nodes, edges):
+        ops = []
+
+        for node_id in self._nodes.keys() - nodes.keys():
+            ops.append({'op': 'node_removed', 'id': node_id})
+        for node_id, node in nodes.items():
+            old = self._nodes.get(node_id)
+            if old is None:
+                ops.append({'op': 'node_added', 'node': node})
+            elif old != node:
+                ops.append({'op': 'node_changed', 'node': node})
+
+        for edge_id in self._edges.keys() - edges.keys():
+            ops.append({'op': 'edge_removed', 'id': edge_id})
+        for edge_id, edge in edges.items():
+            old = self._edges.get(edge_id)
+            if old is None:
+                ops.append({'op': 'edge_added', 'edge': edge})
+            elif self._structure(old) != self._structure(edge):
+                ops.append({'op': 'edge_changed', 'edge': edge})
+            elif (old['bandwidth'], old['metrics_stale']) != (edge['bandwidth'], edge['metrics_stale']):
+                ops.append({
+                    'op': 'edge_metrics',
+                    'id': edge_id,
+                    'bandwidth': edge['bandwidth'],
+                    'metrics_age': edge['metrics_age'],
+                    'metrics_stale': edge['metrics_stale']
+                })
+
+        return ops
+
+    def _structure(self, edge):
+        structure = {k: v for k, v in edge.items() if k not in METRIC_FIELDS}
+        structure['capacity'] = edge['bandwidth']['capacity']
+        return structure
+
+
+topology_log = TopologyLog(max_entries=settings.TOPOLOGY_LOG_SIZE)
@@ -0,0 +1,223 @@
+import asyncio
+import threading
+import time
+from datetime import datetime
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import Q
+from .models import Link
+from .prometheus_client import PrometheusClient, CircuitBreaker
+from .async_prometheus_client import AsyncPrometheusClient
+from .history import bandwidth_history
+from .scopes import subscriptions
+
+
+class MetricsCollector:
+    """
+    Refreshes link bandwidth from Prometheus in the background and keeps the
+    latest values in an in-process snapshot shared by HTTP and WebSocket readers.
+    """
+
+    def __init__(self, client, interval=30, async_client=None, budget=None, history=None, subscriptions=None):
+        self.client = client
+        self.async_client = async_client
+        self.interval = interval
+        # Optional BandwidthHistory that records every refresh
+        self.history = history
+        # Optional Subscriptions limiting refreshes to the sites clients watch
+        self.subscriptions = subscriptions
+        # Overall seconds a single refresh may spend waiting on Prometheus
+        self.budget = budget if budget is not None else interval
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._snapshot = {}
+        self._updated_at = None
+        self._thread = None
+        self._task = None
+        self._stop = threading.Event()
+        self._listeners = []
+        self._loop = None
+        self._wake = None
+
+    @property
+    def running(self):
+        if self._task is not None:
+            return not self._task.done()
+        return self._thread is not None and self._thread.is_alive()
+
+    def add_listener(self, callback):
+        """Register an async callable awaited after every background refresh"""
+        self._listeners.append(callback)
+
+    def start(self):
+        """
+        Start the background refresh loop (idempotent).
+        Inside a running event loop (the ASGI server) it runs as a task on that
+        loop, so listeners can talk to the channel layer; otherwise in a thread.
+        """
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+
+        with self._lock:
+            if self.running:
+                return
+            self._stop.clear()
+            if loop is not None and self.async_client is not None:
+                self._thread = None
+                self._task = loop.create_task(self._arun())
+            else:
+                self._task = None
+                self._thread = threading.Thread(target=self._run, name='netmap-metrics-collector', daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+
+    def wake(self):
+        """Refresh now rather than at the end of the interval (background task only)"""
+        if self._wake is not None and self.running:
+            self._loop.call_soon_threadsafe(self._wake.set)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"Metrics collector error: {e}")
+            finally:
+                close_old_connections()
+            self._stop.wait(self.interval)
+
+    async def _arun(self):
+        """Refresh loop on the server's event loop, fanning out queries concurrently"""
+        self._loop = asyncio.get_running_loop()
+        self._wake = asyncio.Event()
+        try:
+            while not self._stop.is_set():
+                try:
+                    await self.arefresh()
+                    for listener in self._listeners:
+                        await listener()
+                except Exception as e:
+                    print(f"Metrics collector error: {e}")
+                try:
+                    await asyncio.wait_for(self._wake.wait(), self.interval)
+                except asyncio.TimeoutError:
+                    pass
+                self._wake.clear()
+        finally:
+            await self.async_client.aclose()
+
+    def monitored_pairs(self):
+        """All (instance, ifName) pairs that currently report bandwidth on watched links"""
+        links = Link.objects.select_related('source_device', 'target_device')
+        sites = self.subscriptions.wanted_sites() if self.subscriptions is not None else None
+        if sites is not None:
+            links = links.filter(Q(source_device__site__in=sites) | Q(target_device__site__in=sites))
+        return {link.metric_key for link in links if link.metric_key}
+
+    def refresh(self):
+        """Fetch bandwidth for every monitored link and swap in a new snapshot"""
+        pairs = self.monitored_pairs()
+        with self.client.deadline(self.budget):
+            results = self.client.get_bulk_interface_bandwidth(pairs) if pairs else {}
+        return self._store(results)
+
+    async def arefresh(self):
+        """Async refresh using the pooled async client"""
+        pairs = await database_sync_to_async(self.monitored_pairs)()
+        with self.async_client.deadline(self.budget):
+            results = await self.async_client.get_bulk_interface_bandwidth(pairs) if pairs else {}
+        return self._store(results)
+
+    def _store(self, results):
+        fetched_at = time.time()
+
+        snapshot = {}
+        for key, metrics in results.items():
+            # Stale fallbacks keep the time they were originally fetched
+            snapshot[key] = dict({'fetched_at': fetched_at, 'stale': False}, **metrics)
+
+        # Readers hold a reference to the old dict, so replace rather than mutate
+        with self._lock:
+            self._snapshot = snapshot
+            self._updated_at = fetched_at
+        if self.history is not None:
+            self.history.record(snapshot, fetched_at)
+        return snapshot
+
+    def seed(self, snapshot, updated_at=None):
+        """
+        Serve `snapshot` (e.g. read from disk, marked stale) until the first
+        refresh replaces it. Ignored once a refresh has been stored.
+        """
+        with self._lock:
+            if self._updated_at is None and not self._snapshot:
+                self._snapshot = snapshot
+                self._updated_at = updated_at
+
+    def latest(self):
+        """(snapshot, fetched_at as a Unix time or None) as last stored, without refreshing"""
+        with self._lock:
+            return self._snapshot, self._updated_at
+
+    def get_snapshot(self):
+        """
+        Return the current {(instance, ifName): metrics} snapshot.
+        Without a running collector (runserver, management commands) stale
+        data is refreshed inline on first read after the interval.
+        """
+        if not self.running and self._is_stale():
+            with self._refresh_lock:
+                if self._is_stale():
+                    self.refresh()
+        return self._snapshot
+
+    async def aget_snapshot(self):
+        """Async variant of get_snapshot() that never blocks the event loop on Prometheus"""
+        if not self.running and self._is_stale() and self.async_client is not None:
+            await self.arefresh()
+        return self._snapshot
+
+    def _is_stale(self):
+        return self._updated_at is None or time.time() - self._updated_at >= self.interval
+
+    @property
+    def updated_at(self):
+        if self._updated_at is None:
+            return None
+        return datetime.fromtimestamp(self._updated_at).isoformat()
+
+
+# Sync and async clients share one view of Prometheus health
+breaker = CircuitBreaker(
+    failure_threshold=settings.PROMETHEUS_BREAKER_THRESHOLD,
+    reset_timeout=settings.PROMETHEUS_BREAKER_RESET
+)
+
+collector = MetricsCollector(
+    PrometheusClient(
+        settings.PROMETHEUS_URL,
+        pool_size=settings.PROMETHEUS_MAX_CONNECTIONS,
+        retries=settings.PROMETHEUS_RETRIES,
+        timeout=settings.PROMETHEUS_QUERY_TIMEOUT,
+        breaker=breaker
+    ),
+    interval=settings.METRICS_REFRESH_INTERVAL,
+    async_client=AsyncPrometheusClient(
+        settings.PROMETHEUS_URL,
+        max_connections=settings.PROMETHEUS_MAX_CONNECTIONS,
+        max_concurrency=settings.PROMETHEUS_MAX_CONCURRENCY,
+        query_timeout=settings.PROMETHEUS_QUERY_TIMEOUT,
+        retries=settings.PROMETHEUS_RETRIES,
+        breaker=breaker
+    ),
+    budget=settings.PROMETHEUS_BUILD_BUDGET,
+    history=bandwidth_history,
+    subscriptions=subscriptions
+)
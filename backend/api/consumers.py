@@ -1,61 +1,315 @@
 import json
+from collections import deque
+from urllib.parse import parse_qs
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
-from .views import get_topology_data
+from django.conf import settings
+from .changelog import topology_log
+from .encoding import negotiate, release, encode_frame, frame_for, snapshot_frames
+from .positions import position_stream
+from .scopes import subscriptions, scope_group, parse_sites
+from .aggregate import parse_level
+from .collector import collector
+from .instrumentation import websocket_clients, websocket_held_patches, websocket_resyncs
+from .views import apublish_current
+
+
+class Mailbox:
+    """
+    Patches held back for a client that is behind on acknowledgements,
+    merged into one: structural ops in order, only the latest metrics per
+    edge and the latest live position per device. Past `max_ops` structural
+    ops the backlog is dropped and the client needs a fresh snapshot.
+    """
+
+    def __init__(self, base, max_ops):
+        self.base = base
+        self.revision = base
+        self.max_ops = max_ops
+        self.ops = []
+        self.metrics = {}
+        self.positions = {}
+        self.resync = False
+
+    def add_patch(self, revision, ops):
+        self.revision = revision
+        if self.resync:
+            return
+        for op in ops:
+            if op['op'] == 'edge_metrics':
+                self.metrics[op['id']] = op
+                continue
+            if op['op'].startswith('edge_'):
+                # Added and changed edges carry their current metrics
+                self.metrics.pop(op['edge']['id'] if 'edge' in op else op['id'], None)
+            self.ops.append(op)
+        if len(self.ops) > self.max_ops:
+            self.skip_to(revision)
+
+    def add_positions(self, positions):
+        for position in positions:
+            self.positions[position['id']] = position
+
+    def skip_to(self, revision):
+        """Give up on the backlog (too long, or a patch went missing)"""
+        self.revision = revision
+        self.resync = True
+        self.ops.clear()
+        self.metrics.clear()
+
+    def patch_ops(self):
+        return self.ops + list(self.metrics.values())
 
 
 class TopologyConsumer(AsyncWebsocketConsumer):
     """
     WebSocket consumer for real-time topology updates.
-    Handles connections, disconnections, and broadcasts topology changes.
+
+    Protocol: clients get one full snapshot ('topology_update') on connect and
+    then 'topology_patch' messages, each with a monotonically increasing
+    revision and the revision it applies on top of ('base'). A client that
+    reconnects with ?revision=N (or sends {'action': 'resume', 'revision': N})
+    receives only the patches it missed, or a fresh snapshot if they are no
+    longer retained.
+
+    Clients see the whole map unless they connect with ?site=a,b or send
+    {'action': 'subscribe', 'sites': ['a', 'b']} (null for everything); then
+    snapshots and patches only cover those sites' devices, the links touching
+    them and the devices at the far end, with revisions of their own.
+    ?level=site or ?level=rack (or 'level' in the subscribe message) collapses
+    each site or rack into one node, with the links between two groups merged.
+
+    While dragging, clients send {'action': 'move', 'positions': [{'id', 'x',
+    'y'}, ...]}; other clients whose view shows those devices receive
+    throttled 'position_update' messages.
+
+    Frames are JSON text by default; ?encoding=deflate or ?encoding=msgpack
+    selects compact binary frames.
+
+    Clients that send {'action': 'ack', 'revision': N} after applying each
+    snapshot or patch get flow control: with WEBSOCKET_MAX_IN_FLIGHT frames
+    unacknowledged, new patches wait in a per-client Mailbox and go out as
+    one merged patch on the next ack (or as a snapshot if the client fell
+    too far behind), instead of queueing up in the server.
     """
-    
+
     async def connect(self):
         """Handle new WebSocket connections"""
-        # Add this connection to the topology group
-        self.group_name = 'topology_updates'
-        
-        await self.channel_layer.group_add(
-            self.group_name,
-            self.channel_name
-        )
-        
+        query = parse_qs(self.scope.get('query_string', b'').decode())
+        self.encoding = negotiate(query.get('encoding', [None])[0])
+        self.revision = None
+        # Flow control, enabled by the client's first ack
+        self.acks = False
+        self.in_flight = deque()
+        self.mailbox = None
+
+        # Add this connection to the group of the sites it views
+        self.sites = None
+        self.level = None
+        self.group_name = None
+        try:
+            level = parse_level(query.get('level', [None])[0])
+        except ValueError:
+            level = None
+        await self.join(parse_sites(query.get('site', [None])[0]), level)
+        await self.channel_layer.group_add(position_stream.group_name, self.channel_name)
+
         await self.accept()
-        
-        # Send initial topology data
-        topology_data = await self.get_topology()
-        await self.send(text_data=json.dumps({
-            'type': 'topology_update',
-            'data': topology_data
-        }))
+        websocket_clients.inc()
+        self.counted = True
+
+        # Send initial topology data, or just what a reconnecting client missed
+        try:
+            revision = int(query['revision'][0])
+        except (KeyError, IndexError, ValueError):
+            revision = None
+        await self.catch_up(revision)
 
     async def disconnect(self, close_code):
         """Handle WebSocket disconnections"""
+        if getattr(self, 'counted', False):
+            websocket_clients.dec()
+            self.counted = False
+        if getattr(self, 'encoding', None) is not None:
+            release(self.encoding)
+            self.encoding = None
         # Remove from topology group
+        await self.leave()
+        await self.channel_layer.group_discard(position_stream.group_name, self.channel_name)
+
+    async def join(self, sites, level=None):
+        """Subscribe to a view: a set of sites (None: all) at a detail level (None: devices)"""
+        if subscriptions.subscribe(sites, level):
+            # Their links were not being fetched, don't wait for the next refresh
+            collector.wake()
+        self.sites = sites
+        self.level = level
+        self.group_name = scope_group(sites, level)
+        await self.channel_layer.group_add(
+            self.group_name,
+            self.channel_name
+        )
+
+    async def leave(self):
+        if self.group_name is None:
+            return
+        subscriptions.unsubscribe(self.sites, self.level)
         await self.channel_layer.group_discard(
             self.group_name,
             self.channel_name
         )
+        self.group_name = None
+
+    @property
+    def log(self):
+        """The change log this client's revisions come from"""
+        if self.sites is None and self.level is None:
+            return topology_log
+        return subscriptions.log(self.sites, self.level)
 
     async def receive(self, text_data):
         """Handle incoming WebSocket messages"""
         data = json.loads(text_data)
-        
-        if data.get('action') == 'refresh':
-            topology_data = await self.get_topology()
-            await self.send(text_data=json.dumps({
-                'type': 'topology_update',
-                'data': topology_data
-            }))
-
-    async def topology_update(self, event):
-        """Send topology update to WebSocket (called by channel layer)"""
-        await self.send(text_data=json.dumps({
-            'type': 'topology_update',
-            'data': event['data']
-        }))
-
-    @database_sync_to_async
-    def get_topology(self):
-        """Fetch topology data from database"""
-        return get_topology_data()
+        action = data.get('action')
+
+        if action == 'refresh':
+            await self.catch_up(None)
+        elif action == 'resume':
+            await self.catch_up(data.get('revision'))
+        elif action == 'move' and isinstance(data.get('positions'), list):
+            await position_stream.submit(data['positions'], sender=self.channel_name)
+        elif action == 'ack' and isinstance(data.get('revision'), int):
+            await self.acknowledge(data['revision'])
+        elif action == 'subscribe':
+            try:
+                sites = parse_sites(data.get('sites'))
+                level = parse_level(data.get('level'))
+            except ValueError:
+                return
+            await self.leave()
+            await self.join(sites, level)
+            # A different view, with revisions of its own
+            self.revision = None
+            self.in_flight.clear()
+            await self.catch_up(None)
+
+    async def catch_up(self, revision):
+        """Bring this client up to the latest revision with patches or a snapshot"""
+        # Make sure the log reflects the current database and metrics
+        await apublish_current()
+        # Whatever a held mailbox contained is covered by the catch-up
+        self.mailbox = None
+
+        entries = self.log.since(revision) if isinstance(revision, int) else None
+        if entries is None:
+            await self.send_snapshot()
+            return
+
+        base = revision
+        for entry_revision, ops in entries:
+            await self.send_patch(entry_revision, base, ops)
+            base = entry_revision
+
+    async def send_frame(self, frame):
+        if isinstance(frame, bytes):
+            await self.send(bytes_data=frame)
+        else:
+            await self.send(text_data=frame)
+
+    @property
+    def congested(self):
+        return self.acks and len(self.in_flight) >= settings.WEBSOCKET_MAX_IN_FLIGHT
+
+    def sent(self, revision):
+        if self.acks:
+            self.in_flight.append(revision)
+
+    async def acknowledge(self, revision):
+        """The client has applied everything up to `revision`"""
+        self.acks = True
+        while self.in_flight and self.in_flight[0] <= revision:
+            self.in_flight.popleft()
+        if self.mailbox is not None and not self.congested:
+            await self.flush_mailbox()
+
+    def hold(self):
+        if self.mailbox is None:
+            self.mailbox = Mailbox(self.revision, settings.WEBSOCKET_MAX_PENDING_OPS)
+        return self.mailbox
+
+    async def flush_mailbox(self):
+        mailbox, self.mailbox = self.mailbox, None
+        if mailbox.resync:
+            websocket_resyncs.inc()
+            await self.send_snapshot()
+        elif mailbox.revision != mailbox.base:
+            await self.send_patch(mailbox.revision, mailbox.base, mailbox.patch_ops())
+        if mailbox.positions:
+            await self.send_frame(encode_frame({
+                'type': 'position_update',
+                'positions': list(mailbox.positions.values())
+            }, self.encoding))
+
+    async def send_snapshot(self):
+        revision, frame = snapshot_frames.get(self.log, self.encoding)
+        self.revision = revision
+        self.mailbox = None
+        self.sent(revision)
+        await self.send_frame(frame)
+
+    async def send_patch(self, revision, base, ops):
+        self.revision = revision
+        self.sent(revision)
+        await self.send_frame(encode_frame({
+            'type': 'topology_patch',
+            'revision': revision,
+            'base': base,
+            'ops': ops
+        }, self.encoding))
+
+    async def topology_patch(self, event):
+        """Send a topology patch to WebSocket (called by channel layer)"""
+        if event.get('origin', topology_log.origin) != topology_log.origin:
+            # Another worker's revisions (shared Redis groups); its database
+            # changes reach us as topology notices (see api.notices)
+            return
+        if event.get('group', self.group_name) != self.group_name:
+            # Queued before this client switched to other sites
+            return
+        latest = self.mailbox.revision if self.mailbox is not None else self.revision
+        if latest is not None and event['revision'] <= latest:
+            # Already covered by the snapshot or catch-up this client received
+            return
+        frames = event['frames']
+
+        if self.mailbox is not None or self.congested:
+            # Behind on acks: merge into the mailbox rather than queue frames
+            mailbox = self.hold()
+            if event['base'] != mailbox.revision:
+                mailbox.skip_to(event['revision'])
+            else:
+                mailbox.add_patch(event['revision'], json.loads(frames['json'])['ops'])
+            websocket_held_patches.inc()
+            return
+
+        if event['base'] != self.revision:
+            await self.catch_up(self.revision)
+            return
+        self.revision = event['revision']
+        self.sent(event['revision'])
+        await self.send_frame(frame_for(frames, self.encoding))
+
+    async def position_update(self, event):
+        """Send live device positions to WebSocket (called by channel layer)"""
+        if event.get('sender') == self.channel_name:
+            # The dragging client already shows its own positions
+            return
+        frames = event['frames']
+        if self.sites is not None or self.level is not None:
+            # Only the devices this client's view shows
+            frames = position_stream.view_frames(frames, self.log)
+            if frames is None:
+                return
+        if self.mailbox is not None or self.congested:
+            self.hold().add_positions(json.loads(frames['json'])['positions'])
+            return
+        await self.send_frame(frame_for(frames, self.encoding))
@@ -0,0 +1,179 @@
+import gzip
+import json
+import threading
+import zlib
+from collections import Counter, OrderedDict
+from django.conf import settings
+from .instrumentation import payload_bytes
+
+try:
+    import msgpack
+except ImportError:  # MessagePack frames are optional
+    msgpack = None
+
+try:
+    import brotli
+except ImportError:  # Brotli HTTP responses are optional
+    brotli = None
+
+DEFAULT_ENCODING = 'json'
+
+# Smaller HTTP bodies are not worth compressing
+MIN_COMPRESS_LENGTH = 200
+
+
+def available_encodings():
+    """WebSocket frame encodings enabled in settings and installed"""
+    encodings = [DEFAULT_ENCODING]
+    for name in settings.WEBSOCKET_ENCODINGS:
+        if name == 'msgpack' and msgpack is None:
+            continue
+        if name in ENCODERS and name not in encodings:
+            encodings.append(name)
+    return encodings
+
+
+# Frame encodings of the clients connected to this process
+_in_use = Counter()
+_in_use_lock = threading.Lock()
+
+
+def negotiate(requested):
+    """
+    Pick the frame encoding for a client, falling back to JSON text.
+    The client counts as using it until release() is called.
+    """
+    encoding = requested if requested in available_encodings() else DEFAULT_ENCODING
+    with _in_use_lock:
+        _in_use[encoding] += 1
+    return encoding
+
+
+def release(encoding):
+    """A client that negotiated `encoding` disconnected"""
+    with _in_use_lock:
+        _in_use[encoding] -= 1
+        if _in_use[encoding] <= 0:
+            del _in_use[encoding]
+
+
+def encodings_in_use():
+    """JSON (which held patches are merged from) and whatever connected clients use"""
+    with _in_use_lock:
+        return [DEFAULT_ENCODING] + [name for name in _in_use if name != DEFAULT_ENCODING]
+
+
+def encode_json(message):
+    return json.dumps(message, separators=(',', ':'))
+
+
+def deflate(text):
+    """zlib-wrapped JSON text, readable with DecompressionStream('deflate') in browsers"""
+    return zlib.compress(text.encode(), settings.WEBSOCKET_COMPRESSION_LEVEL)
+
+
+def encode_deflate(message):
+    return deflate(encode_json(message))
+
+
+def encode_msgpack(message):
+    return msgpack.packb(message, use_bin_type=True)
+
+
+ENCODERS = {
+    'json': encode_json,
+    'deflate': encode_deflate,
+    'msgpack': encode_msgpack,
+}
+
+
+def encode_frames(message, encodings=None):
+    """
+    Encode one message once in each encoding a connected client uses (by
+    default), deflating the JSON text rather than serializing it again.
+    Returns {encoding: str (text frame) or bytes (binary frame)}, always
+    with 'json'.
+    """
+    encodings = encodings or encodings_in_use()
+    text = encode_json(message)
+    frames = {DEFAULT_ENCODING: text}
+    for name in encodings:
+        if name == 'deflate':
+            frames[name] = deflate(text)
+        elif name != DEFAULT_ENCODING:
+            frames[name] = ENCODERS[name](message)
+    kind = message.get('type', '')
+    for name, frame in frames.items():
+        payload_bytes.observe(len(frame), type=kind, encoding=name)
+    return frames
+
+
+def encode_frame(message, encoding):
+    frame = ENCODERS[encoding](message)
+    payload_bytes.observe(len(frame), type=message.get('type', ''), encoding=encoding)
+    return frame
+
+
+def frame_for(frames, encoding):
+    """The frame in `encoding` from encode_frames(), encoded from the JSON if it is missing"""
+    frame = frames.get(encoding)
+    if frame is None:
+        # The client connected after the frames were built, or they came from another worker
+        frame = encode_frame(json.loads(frames[DEFAULT_ENCODING]), encoding)
+    return frame
+
+
+class SnapshotFrames:
+    """
+    Full snapshot frames encoded once per change log, revision and encoding,
+    shared by every client that connects or resyncs in between patches.
+    """
+
+    def __init__(self, size=32):
+        self.size = size
+        self._frames = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, log, encoding):
+        """(revision, frame) of the latest snapshot of `log`"""
+        key = (log, log.revision, encoding)
+        with self._lock:
+            if key in self._frames:
+                self._frames.move_to_end(key)
+                return key[1], self._frames[key]
+        revision, data = log.snapshot()
+        frame = encode_frame({'type': 'topology_update', 'revision': revision, 'data': data}, encoding)
+        with self._lock:
+            self._frames[(log, revision, encoding)] = frame
+            while len(self._frames) > self.size:
+                self._frames.popitem(last=False)
+        return revision, frame
+
+
+snapshot_frames = SnapshotFrames()
+
+
+def accepted_encodings(header):
+    """Content codings from an Accept-Encoding header, without the ones refused by q=0"""
+    accepted = set()
+    for part in header.split(','):
+        name, _, params = part.strip().partition(';')
+        if params.replace(' ', '') in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+            continue
+        accepted.add(name.strip().lower())
+    return accepted
+
+
+def compress_body(body, accept_encoding):
+    """
+    Compress an HTTP response body with the best coding the client accepts.
+    Returns (body, content_encoding); content_encoding is None if left as is.
+    """
+    if len(body) < MIN_COMPRESS_LENGTH:
+        return body, None
+    accepted = accepted_encodings(accept_encoding)
+    if brotli is not None and 'br' in accepted:
+        return brotli.compress(body, quality=5), 'br'
+    if 'gzip' in accepted:
+        return gzip.compress(body, compresslevel=6, mtime=0), 'gzip'
+    return body, None
@@ -0,0 +1,373 @@
+import heapq
+import threading
+from array import array
+from .models import Device, Link
+
+
+class GraphIndex:
+    """
+    Undirected adjacency of the Device/Link graph in CSR form: node i's
+    neighbours are targets[offsets[i]:offsets[i + 1]] and the links leading
+    to them edge_links[...] at the same positions. Nodes are numbered by
+    position in `ids`; parallel links stay separate edges.
+
+    Model signals keep it current without rereading the database: new links
+    go to a small overflow adjacency, deleted ones are skipped, and the
+    arrays are rebuilt from memory once those grow past `compact_ratio` of
+    the graph. Bulk writes bypass signals, so they call reload() and the
+    next query rereads both tables (two queries).
+    """
+
+    def __init__(self, compact_ratio=0.05):
+        self.compact_ratio = compact_ratio
+        self._lock = threading.RLock()
+        self._loaded = False
+        self.version = 0
+        self._articulation = None
+
+    def reload(self):
+        """Reread devices and links on next use"""
+        with self._lock:
+            self._loaded = False
+            self.version += 1
+
+    def _ensure(self):
+        if not self._loaded:
+            devices = list(Device.objects.values_list('id', flat=True))
+            links = {link_id: (source, target) for link_id, source, target in
+                     Link.objects.values_list('id', 'source_device_id', 'target_device_id')}
+            self._build(devices, links)
+            self._loaded = True
+
+    def _build(self, devices, links):
+        ids = list(devices)
+        index = {device_id: i for i, device_id in enumerate(ids)}
+        # Links of a device deleted mid-cascade are about to go too
+        links = {link_id: ends for link_id, ends in links.items() if ends[0] in index and ends[1] in index}
+        degree = [0] * (len(ids) + 1)
+        for source, target in links.values():
+            degree[index[source] + 1] += 1
+            degree[index[target] + 1] += 1
+        for i in range(len(ids)):
+            degree[i + 1] += degree[i]
+        offsets = array('q', degree)
+        fill = degree[:-1]
+        targets = array('q', bytes(8 * offsets[-1]))
+        edge_links = array('q', bytes(8 * offsets[-1]))
+        for link_id, (source, target) in links.items():
+            s, t = index[source], index[target]
+            targets[fill[s]], edge_links[fill[s]] = t, link_id
+            fill[s] += 1
+            targets[fill[t]], edge_links[fill[t]] = s, link_id
+            fill[t] += 1
+
+        self.ids, self.index, self.links = ids, index, links
+        self.offsets, self.targets, self.edge_links = offsets, targets, edge_links
+        self.extra = {}
+        self.removed = set()
+        # Nodes whose adjacency differs from the arrays
+        self.dirty = set()
+        self._overlay = 0
+        self.version += 1
+        self._articulation = None
+
+    def _changed(self):
+        self.version += 1
+        self._articulation = None
+        if self._overlay > self.compact_ratio * max(len(self.links), 1000):
+            self._build([device_id for device_id in self.ids if device_id in self.index], self.links)
+
+    # Incremental updates from model signals (see api/signals.py)
+
+    def add_device(self, device_id):
+        with self._lock:
+            if not self._loaded or device_id in self.index:
+                return
+            self.index[device_id] = len(self.ids)
+            self.ids.append(device_id)
+            self.offsets.append(self.offsets[-1])
+            self._changed()
+
+    def remove_device(self, device_id):
+        """Its links are deleted (and signalled) by the cascade"""
+        with self._lock:
+            if self._loaded and self.index.pop(device_id, None) is not None:
+                self._changed()
+
+    def add_link(self, link_id, source, target):
+        with self._lock:
+            if not self._loaded:
+                return
+            if self.links.get(link_id) == (source, target):
+                return
+            if source not in self.index or target not in self.index:
+                self._loaded = False
+                return
+            if link_id in self.links:
+                self._drop_link(link_id)
+            self.links[link_id] = (source, target)
+            s, t = self.index[source], self.index[target]
+            self.extra.setdefault(s, []).append((t, link_id))
+            self.extra.setdefault(t, []).append((s, link_id))
+            self.dirty.update((s, t))
+            self._overlay += 1
+            self._changed()
+
+    def remove_link(self, link_id):
+        with self._lock:
+            if self._loaded and link_id in self.links:
+                self._drop_link(link_id)
+                self._changed()
+
+    def _drop_link(self, link_id):
+        source, target = self.links.pop(link_id)
+        for end in (source, target):
+            i = self.index.get(end)
+            if i is None:
+                continue
+            self.dirty.add(i)
+            if i in self.extra:
+                self.extra[i] = [(n, l) for n, l in self.extra[i] if l != link_id]
+        self.removed.add(link_id)
+        self._overlay += 1
+
+    # Queries take device and link ids and return them
+
+    def neighbours(self, i):
+        """(node, link id) pairs of node i"""
+        start, end = self.offsets[i], self.offsets[i + 1]
+        removed = self.removed
+        for j, link_id in zip(self.targets[start:end], self.edge_links[start:end]):
+            if link_id not in removed:
+                yield j, link_id
+        yield from self.extra.get(i, ())
+
+    def _nodes(self, device_ids):
+        return {self.index[device_id] for device_id in device_ids if device_id in self.index}
+
+    def has_device(self, device_id):
+        with self._lock:
+            self._ensure()
+            return device_id in self.index
+
+    def stats(self):
+        with self._lock:
+            self._ensure()
+            return {'devices': len(self.index), 'links': len(self.links), 'version': self.version}
+
+    def shortest_path(self, source, target, costs=None):
+        """
+        ([device ids], [link ids], cost) of a shortest path, or None if there
+        is none. Without `costs` ({link id: cost}) every hop counts 1 and a
+        bidirectional BFS is used, otherwise Dijkstra.
+        """
+        with self._lock:
+            self._ensure()
+            if source not in self.index or target not in self.index:
+                return None
+            s, t = self.index[source], self.index[target]
+            if s == t:
+                return [source], [], 0
+            if costs is None:
+                found = self._bidirectional_bfs(s, t)
+            else:
+                found = self._dijkstra(s, t, costs)
+            if found is None:
+                return None
+            nodes, links, cost = found
+            return [self.ids[i] for i in nodes], links, cost
+
+    def _bidirectional_bfs(self, s, t):
+        forward, backward = {s: None}, {t: None}
+        forward_queue, backward_queue = [s], [t]
+        while forward_queue and backward_queue:
+            # Expand the smaller frontier by one level
+            if len(forward_queue) <= len(backward_queue):
+                queue, seen, other = forward_queue, forward, backward
+            else:
+                queue, seen, other = backward_queue, backward, forward
+            following = []
+            for u in queue:
+                for v, link_id in self.neighbours(u):
+                    if v in seen:
+                        continue
+                    seen[v] = (u, link_id)
+                    if v in other:
+                        return self._join(v, forward, backward)
+                    following.append(v)
+            if seen is forward:
+                forward_queue = following
+            else:
+                backward_queue = following
+        return None
+
+    def _join(self, meet, forward, backward):
+        nodes, links = [meet], []
+        node = meet
+        while forward[node] is not None:
+            node, link_id = forward[node]
+            nodes.append(node)
+            links.append(link_id)
+        nodes.reverse()
+        links.reverse()
+        node = meet
+        while backward[node] is not None:
+            node, link_id = backward[node]
+            nodes.append(node)
+            links.append(link_id)
+        return nodes, links, len(links)
+
+    def _dijkstra(self, s, t, costs):
+        distance = {s: 0.0}
+        previous = {s: None}
+        heap = [(0.0, s)]
+        done = set()
+        while heap:
+            d, u = heapq.heappop(heap)
+            if u in done:
+                continue
+            if u == t:
+                break
+            done.add(u)
+            for v, link_id in self.neighbours(u):
+                candidate = d + costs.get(link_id, 1.0)
+                if candidate < distance.get(v, float('inf')):
+                    distance[v] = candidate
+                    previous[v] = (u, link_id)
+                    heapq.heappush(heap, (candidate, v))
+        if t not in previous:
+            return None
+        nodes, links = [t], []
+        node = t
+        while previous[node] is not None:
+            node, link_id = previous[node]
+            nodes.append(node)
+            links.append(link_id)
+        nodes.reverse()
+        links.reverse()
+        return nodes, links, round(distance[t], 3)
+
+    def reachable(self, sources, failed_devices=(), failed_links=(), max_hops=None):
+        """Device ids reachable from `sources` while the failed devices and links are down"""
+        with self._lock:
+            self._ensure()
+            failed = self._nodes(failed_devices)
+            starts = self._nodes(sources) - failed
+            failed_links = {link_id for link_id in failed_links if link_id in self.links}
+            return {self.ids[i] for i in self._reach(starts, failed, failed_links, max_hops)}
+
+    def _reach(self, starts, failed, failed_links, max_hops=None):
+        """Level by level; nodes without changes or failed links take their neighbours straight from the arrays"""
+        offsets, targets = self.offsets, self.targets
+        # Ends of failed links, unless the device itself is already gone
+        ends = {self.index.get(end) for link_id in failed_links for end in self.links[link_id]}
+        dirty = self.dirty | (ends - {None})
+        seen = set(starts) | failed
+        frontier = set(starts)
+        hops = 0
+        while frontier and (max_hops is None or hops < max_hops):
+            following = set()
+            for u in frontier:
+                if u in dirty:
+                    following.update(v for v, link_id in self.neighbours(u) if link_id not in failed_links)
+                else:
+                    following.update(targets[offsets[u]:offsets[u + 1]])
+            following -= seen
+            seen |= following
+            frontier = following
+            hops += 1
+        return seen - failed
+
+    def impact(self, failed_devices=(), failed_links=(), roots=()):
+        """
+        What a failure cuts off: devices no longer reachable from any of
+        `roots` (e.g. the ISP uplinks), or outside the largest remaining
+        component when there are none, and the links that go down with the
+        failed devices.
+        """
+        with self._lock:
+            self._ensure()
+            failed = self._nodes(failed_devices)
+            failed_links = {link_id for link_id in failed_links if link_id in self.links}
+            live = set(self.index.values()) - failed
+            starts = self._nodes(roots) - failed
+            if starts:
+                connected = self._reach(starts, failed, failed_links)
+            else:
+                connected, remaining = set(), set(live)
+                while remaining:
+                    component = self._reach({remaining.pop()}, failed, failed_links)
+                    remaining -= component
+                    if len(component) > len(connected):
+                        connected = component
+            down = failed_links | {link_id for i in failed for _, link_id in self.neighbours(i)}
+            return {
+                'unreachable': sorted(self.ids[i] for i in live - connected),
+                'links_down': sorted(down)
+            }
+
+    def articulation_points(self):
+        """
+        ({device ids}, {link ids}) whose failure alone splits the network:
+        cut vertices and bridges, with an iterative Tarjan DFS. Cached until
+        the graph changes.
+        """
+        with self._lock:
+            self._ensure()
+            if self._articulation is None:
+                self._articulation = self._tarjan()
+            return self._articulation
+
+    def _tarjan(self):
+        order, low = {}, {}
+        points, bridges = set(), set()
+        counter = 0
+        for root in self.index.values():
+            if root in order:
+                continue
+            order[root] = low[root] = counter
+            counter += 1
+            children = 0
+            # (node, link it was reached by, its neighbours, next neighbour to visit)
+            stack = [[root, None, self._adjacent(root), 0]]
+            while stack:
+                frame = stack[-1]
+                u, parent_link, edges, position = frame
+                while position < len(edges):
+                    v, link_id = edges[position]
+                    position += 1
+                    if link_id == parent_link:
+                        continue
+                    if v in order:
+                        if order[v] < low[u]:
+                            low[u] = order[v]
+                        continue
+                    order[v] = low[v] = counter
+                    counter += 1
+                    if u == root:
+                        children += 1
+                    frame[3] = position
+                    stack.append([v, link_id, self._adjacent(v), 0])
+                    break
+                else:
+                    stack.pop()
+                    if stack:
+                        p = stack[-1][0]
+                        if low[u] < low[p]:
+                            low[p] = low[u]
+                        if low[u] > order[p]:
+                            bridges.add(parent_link)
+                        if p != root and low[u] >= order[p]:
+                            points.add(self.ids[p])
+            if children > 1:
+                points.add(self.ids[root])
+        return points, bridges
+
+    def _adjacent(self, i):
+        if i in self.dirty:
+            return list(self.neighbours(i))
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return list(zip(self.targets[start:end], self.edge_links[start:end]))
+
+
+graph_index = GraphIndex()
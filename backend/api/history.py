@@ -0,0 +1,216 @@
+import math
+import threading
+from array import array
+from collections import OrderedDict
+from django.conf import settings
+
+NAN = float('nan')
+
+
+class BandwidthHistory:
+    """
+    Recent inbound/outbound samples per (instance, ifName), kept in memory.
+
+    Every refresh adds one sample round. Samples live in flat float32 arrays
+    with `size` slots per interface, used as ring buffers; the sample times
+    are shared by all interfaces. Memory is bounded at roughly
+    max_keys * size * 8 bytes (about 48 MB for 50k links of 120 samples).
+    Interfaces missing from a round get a gap (NaN), and interfaces unseen
+    for a whole ring are dropped so their slots can be reused.
+    """
+
+    def __init__(self, size=120, max_keys=50000):
+        self.size = size
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        self._times = array('d', [NAN]) * size
+        self._head = 0
+        self._round = 0
+        self._slots = {}
+        self._last_seen = {}
+        self._free = []
+        self._inbound = array('f')
+        self._outbound = array('f')
+
+    def __len__(self):
+        return len(self._slots)
+
+    def record(self, results, timestamp):
+        """Add one round of {key: {'inbound', 'outbound', 'stale'}} samples"""
+        with self._lock:
+            head = self._head
+            self._times[head] = timestamp
+            self._round += 1
+
+            seen = set()
+            for key, metrics in results.items():
+                if metrics.get('stale'):
+                    # Last known values repeated after a failure are not new samples
+                    continue
+                slot = self._slot(key)
+                if slot is None:
+                    continue
+                index = slot * self.size + head
+                self._inbound[index] = metrics['inbound']
+                self._outbound[index] = metrics['outbound']
+                self._last_seen[key] = self._round
+                seen.add(slot)
+
+            for key, slot in list(self._slots.items()):
+                if slot in seen:
+                    continue
+                if self._round - self._last_seen[key] >= self.size:
+                    del self._slots[key]
+                    del self._last_seen[key]
+                    self._free.append(slot)
+                else:
+                    index = slot * self.size + head
+                    self._inbound[index] = NAN
+                    self._outbound[index] = NAN
+
+            self._head = (head + 1) % self.size
+
+    def _slot(self, key):
+        slot = self._slots.get(key)
+        if slot is not None:
+            return slot
+        if self._free:
+            slot = self._free.pop()
+            start = slot * self.size
+            self._inbound[start:start + self.size] = array('f', [NAN]) * self.size
+            self._outbound[start:start + self.size] = array('f', [NAN]) * self.size
+        elif len(self._slots) < self.max_keys:
+            slot = len(self._slots)
+            self._inbound.extend(array('f', [NAN]) * self.size)
+            self._outbound.extend(array('f', [NAN]) * self.size)
+        else:
+            return None
+        self._slots[key] = slot
+        return slot
+
+    def series(self, keys, points=None):
+        """
+        Oldest-to-newest samples for many interfaces, averaged down to at most
+        `points` values. Returns (timestamps, {key: (inbound, outbound)});
+        keys without history are left out, gaps are None.
+        """
+        with self._lock:
+            order = self._order()
+            timestamps = [self._times[i] for i in order]
+            values = {}
+            for key in keys:
+                slot = self._slots.get(key)
+                if slot is None:
+                    continue
+                start = slot * self.size
+                values[key] = (
+                    [self._inbound[start + i] for i in order],
+                    [self._outbound[start + i] for i in order]
+                )
+
+        buckets = _buckets(len(timestamps), points)
+        return (
+            [round(v) for v in _average(timestamps, buckets)],
+            {
+                key: (_rounded(_average(inbound, buckets)), _rounded(_average(outbound, buckets)))
+                for key, (inbound, outbound) in values.items()
+            }
+        )
+
+    def _order(self):
+        """Ring positions holding samples, oldest first"""
+        count = min(self._round, self.size)
+        start = (self._head - count) % self.size
+        return [(start + i) % self.size for i in range(count)]
+
+
+def _buckets(count, points):
+    """Split `count` samples into at most `points` contiguous (start, end) ranges"""
+    if not points or count <= points:
+        return [(i, i + 1) for i in range(count)]
+    return [(count * i // points, count * (i + 1) // points) for i in range(points)]
+
+
+def _average(values, buckets):
+    result = []
+    for start, end in buckets:
+        samples = [v for v in values[start:end] if not math.isnan(v)]
+        result.append(sum(samples) / len(samples) if samples else None)
+    return result
+
+
+def _rounded(values):
+    return [round(v, 3) if v is not None else None for v in values]
+
+
+def lttb(points, threshold):
+    """
+    Largest-Triangle-Three-Buckets downsampling of [(t, v), ...] to at most
+    `threshold` points. Keeps the first and last points and, per bucket, the
+    point forming the largest triangle with its neighbours, so peaks and dips
+    survive where averaging would flatten them.
+    """
+    count = len(points)
+    if threshold >= count:
+        return list(points)
+    if threshold < 3:
+        return [points[0], points[-1]][:threshold]
+
+    sampled = [points[0]]
+    bucket_size = (count - 2) / (threshold - 2)
+    a = 0
+
+    for i in range(threshold - 2):
+        # Average of the next bucket is the third corner of the triangle
+        next_start = int((i + 1) * bucket_size) + 1
+        next_end = max(min(int((i + 2) * bucket_size) + 1, count), next_start + 1)
+        next_bucket = points[next_start:next_end]
+        avg_t = sum(p[0] for p in next_bucket) / len(next_bucket)
+        avg_v = sum(p[1] for p in next_bucket) / len(next_bucket)
+
+        start = int(i * bucket_size) + 1
+        end = int((i + 1) * bucket_size) + 1
+        at, av = points[a]
+        best, best_area = start, -1.0
+        for j in range(start, end):
+            t, v = points[j]
+            area = abs((at - avg_t) * (v - av) - (at - t) * (avg_v - av))
+            if area > best_area:
+                best, best_area = j, area
+
+        sampled.append(points[best])
+        a = best
+
+    sampled.append(points[-1])
+    return sampled
+
+
+class RangeCache:
+    """Small LRU of downsampled range query results, keyed by (links, window, step, ...)"""
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+bandwidth_history = BandwidthHistory(
+    size=settings.METRICS_HISTORY_SIZE,
+    max_keys=settings.METRICS_HISTORY_MAX_LINKS
+)
+
+range_cache = RangeCache(max_entries=settings.HISTORY_RANGE_CACHE_SIZE)
@@ -0,0 +1,63 @@
+import base64
+import binascii
+import hashlib
+import io
+from urllib.parse import unquote_to_bytes
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow is optional, thumbnails fall back to the original
+    Image = None
+
+THUMBNAIL_MIN_SIZE = 16
+THUMBNAIL_MAX_SIZE = 512
+
+# Icons are served from NetMap's own origin, so only image types are stored
+ICON_CONTENT_TYPES = ('image/png', 'image/jpeg', 'image/gif', 'image/webp', 'image/svg+xml')
+
+
+def parse_data_url(data_url):
+    """
+    Split a 'data:<type>[;base64],<payload>' URL into (content_type, bytes).
+    Returns None if the value is not a data URL, raises ValueError if it is
+    not one of the ICON_CONTENT_TYPES or its base64 payload is malformed.
+    """
+    if not data_url or not data_url.startswith('data:') or ',' not in data_url:
+        return None
+
+    header, payload = data_url[5:].split(',', 1)
+    params = header.split(';')
+    content_type = params[0].strip().lower()
+    if content_type not in ICON_CONTENT_TYPES:
+        raise ValueError('Icons must be PNG, JPEG, GIF, WebP or SVG images')
+
+    if 'base64' not in params[1:]:
+        return content_type, unquote_to_bytes(payload)
+    try:
+        return content_type, base64.b64decode(''.join(payload.split()), validate=True)
+    except binascii.Error:
+        raise ValueError('Icon is not valid base64')
+
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def make_thumbnail(data, size):
+    """
+    Downscale raster icons to fit within size x size pixels, as PNG.
+    Returns None when Pillow is missing or the image cannot be scaled
+    (e.g. SVG), in which case the original should be served.
+    """
+    if Image is None:
+        return None
+    try:
+        image = Image.open(io.BytesIO(data))
+        if image.width <= size and image.height <= size:
+            return None
+        image.thumbnail((size, size))
+        output = io.BytesIO()
+        image.save(output, format='PNG')
+        return output.getvalue()
+    except Exception:
+        return None
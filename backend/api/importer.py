@@ -0,0 +1,412 @@
+import csv
+import io
+import ipaddress
+import json
+from django.db import transaction
+from django.utils import timezone
+from .models import Device, Link
+from .graph import graph_index
+
+FORMATS = ('json', 'csv')
+
+# Header names accepted for each field, after lowercasing and turning spaces
+# and dashes into underscores (NetBox CSV exports use 'Side A', 'IP Address')
+DEVICE_COLUMNS = {
+    'name': ('name', 'device', 'hostname'),
+    # NetBox's own device_type is the hardware model, so roles come first
+    'device_type': ('role', 'device_role', 'device_type'),
+    'ip_address': ('ip_address', 'primary_ip', 'primary_ip4', 'primary_ip6', 'ip'),
+    'prometheus_instance': ('prometheus_instance', 'instance'),
+    'site': ('site',),
+    'rack': ('rack',),
+}
+LINK_COLUMNS = {
+    'source_device': ('source_device', 'side_a', 'device_a', 'a_device'),
+    'source_interface': ('source_interface', 'termination_a', 'interface_a', 'a_interface'),
+    'target_device': ('target_device', 'side_b', 'device_b', 'b_device'),
+    'target_interface': ('target_interface', 'termination_b', 'interface_b', 'b_interface'),
+    'bandwidth_capacity': ('bandwidth_capacity', 'capacity', 'speed'),
+}
+
+# NetBox role names that do not contain one of our device types
+ROLE_ALIASES = {
+    'leaf': 'switch', 'spine': 'switch', 'access': 'switch', 'tor': 'switch',
+    'gateway': 'router', 'border': 'router', 'compute': 'hypervisor', 'host': 'server',
+    'transit': 'isp', 'upstream': 'isp', 'provider': 'isp',
+}
+
+# Labels naming the local port of an LLDP neighbour, in order of preference.
+# Configure an ifName lookup in the SNMP exporter so links match interface metrics.
+LLDP_LOCAL_PORT_LABELS = ('ifName', 'lldpLocPortId', 'lldpLocPortDesc', 'lldpRemLocalPortNum')
+LLDP_REMOTE_PORT_LABELS = ('lldpRemPortId', 'lldpRemPortDesc')
+
+# Placeholder for devices no source gave an address for
+UNKNOWN_IP = '0.0.0.0'
+
+NAME_LENGTH = Device._meta.get_field('name').max_length
+INTERFACE_LENGTH = Link._meta.get_field('source_interface').max_length
+
+
+def link_key(source, source_interface, target, target_interface):
+    """The same cable seen from either end (both sides report it over LLDP)"""
+    return tuple(sorted([(source, source_interface), (target, target_interface)]))
+
+
+def host_of(instance):
+    """'10.0.0.1:9116' -> '10.0.0.1'"""
+    host = instance.rsplit(':', 1)[0] if instance.count(':') == 1 else instance
+    return host.strip('[]')
+
+
+def parse_ip(value):
+    """An address from '10.0.0.1/24' style values, or None"""
+    if not value:
+        return None
+    try:
+        return str(ipaddress.ip_interface(str(value).strip()).ip)
+    except ValueError:
+        return None
+
+
+def device_type_of(role):
+    """Map a NetBox role ('Core Switch', 'edge-firewall') to a device type, or None"""
+    role = str(role or '').lower()
+    for device_type, _ in Device.DEVICE_TYPES:
+        if device_type in role:
+            return device_type
+    for alias, device_type in ROLE_ALIASES.items():
+        if alias in role:
+            return device_type
+    return None
+
+
+def label(value):
+    """Flatten nested NetBox API objects ({'name': ...}, {'address': ...}) to a string"""
+    if isinstance(value, dict):
+        for key in ('name', 'address', 'slug', 'display', 'value'):
+            if value.get(key) not in (None, ''):
+                return label(value[key])
+        return ''
+    if value is None:
+        return ''
+    return str(value).strip()
+
+
+def normalise_row(row):
+    """Lowercase headers and pull cable endpoints out of NetBox API objects"""
+    if not isinstance(row, dict):
+        raise ValueError(f'expected an object, got {type(row).__name__}')
+    row = {str(key).strip().lower().replace(' ', '_').replace('-', '_'): value for key, value in row.items()}
+    for side, end in (('a', 'source'), ('b', 'target')):
+        termination = row.get(f'{side}_terminations') or row.get(f'termination_{side}')
+        if isinstance(termination, list):
+            termination = termination[0] if termination else None
+        if isinstance(termination, dict):
+            termination = termination.get('object') or termination
+            row[f'{end}_device'] = label(termination.get('device'))
+            row[f'{end}_interface'] = label(termination.get('name'))
+    return row
+
+
+def pick(row, names):
+    for name in names:
+        value = label(row.get(name))
+        if value:
+            return value
+    return ''
+
+
+def read_rows(stream, format):
+    """
+    Yield rows from a NetBox style export: CSV, a JSON list, a NetBox API
+    page ({"results": [...]}) or JSON lines. CSV is read row by row.
+    """
+    if isinstance(stream, (bytes, str)):
+        stream = io.StringIO(stream.decode('utf-8-sig') if isinstance(stream, bytes) else stream)
+
+    if format == 'csv':
+        yield from csv.DictReader(stream)
+        return
+
+    text = stream.read().strip()
+    if not text:
+        return
+    try:
+        data = json.loads(text)
+    except json.JSONDecodeError:
+        # JSON lines, one object per line
+        data = [json.loads(line) for line in text.splitlines() if line.strip()]
+    if isinstance(data, dict):
+        data = data.get('results', [data])
+    if not isinstance(data, list) or not all(isinstance(row, dict) for row in data):
+        raise ValueError('Expected a list of objects')
+    yield from data
+
+
+class TopologyImport:
+    """
+    Devices and links collected from LLDP or NetBox exports, reconciled with
+    the existing Device and Link rows in memory and written with a handful
+    of chunked bulk operations.
+
+    Devices are matched by name and links by their two endpoints in either
+    direction. Imports only add and update, nothing is deleted; fields a
+    source leaves empty keep their current value.
+    """
+
+    def __init__(self, default_type='switch', default_capacity=1000, batch_size=1000):
+        self.default_type = default_type
+        self.default_capacity = default_capacity
+        self.batch_size = batch_size
+        self.devices = {}
+        self.links = {}
+        self.errors = []
+        self.rows = 0
+        self._existing = None
+        self._planned = None
+
+    @property
+    def existing(self):
+        """Current devices by name, loaded once"""
+        if self._existing is None:
+            self._existing = {device.name: device for device in Device.objects.all()}
+        return self._existing
+
+    def add_device(self, name, **fields):
+        if not name:
+            raise ValueError('device name is missing')
+        if len(name) > NAME_LENGTH:
+            raise ValueError(f'device name longer than {NAME_LENGTH} characters: {name}')
+        device = self.devices.setdefault(name, {})
+        device.update({field: value for field, value in fields.items() if value not in (None, '')})
+        self._planned = None
+
+    def add_link(self, source, source_interface, target, target_interface, capacity=None):
+        if not (source and source_interface and target and target_interface):
+            raise ValueError('link needs a device and interface on both ends')
+        if max(len(source_interface), len(target_interface)) > INTERFACE_LENGTH:
+            raise ValueError(f'interface name longer than {INTERFACE_LENGTH} characters')
+        if source == target:
+            raise ValueError(f'link from {source} to itself')
+        self.add_device(source)
+        self.add_device(target)
+        key = link_key(source, source_interface, target, target_interface)
+        link = self.links.setdefault(key, {
+            'source': source, 'source_interface': source_interface,
+            'target': target, 'target_interface': target_interface, 'capacity': None
+        })
+        if capacity:
+            link['capacity'] = max(link['capacity'] or 0, capacity)
+
+    def add_rows(self, rows):
+        """Add NetBox style rows (see read_rows), recording bad ones in errors"""
+        for row in rows:
+            self.rows += 1
+            try:
+                self.add_row(normalise_row(row))
+            except ValueError as e:
+                self.errors.append({'row': self.rows, 'error': str(e)})
+
+    def add_row(self, row):
+        """A cable if the row names two ends, a device otherwise"""
+        link = {field: pick(row, names) for field, names in LINK_COLUMNS.items()}
+        if link['source_device'] or link['target_device']:
+            try:
+                capacity = int(float(link['bandwidth_capacity'])) if link['bandwidth_capacity'] else None
+            except ValueError:
+                raise ValueError(f"capacity is not a number: {link['bandwidth_capacity']}")
+            self.add_link(
+                link['source_device'], link['source_interface'],
+                link['target_device'], link['target_interface'], capacity
+            )
+            return
+
+        device = {field: pick(row, names) for field, names in DEVICE_COLUMNS.items()}
+        ip_address = parse_ip(device['ip_address'])
+        if device['ip_address'] and ip_address is None:
+            raise ValueError(f"invalid IP address: {device['ip_address']}")
+        self.add_device(
+            device['name'],
+            device_type=device_type_of(device['device_type']),
+            ip_address=ip_address,
+            prometheus_instance=device['prometheus_instance'],
+            site=device['site'],
+            rack=device['rack']
+        )
+
+    def add_lldp(self, client):
+        """
+        Add the links of every LLDP neighbour table the SNMP exporter scrapes.
+        Local devices are found by their Prometheus instance, neighbours by
+        system name (or its first label, for 'sw1.example.net'); link
+        capacity comes from ifHighSpeed of the local port.
+        """
+        by_instance = {device.prometheus_instance: name for name, device in self.existing.items()
+                       if device.prometheus_instance}
+        by_instance.update({fields['prometheus_instance']: name for name, fields in self.devices.items()
+                            if fields.get('prometheus_instance')})
+
+        neighbours = []
+        for labels in client.get_lldp_neighbors():
+            self.rows += 1
+            instance = labels.get('instance', '')
+            local_port = pick(labels, LLDP_LOCAL_PORT_LABELS)
+            remote = labels.get('lldpRemSysName', '').strip()
+            remote_port = pick(labels, LLDP_REMOTE_PORT_LABELS)
+            if not (instance and local_port and remote and remote_port):
+                self.errors.append({'row': self.rows, 'error': f'incomplete LLDP entry on {instance or "?"}'})
+                continue
+            if instance not in by_instance:
+                by_instance[instance] = host_of(instance)
+                self.add_device(host_of(instance), prometheus_instance=instance, ip_address=parse_ip(host_of(instance)))
+            neighbours.append((self.rows, instance, local_port, remote, remote_port))
+
+        # Neighbours by system name, once every scraped device is known
+        short_names = {}
+        for name in set(self.existing) | set(self.devices):
+            short_names.setdefault(name.split('.')[0], set()).add(name)
+
+        def resolve(name):
+            if name in self.existing or name in self.devices:
+                return name
+            matches = short_names.get(name.split('.')[0], ())
+            return next(iter(matches)) if len(matches) == 1 else name
+
+        speeds = client.get_bulk_interface_speed({(row[1], row[2]) for row in neighbours})
+        for row, instance, local_port, remote, remote_port in neighbours:
+            try:
+                self.add_link(
+                    by_instance[instance], local_port, resolve(remote), remote_port,
+                    int(speeds.get((instance, local_port), 0))
+                )
+            except ValueError as e:
+                self.errors.append({'row': row, 'error': str(e)})
+
+    def plan(self):
+        """
+        Compare the collected topology with the database:
+        {'devices': {'create': [Device], 'update': [(Device, {field: (old, new)})]},
+         'links': {'create': [link dict], 'update': [(link id, link dict, old capacity)]}}
+        """
+        if self._planned is not None:
+            return self._planned
+
+        create_devices, update_devices = [], []
+        for name, fields in self.devices.items():
+            device = self.existing.get(name)
+            if device is None:
+                instance = fields.get('prometheus_instance', '')
+                create_devices.append(Device(
+                    name=name,
+                    device_type=fields.get('device_type') or self.default_type,
+                    ip_address=fields.get('ip_address') or UNKNOWN_IP,
+                    prometheus_instance=instance,
+                    is_monitored=bool(instance),
+                    site=fields.get('site', ''),
+                    rack=fields.get('rack', '')
+                ))
+                continue
+            changes = {
+                field: (getattr(device, field), value)
+                for field, value in fields.items()
+                if getattr(device, field) != value
+            }
+            if fields.get('prometheus_instance') and not device.is_monitored:
+                changes['is_monitored'] = (False, True)
+            if changes:
+                update_devices.append((device, changes))
+
+        names = {device.id: name for name, device in self.existing.items()}
+        existing_links = {}
+        for link_id, source, source_interface, target, target_interface, capacity in Link.objects.values_list(
+            'id', 'source_device_id', 'source_interface', 'target_device_id', 'target_interface', 'bandwidth_capacity'
+        ):
+            key = link_key(names[source], source_interface, names[target], target_interface)
+            existing_links[key] = (link_id, capacity)
+
+        create_links, update_links = [], []
+        for key, link in self.links.items():
+            current = existing_links.get(key)
+            if current is None:
+                create_links.append(dict(link, capacity=link['capacity'] or self.default_capacity))
+            elif link['capacity'] and link['capacity'] != current[1]:
+                update_links.append((current[0], link, current[1]))
+
+        self._planned = {
+            'devices': {'create': create_devices, 'update': update_devices},
+            'links': {'create': create_links, 'update': update_links},
+        }
+        return self._planned
+
+    def summary(self):
+        plan = self.plan()
+        return {
+            'rows': self.rows,
+            'devices': {
+                'create': len(plan['devices']['create']),
+                'update': len(plan['devices']['update']),
+                'unchanged': len(self.devices) - len(plan['devices']['create']) - len(plan['devices']['update'])
+            },
+            'links': {
+                'create': len(plan['links']['create']),
+                'update': len(plan['links']['update']),
+                'unchanged': len(self.links) - len(plan['links']['create']) - len(plan['links']['update'])
+            },
+            'errors': len(self.errors)
+        }
+
+    def diff(self):
+        """Readable lines for the planned changes, like a dry-run of apply()"""
+        plan = self.plan()
+        for device in plan['devices']['create']:
+            where = '/'.join(part for part in (device.site, device.rack) if part)
+            yield f"+ device {device.name} ({device.device_type}, {device.ip_address}{', ' + where if where else ''})"
+        for device, changes in plan['devices']['update']:
+            fields = ', '.join(f'{field} {old!r} -> {new!r}' for field, (old, new) in sorted(changes.items()))
+            yield f'~ device {device.name}: {fields}'
+        for link in plan['links']['create']:
+            yield (f"+ link {link['source']}:{link['source_interface']} <-> "
+                   f"{link['target']}:{link['target_interface']} ({link['capacity']} Mbps)")
+        for _, link, old in plan['links']['update']:
+            yield (f"~ link {link['source']}:{link['source_interface']} <-> "
+                   f"{link['target']}:{link['target_interface']}: capacity {old} -> {link['capacity']}")
+
+    def apply(self):
+        """Write the plan in one transaction; returns the ids of the new devices"""
+        plan = self.plan()
+        now = timezone.now()
+        with transaction.atomic():
+            Device.objects.bulk_create(plan['devices']['create'], batch_size=self.batch_size)
+
+            updated, fields = [], {'updated_at'}
+            for device, changes in plan['devices']['update']:
+                for field, (_, value) in changes.items():
+                    setattr(device, field, value)
+                    fields.add(field)
+                # bulk_update skips auto_now, so stamp updated_at ourselves
+                device.updated_at = now
+                updated.append(device)
+            if updated:
+                Device.objects.bulk_update(updated, sorted(fields), batch_size=self.batch_size)
+
+            # One query for the ids, whether or not the backend returns them from bulk_create
+            ids = dict(Device.objects.values_list('name', 'id'))
+            Link.objects.bulk_create([
+                Link(
+                    source_device_id=ids[link['source']],
+                    source_interface=link['source_interface'],
+                    target_device_id=ids[link['target']],
+                    target_interface=link['target_interface'],
+                    bandwidth_capacity=link['capacity']
+                )
+                for link in plan['links']['create']
+            ], batch_size=self.batch_size)
+            Link.objects.bulk_update([
+                Link(id=link_id, bandwidth_capacity=link['capacity'], updated_at=now)
+                for link_id, link, _ in plan['links']['update']
+            ], ['bandwidth_capacity', 'updated_at'], batch_size=self.batch_size)
+
+        graph_index.reload()
+        self._existing = None
+        self._planned = None
+        return {ids[device.name] for device in plan['devices']['create']}
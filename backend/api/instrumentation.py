@@ -0,0 +1,175 @@
+import threading
+import time
+from contextlib import contextmanager
+from django.db import connection
+
+# Latency buckets in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Metric:
+    """Base for NetMap's own metrics; values are kept per label set"""
+
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def _labels(self, key, extra=None):
+        pairs = list(zip(self.labelnames, key))
+        if extra:
+            pairs.append(extra)
+        if not pairs:
+            return ''
+        escaped = (
+            (name, value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"'))
+            for name, value in pairs
+        )
+        return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self._samples(key, value))
+        return lines
+
+    def _samples(self, key, value):
+        return [f'{self.name}{self._labels(key)} {_number(value)}']
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total, observations = self._values.get(key, ((0,) * len(self.buckets), 0.0, 0))
+            counts = tuple(count + 1 if value <= bound else count for bound, count in zip(self.buckets, counts))
+            self._values[key] = (counts, total + value, observations + 1)
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of the block in seconds"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _samples(self, key, value):
+        counts, total, observations = value
+        lines = [
+            f'{self.name}_bucket{self._labels(key, ("le", _number(bound)))} {count}'
+            for bound, count in zip(self.buckets, counts)
+        ]
+        lines.append(f'{self.name}_bucket{self._labels(key, ("le", "+Inf"))} {observations}')
+        lines.append(f'{self.name}_sum{self._labels(key)} {_number(total)}')
+        lines.append(f'{self.name}_count{self._labels(key)} {observations}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+def _number(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+@contextmanager
+def count_queries():
+    """Count ORM queries this thread runs inside the block, read as queries[0]"""
+    queries = [0]
+
+    def counter(execute, sql, params, many, context):
+        queries[0] += 1
+        return execute(sql, params, many, context)
+
+    with connection.execute_wrapper(counter):
+        yield queries
+
+
+registry = Registry()
+
+topology_build_seconds = registry.register(Histogram(
+    'netmap_topology_build_seconds', 'Time to build the topology payload', ['mode']
+))
+topology_build_queries = registry.register(Histogram(
+    'netmap_topology_build_queries', 'Database queries per topology build',
+    buckets=(0, 1, 2, 5, 10, 20, 50, 100, 500)
+))
+prometheus_query_seconds = registry.register(Histogram(
+    'netmap_prometheus_query_seconds', 'Time per Prometheus API query, including retries', ['endpoint']
+))
+prometheus_query_errors = registry.register(Counter(
+    'netmap_prometheus_query_errors_total', 'Prometheus API queries that failed', ['endpoint']
+))
+websocket_clients = registry.register(Gauge(
+    'netmap_websocket_clients', 'Connected WebSocket clients'
+))
+websocket_clients.set(0)
+websocket_held_patches = registry.register(Counter(
+    'netmap_websocket_held_patches_total', 'Patches merged into the mailbox of a slow WebSocket client'
+))
+websocket_resyncs = registry.register(Counter(
+    'netmap_websocket_resyncs_total', 'Slow WebSocket clients sent a fresh snapshot instead of their backlog'
+))
+broadcast_seconds = registry.register(Histogram(
+    'netmap_broadcast_seconds', 'Time to fan a message out to the WebSocket group', ['type']
+))
+payload_bytes = registry.register(Histogram(
+    'netmap_payload_bytes', 'Size of encoded topology payloads', ['type', 'encoding'],
+    buckets=(256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+))
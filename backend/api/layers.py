@@ -0,0 +1,233 @@
+import asyncio
+import base64
+import json
+import random
+import select
+import string
+import threading
+import time
+import uuid
+from datetime import timedelta
+from channels.db import database_sync_to_async
+from channels.exceptions import ChannelFull
+from channels.layers import InMemoryChannelLayer
+from django.conf import settings
+from django.db import connection, close_old_connections
+from django.db.models import Max, Q
+from django.utils import timezone
+from .models import ChannelMessage
+
+# PostgreSQL NOTIFY channel that wakes the other workers
+NOTIFY_CHANNEL = 'netmap_channel_layer'
+
+# Groups whose messages other workers need: topology notices and live
+# positions. Everything else (topology patches, metrics) every worker builds
+# for its own clients. Prefixes, so 'topology_positions' covers per-view groups.
+SHARED_GROUPS = ('topology_changes', 'topology_positions')
+
+# How long an id skipped by the cursor may take to show up: PostgreSQL hands
+# out sequence values at insert, so a later id can commit first
+LATE_COMMIT_GRACE = 10.0
+
+
+class DatabaseChannelLayer(InMemoryChannelLayer):
+    """
+    Channel layer that spans several worker processes through NetMap's own
+    database, for sites that cannot run Redis.
+
+    Delivery inside a process stays in memory. A group_send() to one of the
+    `shared_groups`, and every send() to a channel of another process, is also
+    written to ChannelMessage; each process picks up the other processes' rows
+    and delivers them to its own channels. On PostgreSQL workers are woken by
+    LISTEN/NOTIFY, elsewhere (SQLite, switched to WAL mode) the table is polled
+    every poll_interval. Ids the cursor skipped are looked up again for
+    LATE_COMMIT_GRACE seconds, in case they were still being committed.
+    Rows older than `expiry` seconds are deleted.
+    """
+
+    def __init__(self, poll_interval=None, shared_groups=SHARED_GROUPS, **kwargs):
+        super().__init__(**kwargs)
+        self.poll_interval = poll_interval if poll_interval is not None else settings.CHANNEL_LAYER_POLL_INTERVAL
+        self.shared_groups = tuple(shared_groups)
+        self.process_id = uuid.uuid4().hex[:12]
+        self._loop = None
+        self._thread = None
+        self._stop = threading.Event()
+        self._ready = threading.Event()
+        self._own_lock = threading.Lock()
+        self._own_ids = set()
+
+    async def new_channel(self, prefix='specific'):
+        """Channel names carry the process id so other workers can route to them"""
+        suffix = ''.join(random.choice(string.ascii_letters) for _ in range(12))
+        return f'{prefix}.{self.process_id}!{suffix}'
+
+    def is_local(self, channel):
+        if '!' not in channel:
+            return True
+        return channel.split('!', 1)[0].endswith(f'.{self.process_id}')
+
+    async def send(self, channel, message):
+        if self.is_local(channel):
+            await super().send(channel, message)
+        else:
+            self.require_valid_channel_name(channel)
+            await self._publish(message, channel=channel)
+
+    def is_shared(self, group):
+        return group.startswith(self.shared_groups)
+
+    async def receive(self, channel):
+        await self._start()
+        return await super().receive(channel)
+
+    async def group_add(self, group, channel):
+        await self._start()
+        await super().group_add(group, channel)
+
+    async def group_send(self, group, message):
+        await super().group_send(group, message)
+        if self.is_shared(group):
+            await self._publish(message, group=group)
+
+    async def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            await asyncio.get_running_loop().run_in_executor(None, self._thread.join, 5)
+
+    async def _publish(self, message, group='', channel=''):
+        await database_sync_to_async(self._insert)(encode_message(message), group, channel)
+
+    def _insert(self, payload, group, channel):
+        row = ChannelMessage.objects.create(origin=self.process_id, group=group, channel=channel, payload=payload)
+        with self._own_lock:
+            # Not a gap for our listener, which skips our own rows
+            self._own_ids.add(row.id)
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT pg_notify(%s, %s)', [NOTIFY_CHANNEL, self.process_id])
+
+    async def _start(self):
+        """Start picking up other workers' messages on the running loop (idempotent)"""
+        if self._thread is not None and self._thread.is_alive():
+            if not self._ready.is_set():
+                await self._loop.run_in_executor(None, self._ready.wait, 5)
+            return
+        self._loop = asyncio.get_running_loop()
+        self._stop.clear()
+        self._ready.clear()
+        self._thread = threading.Thread(target=self._listen, name='netmap-channel-layer', daemon=True)
+        self._thread.start()
+        # Messages sent after group_add() returns must not be missed
+        await self._loop.run_in_executor(None, self._ready.wait, 5)
+
+    def _listen(self):
+        try:
+            cursor = ChannelMessage.objects.aggregate(last=Max('id'))['last'] or 0
+            wait = self._listener()
+        except Exception as e:
+            print(f"Channel layer listener failed to start: {e}")
+            cursor, wait = 0, self._stop.wait
+        finally:
+            self._ready.set()
+
+        last_cleanup = time.monotonic()
+        # Skipped ids not yet seen: {id: when first skipped}
+        gaps = {}
+        while not self._stop.is_set() and not self._loop.is_closed():
+            try:
+                wait(self.poll_interval)
+                rows = list(
+                    ChannelMessage.objects.filter(Q(id__gt=cursor) | Q(id__in=list(gaps)))
+                    .exclude(origin=self.process_id).order_by('id')
+                )
+                if rows:
+                    cursor = self._advance(cursor, rows, gaps)
+                    asyncio.run_coroutine_threadsafe(self._deliver(rows), self._loop)
+                now = time.monotonic()
+                for row_id in [row_id for row_id, since in gaps.items() if now - since > LATE_COMMIT_GRACE]:
+                    del gaps[row_id]
+
+                if time.monotonic() - last_cleanup > self.expiry:
+                    last_cleanup = time.monotonic()
+                    ChannelMessage.objects.filter(
+                        created_at__lt=timezone.now() - timedelta(seconds=self.expiry)
+                    ).delete()
+            except Exception as e:
+                print(f"Channel layer listener error: {e}")
+                close_old_connections()
+                self._stop.wait(1)
+        connection.close()
+
+    def _advance(self, cursor, rows, gaps):
+        """Move the cursor past `rows`, noting the ids in between that were not among them"""
+        seen = {row.id for row in rows}
+        last = max(cursor, rows[-1].id)
+        with self._own_lock:
+            own = {row_id for row_id in self._own_ids if row_id <= last}
+            self._own_ids -= own
+        now = time.monotonic()
+        for row_id in seen:
+            gaps.pop(row_id, None)
+        for row_id in range(cursor + 1, last):
+            if row_id not in seen and row_id not in own:
+                gaps[row_id] = now
+        return last
+
+    def _listener(self):
+        """
+        Return a wait(timeout) callable: LISTEN/NOTIFY on PostgreSQL (with
+        psycopg2), otherwise a plain sleep between polls.
+        """
+        connection.ensure_connection()
+        if connection.vendor == 'sqlite':
+            # Readers no longer block the writing worker and vice versa
+            with connection.cursor() as cursor:
+                cursor.execute('PRAGMA journal_mode=WAL')
+            return self._stop.wait
+
+        raw = connection.connection
+        if connection.vendor != 'postgresql' or not hasattr(raw, 'poll'):
+            return self._stop.wait
+
+        with connection.cursor() as cursor:
+            cursor.execute(f'LISTEN {NOTIFY_CHANNEL}')
+
+        def wait(timeout):
+            # Poll anyway now and then in case a notification was lost
+            if select.select([raw], [], [], max(timeout, 1.0)) != ([], [], []):
+                raw.poll()
+                raw.notifies.clear()
+        return wait
+
+    async def _deliver(self, rows):
+        for row in rows:
+            message = decode_message(row.payload)
+            if row.group:
+                await InMemoryChannelLayer.group_send(self, row.group, message)
+            else:
+                try:
+                    await InMemoryChannelLayer.send(self, row.channel, message)
+                except ChannelFull:
+                    pass
+
+
+def encode_message(message):
+    """JSON for channel messages, with bytes (binary frames) as base64"""
+    return json.dumps(message, default=_encode_bytes)
+
+
+def decode_message(payload):
+    return json.loads(payload, object_hook=_decode_bytes)
+
+
+def _encode_bytes(value):
+    if isinstance(value, bytes):
+        return {'__bytes__': base64.b64encode(value).decode()}
+    raise TypeError(f'Cannot send {type(value).__name__} over the channel layer')
+
+
+def _decode_bytes(value):
+    if len(value) == 1 and '__bytes__' in value:
+        return base64.b64decode(value['__bytes__'])
+    return value
@@ -0,0 +1,193 @@
+import math
+
+try:
+    import numpy as np
+except ImportError:  # Server-side layout is optional
+    np = None
+
+ALGORITHMS = ('force', 'layered')
+
+# Device types from the network edge inwards, one row each in layered layouts
+TIERS = {'isp': 0, 'firewall': 1, 'router': 2, 'switch': 3, 'hypervisor': 4, 'server': 5}
+
+
+def available():
+    return np is not None
+
+
+def compute_layout(nodes, edges, movable, algorithm='force', spacing=150, iterations=None, seed=0):
+    """
+    Place the `movable` nodes around the others, which stay pinned.
+
+    nodes: [(id, x, y, device_type), ...]; edges: [(source_id, target_id), ...]
+    Returns {id: (x, y)} for the movable nodes. Requires numpy.
+    """
+    if np is None:
+        raise RuntimeError('Server-side layout needs numpy: pip install numpy')
+    if algorithm not in ALGORITHMS:
+        raise ValueError(f"algorithm must be one of {', '.join(ALGORITHMS)}")
+
+    index = {node[0]: i for i, node in enumerate(nodes)}
+    pos = np.array([(node[1], node[2]) for node in nodes], dtype=float).reshape(-1, 2)
+    pinned = np.array([node[0] not in movable for node in nodes], dtype=bool)
+    pairs = [(index[s], index[t]) for s, t in edges if s in index and t in index and s != t]
+    src = np.array([s for s, _ in pairs], dtype=int)
+    dst = np.array([t for _, t in pairs], dtype=int)
+    rng = np.random.default_rng(seed)
+
+    if algorithm == 'layered':
+        tiers = np.array([TIERS.get(node[3], 3) for node in nodes], dtype=int)
+        pos = layered_layout(pos, pinned, src, dst, tiers, spacing)
+    else:
+        pos = force_layout(pos, pinned, src, dst, spacing, iterations, rng)
+
+    return {
+        nodes[i][0]: (int(round(pos[i, 0])), int(round(pos[i, 1])))
+        for i in np.flatnonzero(~pinned)
+    }
+
+
+def neighbour_mean(pos, placed, src, dst):
+    """Mean position of each node's placed neighbours, and how many there are"""
+    n = len(pos)
+    ends = np.concatenate([src, dst])
+    others = np.concatenate([dst, src])
+    mask = placed[others]
+    ends, others = ends[mask], others[mask]
+    sums = np.stack([
+        np.bincount(ends, weights=pos[others, 0], minlength=n),
+        np.bincount(ends, weights=pos[others, 1], minlength=n)
+    ], axis=1)
+    counts = np.bincount(ends, minlength=n).astype(float)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return sums / counts[:, None], counts
+
+
+def initial_positions(pos, pinned, src, dst, spacing, rng):
+    """
+    Start free nodes next to their placed neighbours, spreading outwards from
+    the pinned ones; nodes in components without any go to a square beside them.
+    """
+    pos = pos.copy()
+    placed = pinned.copy()
+    while True:
+        mean, counts = neighbour_mean(pos, placed, src, dst)
+        frontier = ~placed & (counts > 0)
+        if not frontier.any():
+            break
+        jitter = rng.uniform(-spacing, spacing, (int(frontier.sum()), 2))
+        pos[frontier] = mean[frontier] + jitter
+        placed |= frontier
+
+    rest = np.flatnonzero(~placed)
+    if len(rest):
+        side = math.sqrt(len(rest)) * spacing
+        origin = np.zeros(2)
+        if placed.any():
+            # Right of whatever is already on the map
+            origin = np.array([pos[placed, 0].max() + 2 * spacing, pos[placed, 1].min()])
+        pos[rest] = origin + rng.uniform(0, side, (len(rest), 2))
+    return pos
+
+
+def nearby_pairs(pos, rows, cell):
+    """
+    (row, node) index pairs of each node in `rows` with every node in its own
+    and the 8 surrounding grid cells, found by sorting nodes by cell.
+    """
+    cells = np.floor(pos / cell).astype(np.int64)
+    keys = cells[:, 0] * 2 ** 32 + cells[:, 1]
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+    pairs_rows, pairs_cols = [], []
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            wanted = (cells[rows, 0] + dx) * 2 ** 32 + cells[rows, 1] + dy
+            low = np.searchsorted(sorted_keys, wanted, 'left')
+            counts = np.searchsorted(sorted_keys, wanted, 'right') - low
+            total = int(counts.sum())
+            if not total:
+                continue
+            # Expand each [low, low + count) range into individual indices
+            offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+            pairs_rows.append(np.repeat(np.arange(len(rows)), counts))
+            pairs_cols.append(order[np.repeat(low, counts) + offsets])
+    if not pairs_rows:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+    return np.concatenate(pairs_rows), np.concatenate(pairs_cols)
+
+
+def force_layout(pos, pinned, src, dst, spacing, iterations, rng):
+    """
+    Fruchterman-Reingold with `spacing` as the ideal edge length and the
+    paper's grid variant: nodes only repel others within two spacings, so
+    each round costs about linear time. Only free nodes move.
+    """
+    free = np.flatnonzero(~pinned)
+    if not len(free):
+        return pos
+    n = len(pos)
+    pos = initial_positions(pos, pinned, src, dst, spacing, rng)
+    if iterations is None:
+        iterations = 100
+
+    k2 = float(spacing) ** 2
+    cutoff = 2.0 * spacing
+    temperature = spacing * max(1.0, math.sqrt(len(free)) / 2)
+    cooling = (1.0 / temperature) ** (1.0 / max(1, iterations))
+
+    for _ in range(iterations):
+        rows, cols = nearby_pairs(pos, free, cutoff)
+        delta = pos[free[rows]] - pos[cols]
+        dist2 = (delta ** 2).sum(axis=1)
+        close = (dist2 < cutoff ** 2) & (free[rows] != cols)
+        rows, delta = rows[close], delta[close]
+        # Coincident nodes push apart in a random direction
+        delta[dist2[close] == 0] = rng.uniform(-1, 1, (int((dist2[close] == 0).sum()), 2))
+        push = delta * (k2 / np.maximum((delta ** 2).sum(axis=1), 1.0))[:, None]
+        disp = np.stack([
+            np.bincount(rows, weights=push[:, 0], minlength=len(free)),
+            np.bincount(rows, weights=push[:, 1], minlength=len(free))
+        ], axis=1)
+
+        if len(src):
+            delta = pos[src] - pos[dst]
+            pull = delta * (np.sqrt((delta ** 2).sum(axis=1)) / spacing)[:, None]
+            ends = np.concatenate([src, dst])
+            pulls = np.concatenate([-pull, pull])
+            disp[:, 0] += np.bincount(ends, weights=pulls[:, 0], minlength=n)[free]
+            disp[:, 1] += np.bincount(ends, weights=pulls[:, 1], minlength=n)[free]
+
+        length = np.maximum(np.sqrt((disp ** 2).sum(axis=1)), 1e-9)
+        pos[free] += disp * (np.minimum(length, temperature) / length)[:, None]
+        temperature *= cooling
+    return pos
+
+
+def layered_layout(pos, pinned, src, dst, tiers, spacing, sweeps=4):
+    """
+    One row per device tier (ISP edge at the top, servers at the bottom),
+    ordered within rows by the barycenter of their neighbours to reduce
+    crossings. New rows go below what is already on the map.
+    """
+    free = ~pinned
+    if not free.any():
+        return pos
+    pos = pos.copy()
+    used = np.unique(tiers[free])
+    row = np.searchsorted(used, tiers)
+
+    top = pos[pinned, 1].max() + 2 * spacing if pinned.any() else 0.0
+    centre = pos[pinned, 0].mean() if pinned.any() else 0.0
+    pos[free, 1] = top + row[free] * spacing
+    # Start from the input order, then let neighbours pull nodes sideways
+    order = np.arange(len(pos), dtype=float)
+
+    for _ in range(sweeps + 1):
+        for r in range(len(used)):
+            members = np.flatnonzero(free & (row == r))
+            ranked = members[np.argsort(order[members], kind='stable')]
+            pos[ranked, 0] = centre + (np.arange(len(ranked)) - (len(ranked) - 1) / 2) * spacing
+        mean, counts = neighbour_mean(pos, np.ones(len(pos), dtype=bool), src, dst)
+        order = np.where(counts > 0, mean[:, 0], pos[:, 0])
+    return pos
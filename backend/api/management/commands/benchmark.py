@@ -0,0 +1,251 @@
+import asyncio
+import json
+import platform
+import statistics
+import time
+import django
+from datetime import datetime
+from channels.testing import WebsocketCommunicator
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import setup_test_environment, teardown_test_environment
+from api import views
+from api.cache import topology_cache
+from api.collector import MetricsCollector
+from api.consumers import TopologyConsumer
+from api.graph import graph_index
+from api.models import Device
+from api.prometheus_client import PrometheusClient
+from api.async_prometheus_client import AsyncPrometheusClient
+from api.synthetic import generate_topology, StubPrometheus
+
+
+def summarize(durations):
+    """Timing statistics in milliseconds"""
+    ordered = sorted(durations)
+    return {
+        'runs': len(ordered),
+        'min': round(ordered[0] * 1000, 3),
+        'mean': round(statistics.fmean(ordered) * 1000, 3),
+        'median': round(statistics.median(ordered) * 1000, 3),
+        'p95': round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000, 3),
+        'max': round(ordered[-1] * 1000, 3),
+    }
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark topology building, the HTTP API and WebSocket fan-out against '
+        'synthetic topologies and a local stub Prometheus. Runs in a throwaway '
+        'test database and writes JSON results for comparison between releases.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--links', default='100,10000',
+                            help='Comma separated topology sizes in links (default: 100,10000)')
+        parser.add_argument('--repeat', type=int, default=5, help='Runs per measurement (default: 5)')
+        parser.add_argument('--latency', type=float, default=0.01,
+                            help='Stub Prometheus latency per query in seconds (default: 0.01)')
+        parser.add_argument('--clients', type=int, default=50,
+                            help='WebSocket clients for the fan-out measurement (default: 50)')
+        parser.add_argument('--bulk-size', type=int, default=500,
+                            help='Objects per bulk API request (default: 500)')
+        parser.add_argument('--output', help='Write JSON results to this file')
+
+    def handle(self, *args, **options):
+        try:
+            sizes = [int(size) for size in options['links'].split(',') if size]
+        except ValueError:
+            raise CommandError('--links must be a comma separated list of integers')
+        if options['repeat'] < 1:
+            raise CommandError('--repeat must be at least 1')
+
+        # Like the test runner: no query logging, and a database we can throw away
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        original_collector = views.collector
+        results = []
+        try:
+            for links in sizes:
+                self.stdout.write(f'Benchmarking {links} links...')
+                results.append(self.run_size(links, options))
+        finally:
+            views.collector = original_collector
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        report = {
+            'started_at': datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'options': {key: options[key] for key in ('links', 'repeat', 'latency', 'clients', 'bulk_size')},
+            'results': results,
+        }
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=2)
+            self.stdout.write(self.style.SUCCESS(f"Results written to {options['output']}"))
+        else:
+            self.stdout.write(json.dumps(report, indent=2))
+
+    def run_size(self, links, options):
+        Device.objects.all().delete()
+        started = time.perf_counter()
+        pairs = generate_topology(links)
+        generate_seconds = time.perf_counter() - started
+        repeat = options['repeat']
+
+        with StubPrometheus(pairs, latency=options['latency']) as prometheus:
+            # A collector of our own that only refreshes when told to
+            collector = MetricsCollector(
+                PrometheusClient(prometheus.url),
+                interval=3600,
+                async_client=AsyncPrometheusClient(prometheus.url)
+            )
+            views.collector = collector
+
+            timings = {
+                'collector_refresh': self.measure(collector.refresh, repeat),
+                'collector_arefresh': self.ameasure(collector.arefresh, repeat),
+            }
+            requests_per_refresh = prometheus.requests // (2 * repeat)
+
+            timings['get_topology_data_cold'] = self.measure(
+                views.get_topology_data, repeat, setup=topology_cache.invalidate
+            )
+            timings['get_topology_data_warm'] = self.measure(views.get_topology_data, repeat)
+
+            client = Client()
+            timings['http_topology'] = self.measure(lambda: client.get('/api/topology/'), repeat)
+            etag = client.get('/api/topology/')['ETag']
+            timings['http_topology_not_modified'] = self.measure(
+                lambda: client.get('/api/topology/', HTTP_IF_NONE_MATCH=etag), repeat
+            )
+            timings.update(self.measure_bulk(client, options['bulk_size'], repeat))
+            timings.update(self.measure_graph(repeat))
+            timings['websocket_fanout'] = self.run_async(self.measure_fanout(options['clients'], repeat))
+
+        return {
+            'links': links,
+            'devices': Device.objects.count(),
+            'monitored_interfaces': len(pairs),
+            'prometheus_requests_per_refresh': requests_per_refresh,
+            'generate_seconds': round(generate_seconds, 3),
+            'timings_ms': timings,
+        }
+
+    def measure(self, func, repeat, setup=None):
+        durations = []
+        for _ in range(repeat):
+            if setup:
+                setup()
+            started = time.perf_counter()
+            func()
+            durations.append(time.perf_counter() - started)
+        return summarize(durations)
+
+    def ameasure(self, coroutine_func, repeat):
+        async def run():
+            durations = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                await coroutine_func()
+                durations.append(time.perf_counter() - started)
+            return summarize(durations)
+        return self.run_async(run())
+
+    def run_async(self, coroutine):
+        return asyncio.run(coroutine)
+
+    def wait_for_broadcasts(self):
+        """Let the debounced broadcast after a write finish outside the timed requests"""
+        while not views.broadcast_scheduler.idle:
+            time.sleep(0.01)
+
+    def measure_bulk(self, client, size, repeat):
+        """Time bulk create, update, position and delete requests of `size` devices"""
+        durations = {'bulk_create_devices': [], 'bulk_update_devices': [],
+                     'bulk_update_positions': [], 'bulk_delete_devices': []}
+
+        for run in range(repeat):
+            items = [
+                {'name': f'bulk-{run}-{i}', 'device_type': 'server', 'ip_address': f'192.168.{i // 256 % 256}.{i % 256}'}
+                for i in range(size)
+            ]
+            started = time.perf_counter()
+            response = client.post('/api/devices/bulk/', items, content_type='application/json')
+            durations['bulk_create_devices'].append(time.perf_counter() - started)
+            self.wait_for_broadcasts()
+            if response.status_code != 201:
+                raise CommandError(f'Bulk create failed: {response.content[:200]}')
+            ids = [device['id'] for device in response.json()]
+
+            started = time.perf_counter()
+            client.put('/api/devices/bulk/', [{'id': i, 'is_monitored': False} for i in ids],
+                       content_type='application/json')
+            durations['bulk_update_devices'].append(time.perf_counter() - started)
+            self.wait_for_broadcasts()
+
+            started = time.perf_counter()
+            client.post('/api/devices/positions/', [{'id': i, 'x': i, 'y': run} for i in ids],
+                        content_type='application/json')
+            durations['bulk_update_positions'].append(time.perf_counter() - started)
+            self.wait_for_broadcasts()
+
+            started = time.perf_counter()
+            client.delete('/api/devices/bulk/', ids, content_type='application/json')
+            durations['bulk_delete_devices'].append(time.perf_counter() - started)
+            self.wait_for_broadcasts()
+
+        return {name: summarize(values) for name, values in durations.items()}
+
+    def measure_graph(self, repeat):
+        """Time loading the graph index and each /api/graph/ query across the whole topology"""
+        ids = list(Device.objects.order_by('id').values_list('id', flat=True))
+        # Devices far apart in the generated topology
+        source, target, middle = ids[0], ids[len(ids) // 2], ids[len(ids) // 3]
+
+        def load():
+            graph_index.reload()
+            graph_index.stats()
+
+        timings = {'graph_load': self.measure(load, repeat)}
+        timings['graph_path'] = self.measure(lambda: graph_index.shortest_path(source, target), repeat)
+        costs = views.utilization_costs()
+        timings['graph_path_utilization'] = self.measure(
+            lambda: graph_index.shortest_path(source, target, costs), repeat
+        )
+        timings['graph_reachable'] = self.measure(lambda: graph_index.reachable([source]), repeat)
+        timings['graph_impact'] = self.measure(lambda: graph_index.impact([middle], roots=[source]), repeat)
+        # Cold: the result is cached until the graph changes
+        timings['graph_articulation'] = self.measure(graph_index.articulation_points, repeat, setup=load)
+        return timings
+
+    async def measure_fanout(self, clients, repeat):
+        """Time from publishing a topology change until every client has received it"""
+        self.wait_for_broadcasts()
+        communicators = [WebsocketCommunicator(TopologyConsumer.as_asgi(), '/ws/topology/') for _ in range(clients)]
+        for communicator in communicators:
+            connected, _ = await communicator.connect(timeout=30)
+            if not connected:
+                raise CommandError('WebSocket client could not connect')
+            await communicator.receive_output(timeout=30)
+
+        device = await Device.objects.afirst()
+        durations = []
+        try:
+            for run in range(repeat):
+                # Move one device so the next build produces a small patch
+                await Device.objects.filter(id=device.id).aupdate(position_x=run + 1)
+                topology_cache.invalidate()
+
+                started = time.perf_counter()
+                await views.apublish_topology(await views.aget_topology_data())
+                await asyncio.gather(*(c.receive_output(timeout=30) for c in communicators))
+                durations.append(time.perf_counter() - started)
+        finally:
+            for communicator in communicators:
+                await communicator.disconnect()
+        return summarize(durations)
@@ -0,0 +1,88 @@
+import csv
+import sys
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.db import IntegrityError
+from api import importer, layout, views
+from api.collector import collector
+from api.models import Device
+from api.notices import topology_notices
+from api.prometheus_client import PrometheusUnavailable
+
+
+class Command(BaseCommand):
+    help = (
+        'Import devices and links from LLDP neighbour tables in Prometheus (source "lldp") '
+        'or NetBox style JSON/CSV exports (file paths, "-" for stdin). Rows are matched '
+        'against existing devices by name and links by their endpoints, then written '
+        'with chunked bulk operations. Nothing is deleted.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('sources', nargs='+', help='"lldp" and/or export files')
+        parser.add_argument('--format', choices=importer.FORMATS,
+                            help='Format of the export files (default: from the file extension)')
+        parser.add_argument('--dry-run', action='store_true', help='Print the changes without writing them')
+        parser.add_argument('--layout', choices=layout.ALGORITHMS,
+                            help='Place the new devices with this server-side layout (requires numpy)')
+        parser.add_argument('--default-type', default='switch', choices=dict(Device.DEVICE_TYPES),
+                            help='Device type for rows without a recognisable role (default: switch)')
+        parser.add_argument('--default-capacity', type=int, default=1000,
+                            help='Capacity in Mbps for links without one (default: 1000)')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Rows per bulk query (default: 1000)')
+        parser.add_argument('--quiet', action='store_true', help='Only print the summary')
+
+    def handle(self, *args, **options):
+        if options['layout'] and not layout.available():
+            raise CommandError('--layout needs numpy: pip install numpy')
+
+        started = time.perf_counter()
+        topology = importer.TopologyImport(
+            default_type=options['default_type'],
+            default_capacity=options['default_capacity'],
+            batch_size=options['batch_size']
+        )
+        for source in options['sources']:
+            if source == 'lldp':
+                try:
+                    topology.add_lldp(collector.client)
+                except PrometheusUnavailable as e:
+                    raise CommandError(f'Prometheus unavailable: {e}')
+                continue
+            format = options['format'] or ('csv' if source.endswith('.csv') else 'json')
+            try:
+                if source == '-':
+                    topology.add_rows(importer.read_rows(sys.stdin, format))
+                else:
+                    with open(source, newline='', encoding='utf-8-sig') as f:
+                        topology.add_rows(importer.read_rows(f, format))
+            except (OSError, ValueError, csv.Error) as e:
+                raise CommandError(f'Could not read {source}: {e}')
+
+        if not options['quiet']:
+            for line in topology.diff():
+                self.stdout.write(line)
+        for error in topology.errors:
+            self.stderr.write(f"Row {error['row']}: {error['error']}")
+        summary = topology.summary()
+        self.stdout.write(
+            f"{summary['rows']} rows: devices +{summary['devices']['create']} ~{summary['devices']['update']} "
+            f"={summary['devices']['unchanged']}, links +{summary['links']['create']} "
+            f"~{summary['links']['update']} ={summary['links']['unchanged']}, {summary['errors']} errors "
+            f"({time.perf_counter() - started:.2f}s)"
+        )
+        if options['dry_run']:
+            self.stdout.write('Dry run, nothing written')
+            return
+
+        try:
+            created = topology.apply()
+        except IntegrityError as e:
+            raise CommandError(f'Import failed: {e}')
+        if created and options['layout']:
+            placed = views.place_devices(Device.objects.in_bulk(), created, options['layout'])
+            self.stdout.write(f'Placed {placed} new devices')
+        # Reaches running servers through a shared channel layer (Redis or database)
+        topology_notices.changed()
+        views.broadcast_topology_update()
+        self.stdout.write(self.style.SUCCESS(f'Imported in {time.perf_counter() - started:.2f}s'))
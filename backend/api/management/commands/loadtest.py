@@ -0,0 +1,284 @@
+import asyncio
+import json
+import os
+import resource
+import socket
+import subprocess
+import sys
+import time
+import requests
+from datetime import datetime
+from django.core.management.base import BaseCommand, CommandError
+
+try:
+    import websockets
+except ImportError:  # Only needed for load testing
+    websockets = None
+
+# Names of the devices this harness creates and removes again
+PREFIX = 'loadtest'
+# Link capacity changes carry the sequence number on top of this
+BASE_CAPACITY = 1000000
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def rss_mb(pid):
+    """Resident memory of a local process in MB (Linux), or None"""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return None
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class LoadClient:
+    """One WebSocket client recording which mutations reached it, and when"""
+
+    def __init__(self, link_id):
+        self.link_id = link_id
+        self.received = {}
+        self.duplicates = 0
+        self.gaps = 0
+        self.revision = None
+        self.connected = False
+
+    def handle(self, message):
+        if message['type'] == 'topology_update':
+            self.revision = message['revision']
+            return
+        if message['type'] != 'topology_patch':
+            return
+        if self.revision is not None and message['base'] != self.revision:
+            self.gaps += 1
+        self.revision = message['revision']
+
+        now = time.perf_counter()
+        for op in message['ops']:
+            sequence = self.sequence(op)
+            if sequence is None:
+                continue
+            if sequence in self.received:
+                self.duplicates += 1
+            else:
+                self.received[sequence] = now
+
+    def sequence(self, op):
+        """Sequence number of a harness mutation carried by a patch op, if any"""
+        if op['op'] == 'node_changed' and op['node']['label'].startswith(f'{PREFIX}-seq-'):
+            return int(op['node']['label'].rsplit('-', 1)[1])
+        if op['op'] == 'edge_changed' and op['edge']['id'] == self.link_id:
+            return op['edge']['bandwidth']['capacity'] - BASE_CAPACITY or None
+        return None
+
+
+class Command(BaseCommand):
+    help = (
+        'Open many concurrent ws/topology/ clients against a Daphne server, mutate '
+        'devices and links over the API and report end-to-end propagation latency, '
+        'dropped and duplicate messages and server memory. Requires `pip install websockets`.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=500, help='Concurrent WebSocket clients (default: 500)')
+        parser.add_argument('--mutations', type=int, default=20, help='Device/link changes to make (default: 20)')
+        parser.add_argument('--interval', type=float, default=1.0,
+                            help='Seconds between mutations, above BROADCAST_DEBOUNCE so none are merged (default: 1.0)')
+        parser.add_argument('--ramp', type=int, default=100, help='Clients connecting at once (default: 100)')
+        parser.add_argument('--url', help='Base URL of a running server (default: start Daphne locally)')
+        parser.add_argument('--server-pid', type=int, help='PID of the --url server, to sample its memory')
+        parser.add_argument('--timeout', type=float, default=10.0,
+                            help='Seconds to wait for the last mutation to arrive (default: 10)')
+        parser.add_argument('--output', help='Write JSON results to this file')
+
+    def handle(self, *args, **options):
+        if websockets is None:
+            raise CommandError('The load test needs the websockets package: pip install websockets')
+
+        # Every client is a socket, make sure we may open enough of them
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        wanted = options['clients'] + 256
+        if soft < wanted:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (min(wanted, hard), hard))
+
+        server = None
+        url = options['url']
+        pid = options['server_pid']
+        if url is None:
+            port = free_port()
+            server = subprocess.Popen(
+                [sys.executable, '-m', 'daphne', '-b', '127.0.0.1', '-p', str(port), 'netmap.asgi:application'],
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=os.environ.copy()
+            )
+            url = f'http://127.0.0.1:{port}'
+            pid = server.pid
+
+        try:
+            self.wait_for_server(url)
+            report = asyncio.run(self.run(url.rstrip('/'), pid, options))
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait(timeout=10)
+
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+            self.stdout.write(self.style.SUCCESS(f"Results written to {options['output']}"))
+        else:
+            self.stdout.write(output)
+
+    def wait_for_server(self, url, timeout=30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                requests.get(f'{url}/api/devices/', timeout=2)
+                return
+            except requests.RequestException:
+                time.sleep(0.2)
+        raise CommandError(f'Server at {url} did not come up')
+
+    async def run(self, url, pid, options):
+        session = requests.Session()
+        api = f'{url}/api'
+        ws_url = url.replace('http', 'ws', 1) + '/ws/topology/'
+        source, target, link = await asyncio.to_thread(self.create_fixtures, session, api)
+        clients = [LoadClient(link) for _ in range(options['clients'])]
+        tasks = []
+        sent = {}
+
+        try:
+            rss_start = rss_mb(pid)
+            started = time.perf_counter()
+            for batch in range(0, len(clients), options['ramp']):
+                ready = []
+                for client in clients[batch:batch + options['ramp']]:
+                    event = asyncio.Event()
+                    ready.append(event)
+                    tasks.append(asyncio.create_task(self.listen(ws_url, client, event)))
+                await asyncio.gather(*(event.wait() for event in ready))
+            connect_seconds = time.perf_counter() - started
+            rss_connected = rss_mb(pid)
+            rss_peak = max(filter(None, [rss_start, rss_connected]), default=None)
+
+            for sequence in range(1, options['mutations'] + 1):
+                sent[sequence] = time.perf_counter()
+                await asyncio.to_thread(self.mutate, session, api, sequence, source, link)
+                await asyncio.sleep(options['interval'])
+                rss_peak = max(filter(None, [rss_peak, rss_mb(pid)]), default=None)
+
+            # Give the last broadcast time to arrive everywhere
+            deadline = time.monotonic() + options['timeout']
+            while time.monotonic() < deadline and any(
+                c.connected and len(c.received) < len(sent) for c in clients
+            ):
+                await asyncio.sleep(0.1)
+            rss_end = rss_mb(pid)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await asyncio.to_thread(self.delete_fixtures, session, api, source, target)
+
+        latencies = sorted(
+            (received_at - sent[sequence]) * 1000
+            for client in clients
+            for sequence, received_at in client.received.items()
+            if sequence in sent
+        )
+        connected = [client for client in clients if client.connected]
+        expected = len(connected) * len(sent)
+        return {
+            'started_at': datetime.now().isoformat(),
+            'url': url,
+            'clients': len(clients),
+            'connected': len(connected),
+            'connect_seconds': round(connect_seconds, 3),
+            'mutations': len(sent),
+            'interval': options['interval'],
+            'latency_ms': {
+                'p50': self.rounded(percentile(latencies, 0.5)),
+                'p90': self.rounded(percentile(latencies, 0.9)),
+                'p99': self.rounded(percentile(latencies, 0.99)),
+                'max': self.rounded(latencies[-1] if latencies else None),
+            },
+            'delivered': len(latencies),
+            'expected': expected,
+            'dropped': expected - len(latencies),
+            'duplicates': sum(client.duplicates for client in clients),
+            'revision_gaps': sum(client.gaps for client in clients),
+            'server_rss_mb': {
+                'start': rss_start,
+                'connected': rss_connected,
+                'peak': rss_peak,
+                'end': rss_end,
+                'growth': round(rss_end - rss_start, 1) if rss_start and rss_end else None,
+            },
+        }
+
+    def rounded(self, value):
+        return round(value, 2) if value is not None else None
+
+    async def listen(self, ws_url, client, ready):
+        try:
+            async with websockets.connect(ws_url, max_size=None, open_timeout=60) as ws:
+                client.handle(json.loads(await ws.recv()))
+                client.connected = True
+                ready.set()
+                async for frame in ws:
+                    client.handle(json.loads(frame))
+        except (OSError, asyncio.TimeoutError, websockets.exceptions.WebSocketException) as e:
+            if not client.connected:
+                self.stderr.write(f'Client failed to connect: {e}')
+        finally:
+            ready.set()
+
+    def create_fixtures(self, session, api):
+        run = int(time.time())
+        devices = []
+        for side in ('a', 'b'):
+            response = session.post(f'{api}/devices/create/', json={
+                'name': f'{PREFIX}-{run}-{side}',
+                'device_type': 'switch',
+                'ip_address': '192.0.2.1',
+                'is_monitored': False,
+            })
+            if response.status_code != 201:
+                raise CommandError(f'Could not create a test device: {response.text[:200]}')
+            devices.append(response.json()['id'])
+
+        response = session.post(f'{api}/links/create/', json={
+            'source_device': devices[0],
+            'target_device': devices[1],
+            'source_interface': 'lt-0/0/0',
+            'target_interface': 'lt-0/0/0',
+            'bandwidth_capacity': BASE_CAPACITY,
+        })
+        if response.status_code != 201:
+            raise CommandError(f'Could not create a test link: {response.text[:200]}')
+        return devices[0], devices[1], response.json()['id']
+
+    def mutate(self, session, api, sequence, device, link):
+        """Alternate device renames and link capacity changes, each tagged with the sequence number"""
+        if sequence % 2:
+            session.put(f'{api}/devices/{device}/update/', json={'name': f'{PREFIX}-seq-{sequence}'})
+        else:
+            session.put(f'{api}/links/{link}/update/', json={'bandwidth_capacity': BASE_CAPACITY + sequence})
+
+    def delete_fixtures(self, session, api, *devices):
+        for device in devices:
+            session.delete(f'{api}/devices/{device}/delete/')
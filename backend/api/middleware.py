@@ -0,0 +1,65 @@
+import asyncio
+from .collector import collector
+from .views import broadcast_scheduler
+from .positions import position_stream
+from .snapshot import snapshot_writer
+from .notices import topology_notices
+
+
+class BackgroundServicesMiddleware:
+    """
+    ASGI middleware that attaches NetMap's background work to the server's
+    event loop, once, at lifespan startup or when the first connection
+    arrives (servers without lifespan support): the metrics collector, the
+    topology broadcast scheduler, the live position relay and the listener
+    for other workers' topology notices, after a warm start from the on-disk
+    topology snapshot.
+
+    Lifespan events are answered here, ProtocolTypeRouter has no route for them.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        # (loop, task) of the start on the current server loop
+        self._started = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        await self.start()
+        return await self.app(scope, receive, send)
+
+    async def start(self):
+        """Start the services on the running loop, or wait for the start already under way"""
+        loop = asyncio.get_running_loop()
+        if self._started is None or self._started[0] is not loop:
+            self._started = (loop, loop.create_task(self._start(loop)))
+        await asyncio.shield(self._started[1])
+
+    async def _start(self, loop):
+        await snapshot_writer.astart()
+        collector.start()
+        broadcast_scheduler.bind_loop(loop)
+        position_stream.bind_loop(loop)
+        topology_notices.bind_loop(loop)
+        await topology_notices.start()
+
+    async def stop(self):
+        """Stop refreshing metrics and save positions still buffered"""
+        collector.stop()
+        await position_stream.flush()
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                try:
+                    await self.start()
+                except Exception as e:
+                    await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.stop()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
@@ -0,0 +1,56 @@
+# Generated by Django 6.0 on 2026-10-18 16:43
+
+from django.db import migrations, models
+
+from api.icons import parse_data_url, content_hash
+
+
+def move_icons(apps, schema_editor):
+    """Move base64 data URL icons off Device rows into content-addressed Icons"""
+    Device = apps.get_model('api', 'Device')
+    Icon = apps.get_model('api', 'Icon')
+
+    for device in Device.objects.filter(icon__startswith='data:'):
+        try:
+            parsed = parse_data_url(device.icon)
+        except ValueError:
+            # Not an image, cleared by 0008_remove_unsafe_icons
+            continue
+        if parsed is None:
+            continue
+        content_type, data = parsed
+        icon_hash = content_hash(data)
+        Icon.objects.get_or_create(hash=icon_hash, defaults={'content_type': content_type, 'data': data})
+        device.icon_hash = icon_hash
+        device.icon = ''
+        device.save(update_fields=['icon', 'icon_hash'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0003_alter_device_icon'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Icon',
+            fields=[
+                ('hash', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('content_type', models.CharField(max_length=100)),
+                ('data', models.BinaryField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='device',
+            name='icon_hash',
+            field=models.CharField(blank=True, help_text='Hash of the uploaded Icon, if any', max_length=64),
+        ),
+        migrations.AlterField(
+            model_name='device',
+            name='icon',
+            field=models.TextField(blank=True, help_text='Emoji, or a base64 data URL which is moved to Icon on save'),
+        ),
+        migrations.RunPython(move_icons, migrations.RunPython.noop),
+    ]
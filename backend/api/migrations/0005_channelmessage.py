@@ -0,0 +1,24 @@
+# Generated by Django 6.0 on 2026-10-18 17:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_icon'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChannelMessage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('origin', models.CharField(help_text='Process that sent the message', max_length=32)),
+                ('group', models.CharField(blank=True, max_length=100)),
+                ('channel', models.CharField(blank=True, max_length=100)),
+                ('payload', models.TextField()),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 6.0 on 2026-10-18 18:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_channelmessage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='device',
+            name='site',
+            field=models.CharField(blank=True, db_index=True, help_text='Site or region, clients can subscribe to a subset of sites', max_length=100),
+        ),
+    ]
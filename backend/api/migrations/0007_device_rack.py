@@ -0,0 +1,18 @@
+# Generated by Django 6.0 on 2026-10-18 19:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0006_device_site'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='device',
+            name='rack',
+            field=models.CharField(blank=True, help_text='Rack within the site, for collapsed views', max_length=100),
+        ),
+    ]
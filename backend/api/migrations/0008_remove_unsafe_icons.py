@@ -0,0 +1,34 @@
+# Generated by Django 6.0 on 2026-10-18 21:12
+
+from django.db import migrations
+
+from api.icons import ICON_CONTENT_TYPES, parse_data_url
+
+
+def remove_unsafe_icons(apps, schema_editor):
+    """Drop stored icons that are not images, they would be served from NetMap's origin"""
+    Device = apps.get_model('api', 'Device')
+    Icon = apps.get_model('api', 'Icon')
+
+    unsafe = list(Icon.objects.exclude(content_type__in=ICON_CONTENT_TYPES).values_list('hash', flat=True))
+    if unsafe:
+        Device.objects.filter(icon_hash__in=unsafe).update(icon_hash='')
+        Icon.objects.filter(hash__in=unsafe).delete()
+    # Data URLs left inline on devices (e.g. skipped by 0004_icon) that are not images or not decodable
+    for device in Device.objects.filter(icon__startswith='data:'):
+        try:
+            parse_data_url(device.icon)
+        except ValueError:
+            device.icon = ''
+            device.save(update_fields=['icon'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_device_rack'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_unsafe_icons, migrations.RunPython.noop),
+    ]
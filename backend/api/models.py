@@ -1,4 +1,32 @@
 from django.db import models
+from django.urls import reverse
+from .icons import parse_data_url, content_hash
+
+
+class Icon(models.Model):
+    """Uploaded device icon, stored once and addressed by its SHA-256"""
+    hash = models.CharField(max_length=64, primary_key=True)
+    content_type = models.CharField(max_length=100)
+    data = models.BinaryField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.hash[:12]} ({self.content_type})"
+
+    @classmethod
+    def store(cls, data_url):
+        """
+        Save a data URL icon (deduplicated) and return its hash, or None if not
+        a data URL. Raises ValueError for anything but the ICON_CONTENT_TYPES.
+        """
+        parsed = parse_data_url(data_url)
+        if parsed is None:
+            return None
+        content_type, data = parsed
+        icon_hash = content_hash(data)
+        cls.objects.get_or_create(hash=icon_hash, defaults={'content_type': content_type, 'data': data})
+        return icon_hash
+
 
 class Device(models.Model):
     """Network device (firewall, switch, router, server, etc.)"""
@@ -16,15 +44,35 @@ class Device(models.Model):
     ip_address = models.GenericIPAddressField()
     prometheus_instance = models.CharField(max_length=100, blank=True, help_text="Instance label in Prometheus (leave blank for dummy nodes)")
     is_monitored = models.BooleanField(default=True, help_text="Whether this device has Prometheus metrics")  # Add this
+    site = models.CharField(max_length=100, blank=True, db_index=True, help_text="Site or region, clients can subscribe to a subset of sites")
+    rack = models.CharField(max_length=100, blank=True, help_text="Rack within the site, for collapsed views")
     position_x = models.IntegerField(default=0)
     position_y = models.IntegerField(default=0)
-    icon = models.TextField(blank=True, help_text="Base64 encoded image or emoji")
+    icon = models.TextField(blank=True, help_text="Emoji, or a base64 data URL which is moved to Icon on save")
+    icon_hash = models.CharField(max_length=64, blank=True, help_text="Hash of the uploaded Icon, if any")
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
     def __str__(self):
         return f"{self.name} ({self.device_type})"
 
+    def save(self, *args, **kwargs):
+        self.store_icon()
+        super().save(*args, **kwargs)
+
+    def store_icon(self):
+        """Keep image blobs out of the device row, store them content-addressed"""
+        icon_hash = Icon.store(self.icon)
+        if icon_hash:
+            self.icon_hash = icon_hash
+            self.icon = ''
+
+    @property
+    def icon_url(self):
+        if not self.icon_hash:
+            return None
+        return reverse('get_icon', args=[self.icon_hash])
+
     class Meta:
         ordering = ['name']
 
@@ -41,7 +89,39 @@ class Link(models.Model):
     
     def __str__(self):
         return f"{self.source_device.name}:{self.source_interface} -> {self.target_device.name}:{self.target_interface}"
-    
+
+    @property
+    def metric_side(self):
+        """'source' or 'target': the end whose interface reports this link's bandwidth, or None"""
+        if self.source_device.is_monitored and self.source_device.prometheus_instance:
+            return 'source'
+        if self.target_device.is_monitored and self.target_device.prometheus_instance:
+            # Use target device (for dummy source nodes like ISP)
+            return 'target'
+        return None
+
+    @property
+    def metric_key(self):
+        """(prometheus_instance, ifName) that reports this link's bandwidth, or None"""
+        side = self.metric_side
+        if side == 'source':
+            return (self.source_device.prometheus_instance, self.source_interface)
+        if side == 'target':
+            return (self.target_device.prometheus_instance, self.target_interface)
+        return None
+
     class Meta:
         ordering = ['source_device', 'target_device']
         unique_together = ['source_device', 'source_interface', 'target_device', 'target_interface']
+
+
+class ChannelMessage(models.Model):
+    """Channel layer message passed between worker processes (see api.layers)"""
+    origin = models.CharField(max_length=32, help_text="Process that sent the message")
+    group = models.CharField(max_length=100, blank=True)
+    channel = models.CharField(max_length=100, blank=True)
+    payload = models.TextField()
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __str__(self):
+        return f"{self.group or self.channel} from {self.origin}"
@@ -0,0 +1,112 @@
+import asyncio
+import threading
+from channels.layers import get_channel_layer
+from asgiref.sync import async_to_sync
+from .cache import topology_cache
+from .changelog import topology_log
+from .graph import graph_index
+
+STRUCTURE = 'structure'
+POSITIONS = 'positions'
+
+
+class TopologyNotices:
+    """
+    Tells the other worker processes when this one changed the database, so
+    they drop their cached structure and graph index even if none of their
+    WebSocket clients would have noticed.
+
+    changed() is cheap and safe to call from request threads and signals:
+    each burst of changes becomes one small 'topology_changed' message to
+    `group_name`. Every process listens on a channel of its own in that
+    group from a task on the server's event loop (see start()).
+    """
+
+    def __init__(self, group_name='topology_changes'):
+        self.group_name = group_name
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._listeners = []
+        self._loop = None
+        self._task = None
+
+    def bind_loop(self, loop):
+        """Send notices from the given event loop (the ASGI server's), idempotent"""
+        if self._loop is None or self._loop.is_closed():
+            self._loop = loop
+
+    def add_listener(self, callback):
+        """Register a callable run after another process changed the structure"""
+        self._listeners.append(callback)
+
+    def changed(self, kind=STRUCTURE):
+        """Note that devices or links (STRUCTURE) or only positions (POSITIONS) were written"""
+        with self._lock:
+            first = not self._pending
+            self._pending.add(kind)
+        if not first:
+            # Already on its way
+            return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        loop = self._loop
+        if running is not None:
+            # Called on an event loop (position flushes), which must not block
+            running.create_task(self._send_pending())
+        elif loop is not None and not loop.is_closed():
+            asyncio.run_coroutine_threadsafe(self._send_pending(), loop)
+        else:
+            # Management commands and tests, without a server loop
+            try:
+                async_to_sync(self._send_pending)()
+            except Exception as e:
+                print(f"Error sending topology notice: {e}")
+
+    async def _send_pending(self):
+        with self._lock:
+            kinds, self._pending = self._pending, set()
+        channel_layer = get_channel_layer()
+        if channel_layer is None or not kinds:
+            return
+        await channel_layer.group_send(self.group_name, {
+            'type': 'topology_changed',
+            'origin': topology_log.origin,
+            'kinds': sorted(kinds)
+        })
+
+    async def start(self):
+        """Listen for other processes' notices on the running loop (idempotent)"""
+        if self._task is not None and not self._task.done():
+            return
+        channel_layer = get_channel_layer()
+        if channel_layer is None:
+            return
+        channel = await channel_layer.new_channel()
+        await channel_layer.group_add(self.group_name, channel)
+        self._task = asyncio.get_running_loop().create_task(self._listen(channel_layer, channel))
+
+    async def _listen(self, channel_layer, channel):
+        while True:
+            try:
+                self.handle(await channel_layer.receive(channel))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Error handling topology notice: {e}")
+
+    def handle(self, message):
+        """Apply another process's notice to this one's caches"""
+        if message.get('origin') == topology_log.origin:
+            return
+        kinds = message.get('kinds', ())
+        if STRUCTURE in kinds:
+            graph_index.reload()
+        topology_cache.invalidate()
+        if STRUCTURE in kinds:
+            for listener in self._listeners:
+                listener()
+
+
+topology_notices = TopologyNotices()
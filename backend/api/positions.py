@@ -0,0 +1,167 @@
+import asyncio
+import json
+import threading
+import time
+from collections import OrderedDict
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from .models import Device
+from .cache import topology_cache
+from .changelog import topology_log
+from .encoding import encode_frames
+from .notices import topology_notices, POSITIONS
+from .instrumentation import broadcast_seconds
+
+
+class PositionStream:
+    """
+    Live node positions for collaborative dragging.
+
+    Positions sent over the WebSocket are relayed as small 'position_update'
+    messages, at most once per `throttle` seconds per device (the latest
+    position always goes out), to every client whose view shows the device.
+    One message goes to the group, each view's share is filtered and encoded
+    once in view_frames(). Database writes are buffered and
+    flushed with one bulk_update every `flush_interval` seconds.
+    submit() runs on the server's event loop; relay() is for request threads.
+    """
+
+    def __init__(self, throttle=0.05, flush_interval=1.0, group_name='topology_positions'):
+        self.throttle = throttle
+        self.flush_interval = flush_interval
+        self.group_name = group_name
+        self._last_sent = {}
+        self._pending_send = {}
+        self._pending_writes = {}
+        self._send_handle = None
+        self._flush_task = None
+        self._loop = None
+        self._view_frames = OrderedDict()
+        self._view_lock = threading.Lock()
+
+    def bind_loop(self, loop):
+        """Relay positions saved by request threads on the given event loop, idempotent"""
+        if self._loop is None or self._loop.is_closed():
+            self._loop = loop
+
+    def relay(self, positions):
+        """Send positions that were already saved (e.g. over HTTP) to all clients"""
+        if self._loop is not None and not self._loop.is_closed():
+            asyncio.run_coroutine_threadsafe(self._send(positions, None), self._loop)
+        else:
+            async_to_sync(self._send)(positions, None)
+
+    async def submit(self, positions, sender=None):
+        """Accept [{'id', 'x', 'y'}, ...] from a client; invalid entries are ignored"""
+        now = time.monotonic()
+        ready = []
+
+        for position in positions:
+            try:
+                item = {'id': int(position['id']), 'x': int(position['x']), 'y': int(position['y'])}
+            except (KeyError, TypeError, ValueError):
+                continue
+
+            self._pending_writes[item['id']] = (item['x'], item['y'])
+            if now - self._last_sent.get(item['id'], 0) >= self.throttle:
+                self._last_sent[item['id']] = now
+                self._pending_send.pop(item['id'], None)
+                ready.append(item)
+            else:
+                self._pending_send[item['id']] = (item, sender)
+
+        if ready:
+            await self._send(ready, sender)
+        if self._pending_send and self._send_handle is None:
+            self._send_handle = asyncio.get_running_loop().call_later(
+                self.throttle, lambda: asyncio.ensure_future(self._send_pending())
+            )
+        if self._pending_writes and (self._flush_task is None or self._flush_task.done()):
+            self._flush_task = asyncio.ensure_future(self._flush_later())
+
+    async def _send_pending(self):
+        """Trailing edge of the throttle: send the latest position of each waiting device"""
+        self._send_handle = None
+        pending, self._pending_send = self._pending_send, {}
+        now = time.monotonic()
+
+        by_sender = {}
+        for device_id, (item, sender) in pending.items():
+            self._last_sent[device_id] = now
+            by_sender.setdefault(sender, []).append(item)
+        for sender, items in by_sender.items():
+            await self._send(items, sender)
+
+    async def _send(self, positions, sender):
+        channel_layer = get_channel_layer()
+        if channel_layer is None:
+            return
+        message = {
+            'type': 'position_update',
+            'origin': topology_log.origin,
+            'sender': sender,
+            'frames': encode_frames({'type': 'position_update', 'positions': positions})
+        }
+        with broadcast_seconds.time(type='position_update'):
+            await channel_layer.group_send(self.group_name, message)
+
+    def view_frames(self, frames, log, size=64):
+        """
+        The frames of a position_update limited to the nodes of the view
+        recorded in `log`, or None if it shows none of the moved devices.
+        Collapsed views only keep devices that are nodes of their own.
+        """
+        key = (frames['json'], log, log.revision)
+        with self._view_lock:
+            if key in self._view_frames:
+                self._view_frames.move_to_end(key)
+                return self._view_frames[key]
+
+        positions = json.loads(frames['json'])['positions']
+        visible = log.known_nodes(position['id'] for position in positions)
+        if len(visible) == len(positions):
+            view = frames
+        elif visible:
+            view = encode_frames({
+                'type': 'position_update',
+                'positions': [position for position in positions if position['id'] in visible]
+            })
+        else:
+            view = None
+
+        with self._view_lock:
+            self._view_frames[key] = view
+            while len(self._view_frames) > size:
+                self._view_frames.popitem(last=False)
+        return view
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        await self.flush()
+
+    async def flush(self):
+        """Write buffered positions to the database"""
+        pending, self._pending_writes = self._pending_writes, {}
+        if not pending:
+            return
+        try:
+            await database_sync_to_async(self._write)(pending)
+        except Exception as e:
+            print(f"Error saving positions: {e}")
+        topology_cache.invalidate()
+        # Other workers cache the structure too
+        topology_notices.changed(POSITIONS)
+
+    def _write(self, pending):
+        devices = Device.objects.in_bulk(list(pending))
+        for device_id, device in devices.items():
+            device.position_x, device.position_y = pending[device_id]
+        Device.objects.bulk_update(devices.values(), ['position_x', 'position_y'], batch_size=500)
+
+
+position_stream = PositionStream(
+    throttle=settings.POSITION_THROTTLE,
+    flush_interval=settings.POSITION_FLUSH_INTERVAL
+)
@@ -1,41 +1,415 @@
+import re
+import threading
+import time
 import requests
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
 from datetime import datetime
+from requests.adapters import HTTPAdapter
+from .instrumentation import prometheus_query_seconds, prometheus_query_errors
 
-class PrometheusClient:
-    def __init__(self, url='http://10.10.1.7:9090'):
+# Keep each label matcher comfortably below typical proxy/URL limits
+MAX_SELECTOR_LENGTH = 4000
+
+# Interfaces whose last good values are kept to answer for failed chunks
+LAST_KNOWN_SIZE = 100000
+
+# Absolute time.monotonic() deadline for the current topology build, if any
+_deadline = ContextVar('prometheus_deadline', default=None)
+
+
+class PrometheusUnavailable(Exception):
+    """Raised when a query cannot be answered (error, deadline spent or breaker open)"""
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive failures and rejects calls for
+    `reset_timeout` seconds, then lets a single trial call through (half-open).
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+
+    @property
+    def is_open(self):
+        with self._lock:
+            return self._opened_at is not None and time.monotonic() - self._opened_at < self.reset_timeout
+
+    def allow(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at < self.reset_timeout or self._trial_in_flight:
+                return False
+            self._trial_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def release(self):
+        """End a half-open trial without a verdict"""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial_in_flight or self._failures >= self.failure_threshold:
+                if self._opened_at is None or self._trial_in_flight:
+                    print(f"Prometheus circuit breaker open after {self._failures} failures")
+                self._opened_at = time.monotonic()
+            self._trial_in_flight = False
+
+
+class PrometheusQueries:
+    """
+    Query building, selector chunking, retry budgets and result parsing
+    shared by PrometheusClient and AsyncPrometheusClient, which only differ
+    in how they send queries.
+    """
+
+    # LLDP remote table series joined into one row per neighbour
+    LLDP_METRICS = ('lldpRemSysName', 'lldpRemPortId', 'lldpRemPortDesc')
+
+    def __init__(self, url, max_selector_length=MAX_SELECTOR_LENGTH, retries=2, timeout=10, breaker=None,
+                 last_known_size=LAST_KNOWN_SIZE):
         self.url = url
-    
-    def query(self, query):
-        """Execute PromQL query"""
+        self.max_selector_length = max_selector_length
+        self.retries = retries
+        self.timeout = timeout
+        self.breaker = breaker or CircuitBreaker()
+        self.last_known_size = last_known_size
+        # Least recently fetched first
+        self._last_known = OrderedDict()
+        self._last_known_lock = threading.Lock()
+
+    @contextmanager
+    def deadline(self, seconds):
+        """Bound the total time spent in queries inside this block"""
+        token = _deadline.set(time.monotonic() + seconds)
         try:
-            response = requests.get(
-                f'{self.url}/api/v1/query',
-                params={'query': query},
-                timeout=10
-            )
-            response.raise_for_status()
-            return response.json()
-        except requests.RequestException as e:
-            print(f"Prometheus query error: {e}")
-            return {'data': {'result': []}}
-    
-    def get_interface_bandwidth(self, instance, interface):
-        """Get current bandwidth for an interface in Mbps"""
-        query_in = f'sum(rate(ifHCInOctets{{instance="{instance}", ifName="{interface}"}}[5m]) * 8) / 1000000'
-        query_out = f'sum(rate(ifHCOutOctets{{instance="{instance}", ifName="{interface}"}}[5m]) * 8) / 1000000'
-        
-        inbound = self.query(query_in)
-        outbound = self.query(query_out)
-        
+            yield
+        finally:
+            _deadline.reset(token)
+
+    def _remaining(self):
+        """Seconds left in the current deadline budget, or None when unbounded"""
+        deadline = _deadline.get()
+        if deadline is None:
+            return None
+        return deadline - time.monotonic()
+
+    def _attempt_timeout(self):
+        remaining = self._remaining()
+        if remaining is None:
+            return self.timeout
+        if remaining <= 0:
+            raise PrometheusUnavailable('deadline budget exhausted')
+        return min(self.timeout, remaining)
+
+    def _backoff(self, attempt):
+        return min(0.2 * (2 ** attempt), 2.0)
+
+    def _bandwidth_queries(self, instance, interface):
+        """In and out rate queries in Mbps for one interface"""
+        return tuple(
+            f'sum(rate({metric}{{instance="{instance}", ifName="{interface}"}}[5m]) * 8) / 1000000'
+            for metric in ('ifHCInOctets', 'ifHCOutOctets')
+        )
+
+    def _bandwidth(self, inbound, outbound):
         return {
             'inbound': round(self._extract_value(inbound), 2),
             'outbound': round(self._extract_value(outbound), 2),
             'timestamp': datetime.now().isoformat()
         }
-    
+
+    def _history_queries(self, selector, step):
+        """(direction, query) pairs for a query_range over one selector chunk"""
+        # Rate over at least one step so samples between steps are not skipped
+        rate_window = f'{max(300, int(step))}s'
+        return [
+            (direction, self._bulk_rate_query(metric, selector, rate_window))
+            for direction, metric in (('inbound', 'ifHCInOctets'), ('outbound', 'ifHCOutOctets'))
+        ]
+
+    def _add_history(self, results, direction, result, chunk):
+        for key, values in self._extract_matrix(result).items():
+            if key in chunk:
+                results.setdefault(key, {'inbound': [], 'outbound': []})[direction] = values
+
+    def _speed_query(self, selector):
+        return f'max by (instance, ifName) (ifHighSpeed{{{selector}}})'
+
+    def _join_lldp(self, results):
+        """Join the results of the LLDP_METRICS queries, in order, into one row of labels per neighbour"""
+        rows = {}
+        for metric, result in zip(self.LLDP_METRICS, results):
+            for sample in result.get('data', {}).get('result', []):
+                labels = sample.get('metric', {})
+                key = (labels.get('instance'), labels.get('lldpRemLocalPortNum'), labels.get('lldpRemIndex'))
+                if key[1] is None and key[2] is None:
+                    # Nothing to join on, keep every series as a row of its own
+                    key = (labels.get('instance'), metric, len(rows))
+                if metric == 'lldpRemSysName':
+                    rows.setdefault(key, {}).update(labels)
+                elif key in rows:
+                    rows[key].setdefault(metric, labels.get(metric, ''))
+        return list(rows.values())
+
+    def _merge_bulk(self, chunks):
+        """Map chunked vector results back to the requested pairs"""
+        results = {}
+        timestamp = datetime.now().isoformat()
+        fetched_at = time.time()
+
+        with self._last_known_lock:
+            for chunk, inbound, outbound in chunks:
+                if inbound is None or outbound is None:
+                    for key in chunk:
+                        if key in self._last_known:
+                            results[key] = dict(self._last_known[key], stale=True)
+                    continue
+
+                # Regex selectors match the cross product of a chunk, keep only requested pairs
+                for key in (inbound.keys() | outbound.keys()) & chunk:
+                    results[key] = {
+                        'inbound': round(inbound.get(key, 0.0), 2),
+                        'outbound': round(outbound.get(key, 0.0), 2),
+                        'timestamp': timestamp,
+                        'fetched_at': fetched_at,
+                        'stale': False
+                    }
+                    self._last_known[key] = results[key]
+                    self._last_known.move_to_end(key)
+
+            while len(self._last_known) > self.last_known_size:
+                self._last_known.popitem(last=False)
+
+        return results
+
+    def _bulk_rate_query(self, metric, selector, window='5m'):
+        """Build a rate query in Mbps grouped by instance and interface"""
+        return f'sum by (instance, ifName) (rate({metric}{{{selector}}}[{window}]) * 8) / 1000000'
+
+    def _chunk_selectors(self, pairs):
+        """
+        Yield (selector, pairs) chunks covering all pairs, split when a
+        selector grows too long.
+        """
+        instances, interfaces, chunk = set(), set(), set()
+        length = 0
+
+        for instance, interface in sorted(pairs):
+            added = 0
+            if instance not in instances:
+                added += len(self._regex_escape(instance)) + 1
+            if interface not in interfaces:
+                added += len(self._regex_escape(interface)) + 1
+
+            if chunk and length + added > self.max_selector_length:
+                yield self._selector(instances, interfaces), chunk
+                instances, interfaces, chunk = set(), set(), set()
+                added = len(self._regex_escape(instance)) + len(self._regex_escape(interface)) + 2
+                length = 0
+
+            instances.add(instance)
+            interfaces.add(interface)
+            chunk.add((instance, interface))
+            length += added
+
+        if chunk:
+            yield self._selector(instances, interfaces), chunk
+
+    def _selector(self, instances, interfaces):
+        instance_re = '|'.join(self._regex_escape(i) for i in sorted(instances))
+        interface_re = '|'.join(self._regex_escape(i) for i in sorted(interfaces))
+        return f'instance=~"{instance_re}", ifName=~"{interface_re}"'
+
+    def _regex_escape(self, value):
+        """Escape a label value for an RE2 matcher inside a PromQL string literal"""
+        escaped = re.sub(r'([\\.+*?()|\[\]{}^$])', r'\\\1', value)
+        return escaped.replace('\\', '\\\\').replace('"', '\\"')
+
+    def _extract_vector(self, result):
+        """Extract {(instance, ifName): value} from a Prometheus vector result"""
+        values = {}
+        try:
+            series = result['data']['result']
+        except (KeyError, TypeError):
+            return values
+
+        for sample in series:
+            try:
+                metric = sample['metric']
+                values[(metric['instance'], metric['ifName'])] = float(sample['value'][1])
+            except (KeyError, IndexError, ValueError):
+                continue
+        return values
+
+    def _extract_matrix(self, result):
+        """Extract {(instance, ifName): [(t, value), ...]} from a Prometheus matrix result"""
+        values = {}
+        try:
+            series = result['data']['result']
+        except (KeyError, TypeError):
+            return values
+
+        for sample in series:
+            try:
+                metric = sample['metric']
+                values[(metric['instance'], metric['ifName'])] = [
+                    (float(t), float(v)) for t, v in sample['values']
+                ]
+            except (KeyError, TypeError, ValueError):
+                continue
+        return values
+
     def _extract_value(self, result):
         """Extract numeric value from Prometheus result"""
         try:
             return float(result['data']['result'][0]['value'][1])
         except (KeyError, IndexError, ValueError):
             return 0.0
+
+
+class PrometheusClient(PrometheusQueries):
+    def __init__(self, url='http://10.10.1.7:9090', max_selector_length=MAX_SELECTOR_LENGTH,
+                 pool_size=10, retries=2, timeout=10, breaker=None, last_known_size=LAST_KNOWN_SIZE):
+        super().__init__(url, max_selector_length=max_selector_length, retries=retries, timeout=timeout,
+                         breaker=breaker, last_known_size=last_known_size)
+        self.session = self._make_session(pool_size)
+
+    def _make_session(self, pool_size):
+        """Keep-alive connections reused across queries and threads"""
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def _fetch(self, query, endpoint='query', **params):
+        """
+        Execute PromQL query with retries, raising PrometheusUnavailable on failure.
+        `endpoint` and extra params select e.g. query_range with start/end/step.
+        """
+        with prometheus_query_seconds.time(endpoint=endpoint):
+            try:
+                return self._request(query, endpoint, params)
+            except PrometheusUnavailable:
+                prometheus_query_errors.inc(endpoint=endpoint)
+                raise
+
+    def _request(self, query, endpoint, params):
+        if not self.breaker.allow():
+            raise PrometheusUnavailable('circuit breaker open')
+
+        error = None
+        for attempt in range(self.retries + 1):
+            try:
+                timeout = self._attempt_timeout()
+            except PrometheusUnavailable:
+                # Our own budget ran out, which says nothing about Prometheus health
+                self.breaker.release()
+                raise
+            try:
+                response = self.session.get(
+                    f'{self.url}/api/v1/{endpoint}',
+                    params=dict(params, query=query),
+                    timeout=timeout
+                )
+                if 400 <= response.status_code < 500:
+                    # Bad PromQL will not succeed on retry, but the server is healthy
+                    self.breaker.record_success()
+                    raise PrometheusUnavailable(f'HTTP {response.status_code} for query: {response.text[:200]}')
+                response.raise_for_status()
+                result = response.json()
+                self.breaker.record_success()
+                return result
+            except (requests.RequestException, ValueError) as e:
+                error = e
+
+            remaining = self._remaining()
+            if attempt < self.retries and (remaining is None or remaining > self._backoff(attempt)):
+                time.sleep(self._backoff(attempt))
+
+        self.breaker.record_failure()
+        raise PrometheusUnavailable(str(error))
+
+    def query(self, query):
+        """Execute PromQL query"""
+        try:
+            return self._fetch(query)
+        except PrometheusUnavailable as e:
+            print(f"Prometheus query error: {e}")
+            return {'data': {'result': []}}
+
+    def get_interface_bandwidth(self, instance, interface):
+        """Get current bandwidth for an interface in Mbps"""
+        query_in, query_out = self._bandwidth_queries(instance, interface)
+        return self._bandwidth(self.query(query_in), self.query(query_out))
+
+    def get_bulk_interface_bandwidth(self, pairs):
+        """
+        Get current bandwidth in Mbps for many (instance, ifName) pairs at once.
+        Returns a dict keyed by (instance, ifName); pairs without data are omitted.
+        Chunks that cannot be fetched fall back to the last known values, marked stale.
+        """
+        chunks = []
+        for selector, chunk in self._chunk_selectors(set(pairs)):
+            try:
+                inbound = self._extract_vector(self._fetch(self._bulk_rate_query('ifHCInOctets', selector)))
+                outbound = self._extract_vector(self._fetch(self._bulk_rate_query('ifHCOutOctets', selector)))
+            except PrometheusUnavailable as e:
+                print(f"Prometheus bulk query error: {e}")
+                inbound = outbound = None
+            chunks.append((chunk, inbound, outbound))
+
+        return self._merge_bulk(chunks)
+
+    def get_bulk_interface_history(self, pairs, start, end, step):
+        """
+        Get bandwidth in Mbps between two unix times for many (instance, ifName)
+        pairs, with one query_range call per direction and selector chunk.
+        Returns {(instance, ifName): {'inbound': [(t, v), ...], 'outbound': [...]}}.
+        Raises PrometheusUnavailable if any chunk fails, as partial history misleads.
+        """
+        results = {}
+        for selector, chunk in self._chunk_selectors(set(pairs)):
+            for direction, query in self._history_queries(selector, step):
+                result = self._fetch(query, endpoint='query_range', start=start, end=end, step=step)
+                self._add_history(results, direction, result, chunk)
+        return results
+
+    def get_lldp_neighbors(self):
+        """
+        LLDP remote table rows from the SNMP exporter: the labels of every
+        lldpRemSysName series, with lldpRemPortId and lldpRemPortDesc labels
+        joined in from their own series by (instance, local port, index).
+        Raises PrometheusUnavailable, as a partial table would look like
+        missing links.
+        """
+        return self._join_lldp([self._fetch(metric) for metric in self.LLDP_METRICS])
+
+    def get_bulk_interface_speed(self, pairs):
+        """Interface speeds in Mbps (ifHighSpeed) for many (instance, ifName) pairs"""
+        speeds = {}
+        for selector, chunk in self._chunk_selectors(set(pairs)):
+            try:
+                values = self._extract_vector(self._fetch(self._speed_query(selector)))
+            except PrometheusUnavailable as e:
+                print(f"Prometheus speed query error: {e}")
+                continue
+            speeds.update({key: value for key, value in values.items() if key in chunk})
+        return speeds
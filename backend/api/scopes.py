@@ -0,0 +1,152 @@
+import hashlib
+import threading
+import time
+from django.conf import settings
+from .changelog import TopologyLog
+from .aggregate import collapse_topology
+
+
+def parse_sites(value):
+    """
+    Normalize a site selection from a query string ('a,b') or a WebSocket
+    message (['a', 'b']) to a sorted tuple; None or empty means the whole map.
+    """
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = value.split(',')
+    if not isinstance(value, (list, tuple)):
+        raise ValueError('sites must be a list of site names')
+    sites = tuple(sorted({str(site).strip() for site in value if str(site).strip()}))
+    return sites or None
+
+
+def scope_group(sites, level=None):
+    """Channel layer group for the clients subscribed to exactly this view"""
+    if sites is None and level is None:
+        return 'topology_updates'
+    key = '\n'.join(sites or ()) + f'\n{level or ""}'
+    digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+    return f'topology_view_{digest}'
+
+
+def filter_topology(data, sites):
+    """
+    The part of a topology payload within `sites`: their devices, every link
+    touching one of them (including links crossing the boundary) and the
+    devices on the far side of those links.
+    """
+    wanted = set(sites)
+    inside = {node['id'] for node in data['nodes'] if node.get('site') in wanted}
+    edges = [edge for edge in data['edges'] if edge['source'] in inside or edge['target'] in inside]
+    visible = inside.union(*((edge['source'], edge['target']) for edge in edges))
+    return {
+        'nodes': [node for node in data['nodes'] if node['id'] in visible],
+        'edges': edges,
+        'timestamp': data.get('timestamp')
+    }
+
+
+def view_topology(data, sites=None, level=None):
+    """A topology payload limited to `sites` and collapsed to `level`"""
+    if sites is not None:
+        data = filter_topology(data, sites)
+    if level is not None:
+        data = collapse_topology(data, level)
+    return data
+
+
+class Subscriptions:
+    """
+    Which views of the map connected WebSocket clients look at.
+
+    Clients of the whole, uncollapsed map share the main topology_log. Every
+    other view (a set of sites and/or a detail level) gets a TopologyLog of
+    its own, fed with the filtered and collapsed topology on every publish,
+    so its patches are diffed and encoded once per view rather than per
+    client. Logs are dropped with their last client.
+
+    Readers without a connection (HTTP polling, snapshots, utilization
+    weighted paths) are recorded by read() and count for reader_timeout
+    seconds after their last read.
+    """
+
+    def __init__(self, max_entries=500, reader_timeout=90):
+        self.max_entries = max_entries
+        self.reader_timeout = reader_timeout
+        self._lock = threading.Lock()
+        self._whole_map = 0
+        self._views = {}
+        self._readers = {}
+        # Bumped when a view gets a new, still empty log
+        self.version = 0
+
+    def subscribe(self, sites, level=None):
+        """Register a client for a view (sites None: all); True if its links were not fetched yet"""
+        with self._lock:
+            wanted = self._wanted()
+            if sites is None and level is None:
+                self._whole_map += 1
+            elif (sites, level) in self._views:
+                self._views[(sites, level)][1] += 1
+            else:
+                self._views[(sites, level)] = [TopologyLog(max_entries=self.max_entries), 1]
+                self.version += 1
+            return wanted is not None and (sites is None or not set(sites) <= wanted)
+
+    def unsubscribe(self, sites, level=None):
+        with self._lock:
+            if sites is None and level is None:
+                self._whole_map = max(0, self._whole_map - 1)
+                return
+            view = self._views.get((sites, level))
+            if view is not None:
+                view[1] -= 1
+                if view[1] <= 0:
+                    del self._views[(sites, level)]
+
+    def read(self, sites=None):
+        """Record a read of `sites` (None: all) outside a subscription; True if their links were not fetched yet"""
+        with self._lock:
+            wanted = self._wanted()
+            self._readers[sites] = time.monotonic()
+            return wanted is not None and (sites is None or not set(sites) <= wanted)
+
+    def log(self, sites, level=None):
+        """The TopologyLog for a subscribed view"""
+        with self._lock:
+            return self._views[(sites, level)][0]
+
+    def publish(self, data):
+        """Record a topology build for every subscribed view: [(sites, level, revision, base, ops)]"""
+        with self._lock:
+            logs = [(key, view[0]) for key, view in self._views.items()]
+        published = []
+        for (sites, level), log in logs:
+            revision, base, ops = log.publish(view_topology(data, sites, level))
+            published.append((sites, level, revision, base, ops))
+        return published
+
+    def wanted_sites(self):
+        """
+        Sites whose link metrics someone is watching, or None for all links
+        (a client or recent reader wants the whole map, or nobody is
+        connected and HTTP clients may ask for anything)
+        """
+        with self._lock:
+            return self._wanted()
+
+    def _wanted(self):
+        expired = time.monotonic() - self.reader_timeout
+        self._readers = {sites: at for sites, at in self._readers.items() if at > expired}
+        scopes = [sites for sites, _ in self._views] + list(self._readers)
+        if self._whole_map or not self._views or any(sites is None for sites in scopes):
+            return None
+        return set().union(*scopes)
+
+
+# Readers count until they skip a few metric refreshes
+subscriptions = Subscriptions(
+    max_entries=settings.TOPOLOGY_LOG_SIZE,
+    reader_timeout=settings.METRICS_REFRESH_INTERVAL * 3
+)
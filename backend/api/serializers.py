@@ -1,10 +1,21 @@
 from rest_framework import serializers
 from .models import Device, Link
+from .icons import parse_data_url
 
 class DeviceSerializer(serializers.ModelSerializer):
+    icon_url = serializers.CharField(read_only=True)
+
     class Meta:
         model = Device
         fields = '__all__'
+        read_only_fields = ['icon_hash']
+
+    def validate_icon(self, value):
+        try:
+            parse_data_url(value)
+        except ValueError as e:
+            raise serializers.ValidationError(str(e))
+        return value
 
 class LinkSerializer(serializers.ModelSerializer):
     source_device_name = serializers.CharField(source='source_device.name', read_only=True)
@@ -13,3 +24,21 @@ class LinkSerializer(serializers.ModelSerializer):
     class Meta:
         model = Link
         fields = '__all__'
+
+
+class BulkDeviceSerializer(DeviceSerializer):
+    """Bulk request item; name uniqueness is checked for the whole batch in the view"""
+
+    class Meta(DeviceSerializer.Meta):
+        extra_kwargs = {'name': {'validators': []}}
+
+
+class BulkLinkSerializer(serializers.ModelSerializer):
+    """Bulk request item; endpoints are resolved and uniqueness checked for the whole batch in the view"""
+    source_device = serializers.IntegerField()
+    target_device = serializers.IntegerField()
+
+    class Meta:
+        model = Link
+        fields = '__all__'
+        validators = []
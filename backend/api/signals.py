@@ -0,0 +1,37 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from .models import Device, Link
+from .cache import topology_cache
+from .graph import graph_index
+from .notices import topology_notices
+
+
+@receiver(post_save, sender=Device)
+@receiver(post_delete, sender=Device)
+@receiver(post_save, sender=Link)
+@receiver(post_delete, sender=Link)
+def invalidate_topology(sender, **kwargs):
+    """Drop the cached topology structure whenever a device or link changes, here and in other workers"""
+    topology_cache.invalidate()
+    topology_notices.changed()
+
+
+@receiver(post_save, sender=Device)
+def index_device(sender, instance, created, **kwargs):
+    if created:
+        graph_index.add_device(instance.id)
+
+
+@receiver(post_delete, sender=Device)
+def unindex_device(sender, instance, **kwargs):
+    graph_index.remove_device(instance.id)
+
+
+@receiver(post_save, sender=Link)
+def index_link(sender, instance, **kwargs):
+    graph_index.add_link(instance.id, instance.source_device_id, instance.target_device_id)
+
+
+@receiver(post_delete, sender=Link)
+def unindex_link(sender, instance, **kwargs):
+    graph_index.remove_link(instance.id)
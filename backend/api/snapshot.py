@@ -0,0 +1,471 @@
+"""
+Compact binary snapshots of the whole topology: devices with positions and
+icon hashes, links, and the last metrics with the time they were fetched.
+
+Layout (version 1, little-endian):
+
+    header      HEADER below, ending in a CRC-32 of everything after it
+    offsets     (strings + 1) x u32, end of each string in the blob
+    blob        UTF-8 strings, each stored once and referenced by index
+    devices     DEVICE records
+    links       LINK records
+    metrics     METRIC records
+
+Records are fixed width so a snapshot is read with struct.iter_unpack()
+straight off a memory map. Strings referenced as NONE are null.
+"""
+
+import hashlib
+import mmap
+import os
+import struct
+import time
+import zlib
+from datetime import datetime
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.db.models import Count, Max, Sum
+from django.urls import reverse
+from django.utils import timezone
+from .models import Device, Link, Icon
+from .cache import topology_cache
+from .collector import collector
+from .scopes import subscriptions
+
+
+MAGIC = b'NMSNAP\x00\x00'
+VERSION = 1
+NONE = 0xFFFFFFFF
+
+# magic, version, flags, created_at, metrics_at, string/device/link/metric
+# counts, the database fingerprint() (8 values) and the CRC-32
+HEADER = struct.Struct('<8sHHdd4I8dI')
+# id, name, type, ip, instance, site, rack, icon, icon_hash, x, y, is_monitored
+DEVICE = struct.Struct('<q8IiiB')
+# id, source, target, source_interface, target_interface, metric instance
+# and ifName, capacity
+LINK = struct.Struct('<qqq4Ii')
+# instance, ifName, inbound, outbound, fetched_at, stale
+METRIC = struct.Struct('<IIdddB')
+
+
+class SnapshotError(ValueError):
+    """Not a snapshot this version can read"""
+
+
+class StringTable:
+    def __init__(self):
+        self.index = {}
+
+    def add(self, value):
+        if value is None:
+            return NONE
+        if value not in self.index:
+            self.index[value] = len(self.index)
+        return self.index[value]
+
+    def pack(self):
+        encoded = [value.encode('utf-8') for value in self.index]
+        ends, end = [0], 0
+        for value in encoded:
+            end += len(value)
+            ends.append(end)
+        return struct.pack(f'<{len(ends)}I', *ends) + b''.join(encoded)
+
+
+def timestamp(value):
+    return value.timestamp() if value is not None else 0.0
+
+
+def positions_digest(rows):
+    """
+    Hash of (device id, x, y) rows as a float. Unlike sums it changes when
+    two devices swap places, and position writes do not touch updated_at.
+    """
+    digest = hashlib.blake2b(digest_size=8)
+    for device_id, x, y in sorted(rows):
+        digest.update(f'{device_id}:{x}:{y};'.encode())
+    return int.from_bytes(digest.digest(), 'little') / 2 ** 64
+
+
+def fingerprint():
+    """
+    Cheap summary of the Device and Link tables (two aggregates and the
+    device positions): counts, highest ids and update times, a positions
+    digest and the capacity sum. A snapshot whose fingerprint differs is
+    out of date.
+    """
+    devices = Device.objects.order_by().aggregate(count=Count('id'), last=Max('id'), updated=Max('updated_at'))
+    positions = Device.objects.order_by().values_list('id', 'position_x', 'position_y')
+    links = Link.objects.order_by().aggregate(
+        count=Count('id'), last=Max('id'), updated=Max('updated_at'), capacity=Sum('bandwidth_capacity')
+    )
+    return (
+        float(devices['count']), float(devices['last'] or 0), timestamp(devices['updated']),
+        positions_digest(positions),
+        float(links['count']), float(links['last'] or 0), timestamp(links['updated']),
+        float(links['capacity'] or 0)
+    )
+
+
+def fingerprint_of(devices, links):
+    """fingerprint() computed from rows already in memory"""
+    return (
+        float(len(devices)), float(max((d.id for d in devices), default=0)),
+        max((timestamp(d.updated_at) for d in devices), default=0.0),
+        positions_digest((d.id, d.position_x, d.position_y) for d in devices),
+        float(len(links)), float(max((link.id for link in links), default=0)),
+        max((timestamp(link.updated_at) for link in links), default=0.0),
+        float(sum(link.bandwidth_capacity for link in links))
+    )
+
+
+def encode(devices, links, metrics=None, metrics_at=None, created_at=None):
+    """
+    Pack Device and Link instances (links with their devices attached, for
+    metric_key) and a collector snapshot into bytes.
+    """
+    strings = StringTable()
+    add = strings.add
+    device_records = b''.join(
+        DEVICE.pack(
+            device.id, add(device.name), add(device.device_type), add(device.ip_address),
+            add(device.prometheus_instance), add(device.site), add(device.rack), add(device.icon),
+            add(device.icon_hash), device.position_x, device.position_y, device.is_monitored
+        )
+        for device in devices
+    )
+    link_records = []
+    for link in links:
+        instance, if_name = link.metric_key or (None, None)
+        link_records.append(LINK.pack(
+            link.id, link.source_device_id, link.target_device_id, add(link.source_interface),
+            add(link.target_interface), add(instance), add(if_name), link.bandwidth_capacity
+        ))
+    metrics = metrics or {}
+    metric_records = b''.join(
+        METRIC.pack(
+            add(instance), add(if_name), values.get('inbound', 0.0), values.get('outbound', 0.0),
+            values.get('fetched_at', 0.0), values.get('stale', False)
+        )
+        for (instance, if_name), values in metrics.items()
+    )
+
+    body = strings.pack() + device_records + b''.join(link_records) + metric_records
+    header = HEADER.pack(
+        MAGIC, VERSION, 0, created_at or time.time(), metrics_at or 0.0,
+        len(strings.index), len(devices), len(link_records), len(metrics),
+        *fingerprint_of(devices, links), zlib.crc32(body)
+    )
+    return header + body
+
+
+class TopologySnapshot:
+    """A decoded snapshot"""
+
+    def __init__(self, created_at, metrics_at, fingerprint, devices, links, metrics):
+        self.created_at = created_at
+        self.metrics_at = metrics_at
+        self.fingerprint = fingerprint
+        # Tuples in DEVICE and LINK field order, strings resolved
+        self.devices = devices
+        self.links = links
+        self.metrics = metrics
+
+    def structure(self):
+        """(nodes, edges) in the shape of views.get_topology_structure()"""
+        icon_urls = {}
+        nodes = []
+        for device_id, name, device_type, ip, instance, site, rack, icon, icon_hash, x, y, monitored in self.devices:
+            if icon_hash and icon_hash not in icon_urls:
+                icon_urls[icon_hash] = reverse('get_icon', args=[icon_hash])
+            nodes.append({
+                'id': device_id,
+                'label': name,
+                'type': device_type,
+                'ip': ip,
+                'is_monitored': monitored,
+                'prometheus_instance': instance,
+                'site': site,
+                'rack': rack,
+                'icon': icon,
+                'icon_url': icon_urls.get(icon_hash),
+                'position': {'x': x, 'y': y}
+            })
+        # Link.metric_side: the source reports unless it is not monitored
+        reports = {device[0] for device in self.devices if device[11] and device[4]}
+        edges = [
+            {
+                'id': link_id,
+                'source': source,
+                'target': target,
+                'source_interface': source_interface,
+                'target_interface': target_interface,
+                'capacity': capacity,
+                'metric_key': (instance, if_name) if instance is not None else None,
+                'metric_side': None if instance is None else 'source' if source in reports else 'target'
+            }
+            for link_id, source, target, source_interface, target_interface, instance, if_name, capacity
+            in self.links
+        ]
+        return nodes, edges
+
+    def stale_metrics(self):
+        """The metrics as a collector snapshot, all marked stale"""
+        return {key: dict(values, stale=True) for key, values in self.metrics.items()}
+
+
+def decode(buffer):
+    """Read a snapshot from bytes, a memoryview or a memory map"""
+    view = memoryview(buffer)
+    if len(view) < HEADER.size or bytes(view[:len(MAGIC)]) != MAGIC:
+        raise SnapshotError('Not a NetMap snapshot')
+    header = HEADER.unpack_from(view)
+    version = header[1]
+    if version != VERSION:
+        raise SnapshotError(f'Unsupported snapshot version {version}')
+    created_at, metrics_at = header[3], header[4]
+    string_count, device_count, link_count, metric_count = header[5:9]
+    fingerprint, crc = tuple(header[9:17]), header[17]
+    if zlib.crc32(view[HEADER.size:]) != crc:
+        raise SnapshotError('Snapshot is corrupt (checksum mismatch)')
+
+    position = HEADER.size
+    try:
+        ends = struct.unpack_from(f'<{string_count + 1}I', view, position)
+        position += 4 * (string_count + 1)
+        blob = bytes(view[position:position + ends[-1]])
+        position += ends[-1]
+        strings = [blob[ends[i]:ends[i + 1]].decode('utf-8') for i in range(string_count)]
+
+        def string(i):
+            return None if i == NONE else strings[i]
+
+        def records(record, count):
+            nonlocal position
+            end = position + record.size * count
+            if end > len(view):
+                raise SnapshotError('Snapshot is truncated')
+            chunk = view[position:end]
+            position = end
+            return record.iter_unpack(chunk)
+
+        devices = [
+            (device_id, *map(string, refs), x, y, bool(monitored))
+            for device_id, *refs, x, y, monitored in records(DEVICE, device_count)
+        ]
+        links = [
+            (link_id, source, target, *map(string, refs), capacity)
+            for link_id, source, target, *refs, capacity in records(LINK, link_count)
+        ]
+        metrics = {}
+        for instance, if_name, inbound, outbound, fetched_at, stale in records(METRIC, metric_count):
+            metrics[(string(instance), string(if_name))] = {
+                'inbound': inbound,
+                'outbound': outbound,
+                'timestamp': datetime.fromtimestamp(fetched_at).isoformat(),
+                'fetched_at': fetched_at,
+                'stale': bool(stale)
+            }
+    except (struct.error, IndexError, UnicodeDecodeError) as e:
+        raise SnapshotError(f'Snapshot is corrupt: {e}')
+    return TopologySnapshot(created_at, metrics_at, fingerprint, devices, links, metrics)
+
+
+def capture():
+    """Snapshot the database as it is now, with the collector's latest metrics (no refresh)"""
+    metrics, metrics_at = collector.latest()
+    with transaction.atomic():
+        devices = list(Device.objects.all())
+        links = list(Link.objects.all())
+    by_id = {device.id: device for device in devices}
+    for link in links:
+        link.source_device = by_id[link.source_device_id]
+        link.target_device = by_id[link.target_device_id]
+    return encode(devices, links, metrics, metrics_at)
+
+
+def write(path, data):
+    """Replace the file at `path` atomically"""
+    temporary = f'{path}.tmp'
+    with open(temporary, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary, path)
+
+
+def load(path):
+    """Decode the snapshot at `path` through a memory map, or None if there is none"""
+    try:
+        with open(path, 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                with memoryview(mapped) as view:
+                    return decode(view)
+    except FileNotFoundError:
+        return None
+    except ValueError as e:
+        # Also raised by mmap for empty files
+        raise SnapshotError(str(e))
+
+
+def restore(snapshot, dry_run=False):
+    """
+    Make the Device and Link tables match `snapshot`, keeping its ids: rows
+    missing from it are deleted, the others created or updated with bulk
+    queries. Icon hashes without a stored Icon are dropped.
+    Returns counts of what changed.
+    """
+    hashes = {device[8] for device in snapshot.devices if device[8]}
+    icons = set(Icon.objects.filter(hash__in=hashes).values_list('hash', flat=True)) if hashes else set()
+    now = timezone.now()
+    fields = ['name', 'device_type', 'ip_address', 'prometheus_instance', 'site', 'rack',
+              'icon', 'icon_hash', 'position_x', 'position_y', 'is_monitored']
+    devices = {
+        device_id: Device(
+            id=device_id, name=name, device_type=device_type, ip_address=ip, prometheus_instance=instance,
+            site=site, rack=rack, icon=icon, icon_hash=icon_hash if icon_hash in icons else '',
+            position_x=x, position_y=y, is_monitored=monitored, updated_at=now
+        )
+        for device_id, name, device_type, ip, instance, site, rack, icon, icon_hash, x, y, monitored
+        in snapshot.devices
+    }
+    link_fields = ['source_device_id', 'target_device_id', 'source_interface', 'target_interface',
+                   'bandwidth_capacity']
+    links = {
+        link_id: Link(
+            id=link_id, source_device_id=source, target_device_id=target, source_interface=source_interface,
+            target_interface=target_interface, bandwidth_capacity=capacity, updated_at=now
+        )
+        for link_id, source, target, source_interface, target_interface, _, _, capacity in snapshot.links
+    }
+
+    with transaction.atomic():
+        current_devices = {row[0]: row[1:] for row in Device.objects.order_by().values_list('id', *fields)}
+        current_links = {row[0]: row[1:] for row in Link.objects.order_by().values_list('id', *link_fields)}
+        deleted_devices = current_devices.keys() - devices.keys()
+        deleted_links = current_links.keys() - links.keys()
+        # Links still attached to a deleted device go with it in the cascade,
+        # so any of their ids in the snapshot must be created again
+        kept_links = {
+            link_id: row for link_id, row in current_links.items()
+            if row[0] not in deleted_devices and row[1] not in deleted_devices
+        }
+        changed_devices = [
+            device for device_id, device in devices.items()
+            if device_id in current_devices
+            and current_devices[device_id] != tuple(getattr(device, field) for field in fields)
+        ]
+        changed_links = [
+            link for link_id, link in links.items()
+            if link_id in kept_links
+            and kept_links[link_id] != tuple(getattr(link, field) for field in link_fields)
+        ]
+        counts = {
+            'devices': {
+                'create': len(devices.keys() - current_devices.keys()),
+                'update': len(changed_devices),
+                'delete': len(deleted_devices)
+            },
+            'links': {
+                'create': len(links.keys() - kept_links.keys()),
+                'update': len(changed_links),
+                'delete': len(deleted_links)
+            }
+        }
+        if dry_run:
+            return counts
+
+        # Deletes first so names and link endpoints they held can be reused
+        Link.objects.filter(id__in=deleted_links).delete()
+        Device.objects.filter(id__in=deleted_devices).delete()
+        Device.objects.bulk_update(changed_devices, fields + ['updated_at'], batch_size=500)
+        Device.objects.bulk_create(
+            [devices[device_id] for device_id in devices.keys() - current_devices.keys()], batch_size=1000
+        )
+        Link.objects.bulk_update(
+            changed_links, ['source_device', 'target_device', 'source_interface', 'target_interface',
+                            'bandwidth_capacity', 'updated_at'], batch_size=500
+        )
+        Link.objects.bulk_create([links[link_id] for link_id in links.keys() - kept_links.keys()], batch_size=1000)
+        # Rows were inserted with explicit ids, move sequences (PostgreSQL) past them
+        with connection.cursor() as cursor:
+            for sql in connection.ops.sequence_reset_sql(no_style(), [Device, Link]):
+                cursor.execute(sql)
+    return counts
+
+
+class SnapshotWriter:
+    """
+    Keeps the on-disk snapshot at `path` current, rewriting it after a
+    metrics refresh at most every `interval` seconds, and reads it back once
+    on startup so the first clients get a warm, stale-marked topology before
+    Prometheus has been queried or the topology built from the database.
+    Checking that the snapshot is current still reads fingerprint(), which
+    scans every device's position.
+    """
+
+    def __init__(self, path, interval=300):
+        self.path = path
+        self.interval = interval
+        self._written_at = None
+        self._started = False
+
+    def warm_start(self):
+        """
+        Seed the topology cache and the collector from the snapshot, unless
+        the database changed since it was written (three queries, one over
+        all device positions). Returns True if seeded.
+        """
+        if not self.path:
+            return False
+        try:
+            snapshot = load(self.path)
+        except SnapshotError as e:
+            print(f"Ignoring topology snapshot {self.path}: {e}")
+            return False
+        if snapshot is None:
+            return False
+        if snapshot.fingerprint != fingerprint():
+            print(f"Ignoring topology snapshot {self.path}: the database changed since it was written")
+            return False
+        topology_cache.get(snapshot.structure)
+        collector.seed(snapshot.stale_metrics(), snapshot.metrics_at or None)
+        return True
+
+    async def astart(self):
+        """warm_start() once, when the server starts (see BackgroundServicesMiddleware)"""
+        if self._started:
+            return
+        self._started = True
+        if self.path:
+            # Snapshots hold metrics for every link
+            subscriptions.read()
+        try:
+            await database_sync_to_async(self.warm_start)()
+        except Exception as e:
+            print(f"Topology snapshot warm start failed: {e}")
+
+    def save(self):
+        """Write the current topology and metrics, returning the size in bytes"""
+        data = capture()
+        write(self.path, data)
+        self._written_at = time.monotonic()
+        return len(data)
+
+    async def on_refresh(self):
+        """Collector listener"""
+        if not self.path:
+            return
+        subscriptions.read()
+        if self._written_at is not None and time.monotonic() - self._written_at < self.interval:
+            return
+        try:
+            await database_sync_to_async(self.save)()
+        except (OSError, SnapshotError) as e:
+            print(f"Could not write topology snapshot {self.path}: {e}")
+
+
+snapshot_writer = SnapshotWriter(settings.TOPOLOGY_SNAPSHOT_PATH, settings.TOPOLOGY_SNAPSHOT_INTERVAL)
@@ -0,0 +1,178 @@
+import json
+import math
+import re
+import threading
+import time
+import zlib
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from .models import Device, Link
+from .cache import topology_cache
+from .graph import graph_index
+
+# Interfaces per synthetic device; each device links to this many neighbours
+LINKS_PER_DEVICE = 4
+
+
+def generate_topology(links, links_per_device=LINKS_PER_DEVICE, prefix='bench'):
+    """
+    Create a synthetic topology with the given number of links (and about
+    links / links_per_device monitored devices laid out on a grid).
+    Returns the set of (instance, ifName) pairs that report bandwidth.
+    """
+    devices = max(2, math.ceil(links / links_per_device))
+    links_per_device = min(links_per_device, devices - 1)
+    columns = math.ceil(math.sqrt(devices))
+
+    created = Device.objects.bulk_create([
+        Device(
+            name=f'{prefix}-{i}',
+            device_type='switch',
+            ip_address=f'10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}',
+            prometheus_instance=f'{prefix}-{i}:9116',
+            position_x=(i % columns) * 150,
+            position_y=(i // columns) * 150,
+        )
+        for i in range(devices)
+    ], batch_size=1000)
+
+    Link.objects.bulk_create([
+        Link(
+            source_device=created[n // links_per_device],
+            target_device=created[(n // links_per_device + n % links_per_device + 1) % devices],
+            source_interface=f'ge-0/0/{n % links_per_device}',
+            target_interface=f'ge-0/1/{n % links_per_device}',
+            bandwidth_capacity=10000,
+        )
+        for n in range(links)
+    ], batch_size=1000)
+    topology_cache.invalidate()
+    graph_index.reload()
+
+    return {
+        (f'{prefix}-{n // links_per_device}:9116', f'ge-0/0/{n % links_per_device}')
+        for n in range(links)
+    }
+
+
+def synthetic_rate(instance, interface, direction):
+    """Deterministic bandwidth in Mbps for a series"""
+    return zlib.crc32(f'{instance}|{interface}|{direction}'.encode()) % 100000 / 10
+
+
+class StubPrometheus:
+    """
+    Local stand-in for the Prometheus HTTP API. Answers the rate queries
+    NetMap sends (query and query_range) with deterministic values for the
+    known (instance, ifName) pairs, after `latency` seconds.
+
+        with StubPrometheus(pairs, latency=0.02) as prometheus:
+            client = PrometheusClient(prometheus.url)
+    """
+
+    def __init__(self, pairs, latency=0.0, host='127.0.0.1', port=0):
+        self.pairs = set(pairs)
+        self.latency = latency
+        self.requests = 0
+        self._by_instance = {}
+        for instance, interface in self.pairs:
+            self._by_instance.setdefault(instance, set()).add(interface)
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name='stub-prometheus', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                params = {key: values[0] for key, values in parse_qs(url.query).items()}
+                stub.requests += 1
+                if stub.latency:
+                    time.sleep(stub.latency)
+
+                if url.path == '/api/v1/query':
+                    body = stub.vector(params.get('query', ''))
+                elif url.path == '/api/v1/query_range':
+                    body = stub.matrix(params.get('query', ''), params)
+                else:
+                    self.send_error(404)
+                    return
+
+                data = json.dumps({'status': 'success', 'data': body}).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def matching(self, query):
+        """Known pairs selected by the instance/ifName matchers of a query"""
+        instances = _alternatives(query, 'instance')
+        interfaces = _alternatives(query, 'ifName')
+        return [
+            (instance, interface)
+            for instance in instances & self._by_instance.keys()
+            for interface in self._by_instance[instance] & interfaces
+        ]
+
+    def vector(self, query):
+        direction = 'in' if 'InOctets' in query else 'out'
+        now = time.time()
+        return {'resultType': 'vector', 'result': [
+            {
+                'metric': {'instance': instance, 'ifName': interface},
+                'value': [now, str(synthetic_rate(instance, interface, direction))]
+            }
+            for instance, interface in self.matching(query)
+        ]}
+
+    def matrix(self, query, params):
+        direction = 'in' if 'InOctets' in query else 'out'
+        start, end, step = float(params['start']), float(params['end']), float(params['step'])
+        times = [start + i * step for i in range(int((end - start) // step) + 1)]
+        result = []
+        for instance, interface in self.matching(query):
+            base = synthetic_rate(instance, interface, direction)
+            result.append({
+                'metric': {'instance': instance, 'ifName': interface},
+                'values': [[t, str(round(base * (1 + math.sin(t / 3600) / 2), 2))] for t in times]
+            })
+        return {'resultType': 'matrix', 'result': result}
+
+
+def _alternatives(query, label):
+    """Values of an exact or regex alternation matcher such as ifName=~"a|b" """
+    match = re.search(rf'{label}=~?"((?:[^"\\]|\\.)*)"', query)
+    if not match:
+        return set()
+    # Undo PromQL string escaping (as in JSON for \\ and \"), split on unescaped |, undo RE2 escaping
+    pattern = json.loads(f'"{match.group(1)}"')
+    values = re.findall(r'(?:\\.|[^\\|])+', pattern)
+    return {re.sub(r'\\(.)', r'\1', value) for value in values}
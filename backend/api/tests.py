@@ -1,3 +1,1710 @@
-from django.test import TestCase
+import asyncio
+import gzip
+import inspect
+import json
+import math
+import random
+import re
+import threading
+import zlib
+from collections import deque
+from unittest import addModuleCleanup, mock, skipUnless
+import msgpack
+import requests
+from asgiref.sync import sync_to_async
+from channels.testing import WebsocketCommunicator
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from .models import ChannelMessage, Device, Link
+from .cache import topology_cache
+from .changelog import TopologyLog, topology_log
+from .collector import collector
+from .consumers import Mailbox, TopologyConsumer
+from .encoding import (
+    available_encodings, brotli, compress_body, encode_frames, encodings_in_use, frame_for, negotiate, release
+)
+from . import importer, layout
+from .broadcast import BroadcastScheduler
+from .aggregate import collapse_topology
+from .graph import graph_index
+from .history import NAN, BandwidthHistory, lttb
+from .instrumentation import Counter
+from .layers import DatabaseChannelLayer
+from .middleware import BackgroundServicesMiddleware
+from . import snapshot
+from .notices import TopologyNotices, POSITIONS
+from .scopes import Subscriptions
+from .synthetic import StubPrometheus, _alternatives, synthetic_rate
+from .positions import PositionStream, position_stream
+from .async_prometheus_client import AsyncPrometheusClient
+from .prometheus_client import CircuitBreaker, PrometheusClient, PrometheusUnavailable
+from .views import (
+    aget_topology_data, apublish_topology, broadcast_scheduler, downsample, get_topology_data, get_topology_structure,
+    parse_duration
+)
 
-# Create your tests here.
+
+def setUpModule():
+    # Broadcast in the thread that changed the topology, rather than on a
+    # timer thread that may outlive the test and its database
+    patcher = mock.patch.object(broadcast_scheduler, 'window', 0)
+    patcher.start()
+    addModuleCleanup(patcher.stop)
+
+
+def make_topology(devices=10, links_per_device=3):
+    """Create a ring-ish topology with the given number of devices"""
+    created = Device.objects.bulk_create([
+        Device(
+            name=f'dev-{i}',
+            device_type='switch',
+            ip_address=f'10.0.{i // 256}.{i % 256}',
+            prometheus_instance=f'10.0.{i // 256}.{i % 256}',
+        )
+        for i in range(devices)
+    ])
+    Link.objects.bulk_create([
+        Link(
+            source_device=created[i],
+            target_device=created[(i + j + 1) % devices],
+            source_interface=f'ge-0/0/{j}',
+            target_interface=f'ge-0/1/{j}',
+            bandwidth_capacity=1000,
+        )
+        for i in range(devices)
+        for j in range(links_per_device)
+    ])
+    topology_cache.invalidate()
+
+
+@mock.patch('api.views.collector.get_snapshot', return_value={})
+class TopologyQueryCountTests(TestCase):
+    """Building the topology must not scale with the number of links"""
+
+    def setUp(self):
+        topology_cache.invalidate()
+
+    def test_structure_uses_constant_queries(self, _snapshot):
+        make_topology(devices=5)
+        with self.assertNumQueries(2):
+            get_topology_structure()
+
+        Device.objects.all().delete()
+        make_topology(devices=50)
+        with self.assertNumQueries(2):
+            nodes, edges = get_topology_structure()
+        self.assertEqual(len(nodes), 50)
+        self.assertEqual(len(edges), 150)
+
+    def test_cached_structure_needs_no_queries(self, _snapshot):
+        make_topology(devices=20)
+        get_topology_data()
+        with self.assertNumQueries(0):
+            data = get_topology_data()
+        self.assertEqual(len(data['edges']), 60)
+
+    def test_save_and_delete_invalidate_cache(self, _snapshot):
+        make_topology(devices=4)
+        get_topology_data()
+
+        device = Device.objects.first()
+        device.position_x = 123
+        device.save()
+        with self.assertNumQueries(2):
+            data = get_topology_data()
+        node = next(n for n in data['nodes'] if n['id'] == device.id)
+        self.assertEqual(node['position']['x'], 123)
+
+        Link.objects.first().delete()
+        data = get_topology_data()
+        self.assertEqual(len(data['edges']), 11)
+
+    def test_topology_endpoint_query_count(self, _snapshot):
+        make_topology(devices=30)
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse('get_topology'))
+        self.assertEqual(response.status_code, 200)
+
+    def test_unchanged_poll_does_not_rebuild(self, _snapshot):
+        make_topology(devices=10)
+        etag = self.client.get(reverse('get_topology'))['ETag']
+        with mock.patch('api.views.apply_metrics') as apply_metrics, self.assertNumQueries(0):
+            response = self.client.get(reverse('get_topology'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        apply_metrics.assert_not_called()
+
+        # A change is picked up by the next poll
+        Device.objects.filter(name='dev-0').update(position_x=50)
+        topology_cache.invalidate()
+        response = self.client.get(reverse('get_topology'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_list_links_query_count(self, _snapshot):
+        make_topology(devices=30)
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('list_links'))
+        self.assertEqual(len(response.json()), 90)
+        self.assertEqual(response.json()[0]['source_device_name'], 'dev-0')
+
+
+@mock.patch('api.views.schedule_topology_update')
+class BulkQueryCountTests(TestCase):
+    """Bulk endpoints validate whole batches, not one query per item"""
+
+    def post(self, name, items, method='post'):
+        return getattr(self.client, method)(reverse(name), items, content_type='application/json')
+
+    def link_items(self, count):
+        devices = list(Device.objects.values_list('id', flat=True))
+        return [
+            {'source_device': devices[i % len(devices)], 'target_device': devices[(i + 1) % len(devices)],
+             'source_interface': f'ge-0/0/{i}', 'target_interface': f'ge-0/1/{i}', 'bandwidth_capacity': 1000}
+            for i in range(count)
+        ]
+
+    def test_create_uses_constant_queries(self, _schedule):
+        for count in (5, 50):
+            Device.objects.all().delete()
+            items = [{'name': f'dev-{i}', 'device_type': 'switch', 'ip_address': '10.0.0.1'} for i in range(count)]
+            # Name check, then the insert in a savepoint
+            with self.assertNumQueries(4):
+                self.assertEqual(self.post('bulk_devices', items).status_code, 201)
+            links = self.link_items(count)
+            # Endpoints and unique_together checks, then the insert
+            with self.assertNumQueries(5):
+                self.assertEqual(self.post('bulk_links', links).status_code, 201)
+
+    def test_batch_validation_errors(self, _schedule):
+        make_topology(devices=3, links_per_device=1)
+        items = self.link_items(1) + [dict(self.link_items(2)[1], source_device=999)]
+        errors = self.post('bulk_links', items).json()['errors']
+        self.assertEqual([error['index'] for error in errors], [0, 1])
+        self.assertIn('non_field_errors', errors[0]['errors'])
+        self.assertIn('source_device', errors[1]['errors'])
+
+        response = self.post('bulk_devices', [{'name': 'dev-1', 'device_type': 'switch', 'ip_address': '10.0.0.1'}])
+        self.assertIn('name', response.json()['errors'][0]['errors'])
+
+    def test_duplicate_ids_are_reported(self, _schedule):
+        make_topology(devices=2, links_per_device=1)
+        device = Device.objects.first()
+        for name, item in (('bulk_devices', {'id': device.id, 'site': 'a'}),
+                           ('bulk_update_positions', {'id': device.id, 'x': 1, 'y': 2})):
+            method = 'put' if name == 'bulk_devices' else 'post'
+            response = self.post(name, [item, item], method)
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.json()['errors'][0]['index'], 1)
+
+
+def selector_patterns(selector):
+    """The instance and ifName regexes of a selector, PromQL string escaping undone"""
+    return [json.loads(f'"{value}"') for value in re.findall(r'=~"((?:[^"\\]|\\.)*)"', selector)]
+
+
+class BulkQueryTests(SimpleTestCase):
+    """Bulk queries select many interfaces with regex matchers, split to stay under URL limits"""
+
+    TRICKY = [
+        ('10.0.0.1:9116', 'ge-0/0/1.100'),
+        ('10.0.0.1:9116', 'lag|1'),
+        ('10.0.0.2:9116', 'say "hi"'),
+        ('10.0.0.2:9116', 'C:\\port'),
+        ('10.0.0.3:9116', 'trailing\\'),
+        ('[::1]:9116', 'Gi1/0/1+(x)'),
+    ]
+
+    def test_chunks_stay_under_selector_limit(self):
+        client = PrometheusClient('http://prometheus.invalid', max_selector_length=120)
+        pairs = {(f'10.0.{i}.1:9116', f'ge-0/0/{j}') for i in range(30) for j in range(6)}
+        pairs.add(('10.0.99.1:9116', 'x' * 200))
+        chunks = list(client._chunk_selectors(pairs))
+
+        self.assertGreater(len(chunks), 5)
+        self.assertEqual(set().union(*(chunk for _, chunk in chunks)), pairs)
+        self.assertEqual(sum(len(chunk) for _, chunk in chunks), len(pairs))
+        for selector, chunk in chunks:
+            instance_re, interface_re = selector.split(', ')
+            length = len(instance_re) + len(interface_re) - len('instance=~""ifName=~""') + 2
+            # A single pair longer than the limit still gets a chunk of its own
+            self.assertTrue(length <= 120 or len(chunk) == 1, selector)
+
+    def test_metacharacters_are_escaped(self):
+        client = PrometheusClient('http://prometheus.invalid')
+        (selector, chunk), = client._chunk_selectors(self.TRICKY)
+        instance_re, interface_re = selector_patterns(selector)
+        for instance, interface in self.TRICKY:
+            self.assertRegex(instance, f'^(?:{instance_re})$')
+            self.assertRegex(interface, f'^(?:{interface_re})$')
+        for near_miss in ('ge-0/0/1x100', 'lag', '1', 'C:port', 'Gi1/0/11(x)'):
+            self.assertNotRegex(near_miss, f'^(?:{interface_re})$')
+        self.assertNotRegex('10.0.0.19116', f'^(?:{instance_re})$')
+
+        self.assertEqual(_alternatives(selector, 'instance'), {instance for instance, _ in self.TRICKY})
+        self.assertEqual(_alternatives(selector, 'ifName'), {interface for _, interface in self.TRICKY})
+
+    def test_bulk_bandwidth_through_stub(self):
+        pairs = set(self.TRICKY) | {(f'10.1.{i}.1:9116', f'xe-0/0/{i}') for i in range(40)}
+        # Served but not requested: the regex cross product must not leak them
+        served = pairs | {('10.0.0.1:9116', 'C:\\port'), ('10.1.0.1:9116', 'xe-0/0/1')}
+        with StubPrometheus(served) as prometheus:
+            client = PrometheusClient(prometheus.url, max_selector_length=200)
+            chunks = len(list(client._chunk_selectors(pairs)))
+            results = client.get_bulk_interface_bandwidth(pairs)
+            requests = prometheus.requests
+
+        self.assertGreater(chunks, 1)
+        self.assertEqual(requests, chunks * 2)
+        self.assertEqual(results.keys(), pairs)
+        for (instance, interface), metrics in results.items():
+            self.assertEqual(metrics['inbound'], round(synthetic_rate(instance, interface, 'in'), 2))
+            self.assertEqual(metrics['outbound'], round(synthetic_rate(instance, interface, 'out'), 2))
+
+
+def prometheus_response(status_code=200, result=()):
+    response = mock.Mock(status_code=status_code, text='bad_data: parse error')
+    response.json.return_value = {'status': 'success', 'data': {'result': list(result)}}
+    if status_code >= 500:
+        response.raise_for_status.side_effect = requests.HTTPError(response=response)
+    return response
+
+
+@mock.patch('api.prometheus_client.time.sleep')
+class PrometheusResilienceTests(SimpleTestCase):
+    def prometheus(self, *responses, **kwargs):
+        client = PrometheusClient('http://prometheus.invalid', **kwargs)
+        client.session = mock.Mock()
+        client.session.get.side_effect = responses
+        return client
+
+    def test_retries_with_backoff(self, sleep):
+        client = self.prometheus(requests.ConnectionError(), prometheus_response(503), prometheus_response(), retries=2)
+        self.assertEqual(client._fetch('up'), {'status': 'success', 'data': {'result': []}})
+        self.assertEqual(client.session.get.call_count, 3)
+        self.assertEqual([c.args for c in sleep.call_args_list], [(0.2,), (0.4,)])
+        self.assertEqual(client.breaker._failures, 0)
+
+    def test_gives_up_after_retries(self, sleep):
+        client = self.prometheus(*[requests.Timeout()] * 3, retries=2)
+        with self.assertRaises(PrometheusUnavailable):
+            client._fetch('up')
+        self.assertEqual(client.session.get.call_count, 3)
+        # One failed query is one failure, however many attempts it took
+        self.assertEqual(client.breaker._failures, 1)
+
+    def test_client_errors_are_not_retried(self, sleep):
+        client = self.prometheus(prometheus_response(400), retries=2)
+        with self.assertRaisesRegex(PrometheusUnavailable, 'HTTP 400'):
+            client._fetch('rate(')
+        self.assertEqual(client.session.get.call_count, 1)
+        sleep.assert_not_called()
+        self.assertEqual(client.breaker._failures, 0)
+
+    def test_breaker_opens_and_half_opens(self, sleep):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+        client = self.prometheus(*[requests.ConnectionError()] * 3, prometheus_response(), retries=0, breaker=breaker)
+        with mock.patch('api.prometheus_client.time.monotonic', return_value=1000):
+            for _ in range(2):
+                with self.assertRaises(PrometheusUnavailable):
+                    client._fetch('up')
+            self.assertTrue(breaker.is_open)
+            with self.assertRaisesRegex(PrometheusUnavailable, 'circuit breaker open'):
+                client._fetch('up')
+            self.assertEqual(client.session.get.call_count, 2)
+
+        with mock.patch('api.prometheus_client.time.monotonic', return_value=1031):
+            # One trial call; while it is in flight everything else is rejected
+            self.assertTrue(breaker.allow())
+            self.assertFalse(breaker.allow())
+            breaker.release()
+            # A failed trial opens the breaker again straight away
+            with self.assertRaises(PrometheusUnavailable):
+                client._fetch('up')
+            self.assertTrue(breaker.is_open)
+
+        with mock.patch('api.prometheus_client.time.monotonic', return_value=1062):
+            client._fetch('up')
+            self.assertFalse(breaker.is_open)
+            self.assertTrue(breaker.allow())
+
+    def test_deadline_bounds_attempts(self, sleep):
+        clock = [1000.0]
+
+        def slow_failure(*args, timeout, **kwargs):
+            clock[0] += timeout
+            raise requests.Timeout()
+
+        client = self.prometheus(prometheus_response(), timeout=10, retries=3)
+        sleep.side_effect = lambda seconds: clock.__setitem__(0, clock[0] + seconds)
+        with mock.patch('api.prometheus_client.time.monotonic', side_effect=lambda: clock[0]):
+            with client.deadline(2.5):
+                client._fetch('up')
+                self.assertEqual(client.session.get.call_args.kwargs['timeout'], 2.5)
+
+            client.session.get.side_effect = slow_failure
+            with client.deadline(0.5):
+                with self.assertRaisesRegex(PrometheusUnavailable, 'deadline'):
+                    client._fetch('up')
+        # The first attempt spent the budget: no backoff, no second attempt
+        self.assertEqual(client.session.get.call_count, 2)
+        sleep.assert_not_called()
+        # Running out of our own budget is not a Prometheus failure
+        self.assertEqual(client.breaker._failures, 0)
+        self.assertFalse(client.breaker.is_open)
+
+    def test_stale_values_for_failed_chunks(self, sleep):
+        sample = {'metric': {'instance': 'r1', 'ifName': 'ge-0/0/1'}, 'value': [0, '12.5']}
+        client = self.prometheus(
+            prometheus_response(result=[sample]), prometheus_response(result=[sample]),
+            *[requests.ConnectionError()] * 2,
+            retries=0, last_known_size=1
+        )
+        fresh = client.get_bulk_interface_bandwidth({('r1', 'ge-0/0/1')})
+        self.assertFalse(fresh[('r1', 'ge-0/0/1')]['stale'])
+        stale = client.get_bulk_interface_bandwidth({('r1', 'ge-0/0/1')})
+        self.assertEqual(stale[('r1', 'ge-0/0/1')]['inbound'], 12.5)
+        self.assertTrue(stale[('r1', 'ge-0/0/1')]['stale'])
+
+    def test_last_known_is_bounded(self, sleep):
+        samples = [{'metric': {'instance': 'r1', 'ifName': f'ge-0/0/{i}'}, 'value': [0, '1']} for i in range(5)]
+        client = self.prometheus(prometheus_response(result=samples), prometheus_response(result=samples), last_known_size=3)
+        client.get_bulk_interface_bandwidth({('r1', f'ge-0/0/{i}') for i in range(5)})
+        self.assertEqual(len(client._last_known), 3)
+
+
+class AsyncClientTests(SimpleTestCase):
+    PAIRS = {(f'10.0.0.{i}:9116', f'ge-0/0/{j}') for i in range(1, 4) for j in range(3)}
+
+    def test_every_query_is_a_coroutine(self):
+        names = [name for name in dir(PrometheusClient) if name == 'query' or name.startswith('get_')]
+        self.assertIn('get_bulk_interface_history', names)
+        for name in names:
+            self.assertTrue(inspect.iscoroutinefunction(getattr(AsyncPrometheusClient, name)), name)
+
+    async def test_same_results_as_sync_client(self):
+        with StubPrometheus(self.PAIRS) as prometheus:
+            sync_client = PrometheusClient(prometheus.url, max_selector_length=60)
+            async_client = AsyncPrometheusClient(prometheus.url, max_selector_length=60)
+            try:
+                for method, args in (
+                    ('get_bulk_interface_history', (self.PAIRS, 1000, 4600, 600)),
+                    ('get_bulk_interface_speed', (self.PAIRS,)),
+                    ('get_lldp_neighbors', ()),
+                    ('get_interface_bandwidth', ('10.0.0.1:9116', 'ge-0/0/1')),
+                ):
+                    expected = await sync_to_async(getattr(sync_client, method))(*args)
+                    result = await getattr(async_client, method)(*args)
+                    if method == 'get_interface_bandwidth':
+                        expected.pop('timestamp'), result.pop('timestamp')
+                    self.assertEqual(result, expected, method)
+                self.assertEqual(
+                    (await async_client.get_bulk_interface_history(self.PAIRS, 1000, 4600, 600)).keys(), self.PAIRS
+                )
+            finally:
+                await async_client.aclose()
+
+
+class BroadcastSchedulerTests(SimpleTestCase):
+    def scheduler(self, window=0.05, max_delay=0.3):
+        self.runs = []
+
+        async def rebuild():
+            self.runs.append(asyncio.get_running_loop().time())
+
+        scheduler = BroadcastScheduler(rebuild, lambda: self.runs.append(None), window=window, max_delay=max_delay)
+        self.addCleanup(scheduler.drain)
+        return scheduler
+
+    async def test_burst_is_one_rebuild(self):
+        scheduler = self.scheduler()
+        scheduler.bind_loop(asyncio.get_running_loop())
+        for _ in range(5):
+            scheduler.mark_dirty()
+        # Armed on the loop, even when marked from other threads
+        await asyncio.sleep(0)
+        self.assertFalse(scheduler.idle)
+        await asyncio.sleep(0.2)
+        self.assertEqual(len(self.runs), 1)
+        self.assertTrue(scheduler.idle)
+
+    async def test_steady_changes_wait_at_most_max_delay(self):
+        scheduler = self.scheduler(window=0.1, max_delay=0.3)
+        loop = asyncio.get_running_loop()
+        scheduler.bind_loop(loop)
+        started = loop.time()
+        while loop.time() - started < 0.5:
+            scheduler.mark_dirty()
+            await asyncio.sleep(0.02)
+        # Each call pushed the timer back, but not past max_delay
+        self.assertTrue(self.runs)
+        self.assertAlmostEqual(self.runs[0] - started, 0.3, delta=0.1)
+
+    async def test_change_during_rebuild_runs_again(self):
+        scheduler = self.scheduler(window=0.01)
+        scheduler.bind_loop(asyncio.get_running_loop())
+
+        async def rebuild():
+            self.runs.append(len(self.runs))
+            if len(self.runs) == 1:
+                scheduler.mark_dirty()
+                await asyncio.sleep(0.05)
+
+        scheduler.async_callback = rebuild
+        scheduler.mark_dirty()
+        await asyncio.sleep(0.2)
+        self.assertEqual(self.runs, [0, 1])
+        self.assertTrue(scheduler.idle)
+
+    def test_without_loop_drains_synchronously(self):
+        scheduler = self.scheduler(window=60)
+        scheduler.mark_dirty()
+        scheduler.mark_dirty()
+        self.assertEqual(self.runs, [])
+        self.assertTrue(scheduler.drain())
+        self.assertEqual(self.runs, [None])
+        self.assertFalse(scheduler.drain())
+        self.assertTrue(scheduler.idle)
+
+    async def test_zero_window_runs_immediately(self):
+        scheduler = self.scheduler(window=0)
+        await sync_to_async(scheduler.mark_dirty)()
+        self.assertEqual(self.runs, [None])
+        # On an event loop the rebuild becomes a task instead of blocking it
+        scheduler.mark_dirty()
+        await asyncio.sleep(0)
+        self.assertEqual(len(self.runs), 2)
+        self.assertIsNotNone(self.runs[1])
+
+
+class BackgroundServicesMiddlewareTests(SimpleTestCase):
+    def setUp(self):
+        self.services = {}
+        for name, target in (
+            ('astart', 'api.middleware.snapshot_writer.astart'),
+            ('listen', 'api.middleware.topology_notices.start'),
+            ('flush', 'api.middleware.position_stream.flush'),
+        ):
+            patcher = mock.patch(target, new_callable=mock.AsyncMock)
+            self.services[name] = patcher.start()
+            self.addCleanup(patcher.stop)
+        for name, target in (('collector', 'api.middleware.collector'), ('scheduler', 'api.middleware.broadcast_scheduler')):
+            patcher = mock.patch(target)
+            self.services[name] = patcher.start()
+            self.addCleanup(patcher.stop)
+        self.app = mock.AsyncMock()
+        self.middleware = BackgroundServicesMiddleware(self.app)
+
+    async def lifespan(self, *types):
+        messages = asyncio.Queue()
+        for message_type in types:
+            messages.put_nowait({'type': f'lifespan.{message_type}'})
+        sent = []
+        await self.middleware({'type': 'lifespan'}, messages.get, mock.AsyncMock(side_effect=sent.append))
+        return [message['type'] for message in sent]
+
+    async def test_starts_once_for_many_connections(self):
+        await asyncio.gather(*(self.middleware({'type': 'http'}, None, None) for _ in range(3)))
+        await self.middleware({'type': 'websocket'}, None, None)
+        self.services['astart'].assert_awaited_once()
+        self.services['listen'].assert_awaited_once()
+        self.services['collector'].start.assert_called_once()
+        self.services['scheduler'].bind_loop.assert_called_once_with(asyncio.get_running_loop())
+        self.assertEqual(self.app.await_count, 4)
+
+    async def test_lifespan(self):
+        self.assertEqual(
+            await self.lifespan('startup', 'shutdown'),
+            ['lifespan.startup.complete', 'lifespan.shutdown.complete']
+        )
+        self.app.assert_not_awaited()
+        self.services['collector'].start.assert_called_once()
+        self.services['collector'].stop.assert_called_once()
+        self.services['flush'].assert_awaited_once()
+        # Connections after startup find the services running
+        await self.middleware({'type': 'http'}, None, None)
+        self.services['astart'].assert_awaited_once()
+
+    async def test_lifespan_startup_failure(self):
+        self.services['astart'].side_effect = OSError('disk gone')
+        self.assertEqual(await self.lifespan('startup'), ['lifespan.startup.failed'])
+
+
+SAMPLE_LINE = re.compile(r'([a-zA-Z_:][a-zA-Z0-9_:]*)(\{(?:[a-zA-Z_][a-zA-Z0-9_]*="(?:[^"\\\n]|\\.)*",?)*\})? (\S+)')
+
+
+def parse_exposition(text):
+    """[(name, labels, value)] from Prometheus text, failing on anything that is not valid exposition"""
+    samples, types = [], {}
+    for line in text.splitlines():
+        if line.startswith('# HELP '):
+            continue
+        if line.startswith('# TYPE '):
+            _, _, name, kind = line.split(' ')
+            types[name] = kind
+            continue
+        match = SAMPLE_LINE.fullmatch(line)
+        if match is None:
+            raise AssertionError(f'not a sample line: {line!r}')
+        name, labels, value = match.groups()
+        family = name if name in types else re.sub(r'_(bucket|sum|count)$', '', name)
+        if types.get(family) is None:
+            raise AssertionError(f'{name} has no TYPE line before it')
+        samples.append((name, labels or '', float(value)))
+    return samples, types
+
+
+@mock.patch('api.views.collector.get_snapshot', return_value={})
+class MetricsEndpointTests(TestCase):
+    def scrape(self):
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        self.assertTrue(response.content.endswith(b'\n'))
+        return parse_exposition(response.content.decode())
+
+    def total(self, samples, name, **labels):
+        """Sum of a sample over every label set that includes `labels`"""
+        wanted = [f'{key}="{value}"' for key, value in labels.items()]
+        return sum(value for sample, sample_labels, value in samples
+                   if sample == name and all(label in sample_labels for label in wanted))
+
+    def test_exposition_is_valid(self, _):
+        self.client.get(reverse('get_topology'))
+        samples, types = self.scrape()
+        self.assertEqual(types['netmap_prometheus_query_errors_total'], 'counter')
+        self.assertEqual(types['netmap_websocket_clients'], 'gauge')
+        self.assertEqual(types['netmap_topology_build_seconds'], 'histogram')
+
+        # Buckets are cumulative and the +Inf bucket is the count
+        buckets = {}
+        for name, labels, value in samples:
+            if name.endswith('_bucket'):
+                le = re.search(r'le="([^"]+)"', labels).group(1)
+                rest = labels.replace(f',le="{le}"', '').replace(f'le="{le}"', '')
+                series = (name[:-len('_bucket')], '' if rest == '{}' else rest)
+                buckets.setdefault(series, []).append((float(le), value))
+        self.assertTrue(buckets)
+        counts = {(name[:-len('_count')], labels): value for name, labels, value in samples if name.endswith('_count')}
+        for series, bounds in buckets.items():
+            self.assertEqual(bounds, sorted(bounds), series)
+            self.assertEqual(bounds[-1], (math.inf, counts[series]), series)
+
+    def test_counters_and_histograms_move(self, _):
+        make_topology(devices=5, links_per_device=2)
+        topology_cache.invalidate()
+        before, _ = self.scrape()
+
+        self.client.get(reverse('get_topology'), HTTP_ACCEPT_ENCODING='gzip')
+        client = PrometheusClient('http://prometheus.invalid', retries=0)
+        client.session = mock.Mock()
+        client.session.get.side_effect = requests.ConnectionError('refused')
+        client.query('up')
+        after, _ = self.scrape()
+
+        def moved(name, **labels):
+            return self.total(after, name, **labels) - self.total(before, name, **labels)
+
+        self.assertEqual(moved('netmap_prometheus_query_errors_total', endpoint='query'), 1)
+        self.assertEqual(moved('netmap_prometheus_query_seconds_count', endpoint='query'), 1)
+        self.assertEqual(moved('netmap_topology_build_seconds_count'), 1)
+        self.assertGreater(moved('netmap_topology_build_queries_sum'), 0)
+        self.assertEqual(moved('netmap_payload_bytes_count', type='topology_http', encoding='gzip'), 1)
+        self.assertGreater(moved('netmap_payload_bytes_sum', type='topology_http'), 0)
+
+    def test_label_values_are_escaped(self, _):
+        counter = Counter('netmap_test_total', 'Test', ['path'])
+        counter.inc(path='a"b\\c\nd')
+        samples, _ = parse_exposition('\n'.join(counter.render()))
+        self.assertEqual(samples, [('netmap_test_total', '{path="a\\"b\\\\c\\nd"}', 1)])
+
+
+class IconTests(TestCase):
+    """Uploaded icons are served from NetMap's origin, so only images are accepted"""
+
+    def create(self, icon):
+        return self.client.post(reverse('create_device'), {
+            'name': 'fw', 'device_type': 'firewall', 'ip_address': '10.0.0.1', 'icon': icon
+        }, content_type='application/json')
+
+    def test_non_image_data_url_is_rejected(self):
+        response = self.create('data:text/html;base64,PHNjcmlwdD5hbGVydCgxKTwvc2NyaXB0Pg==')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('icon', response.json())
+        self.assertFalse(Device.objects.exists())
+
+    def test_malformed_base64_is_rejected(self):
+        response = self.create('data:image/png;base64,iVBOR*not base64*')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('base64', response.json()['icon'][0])
+        self.assertFalse(Device.objects.exists())
+
+    def test_image_is_served_sandboxed(self):
+        response = self.create('data:image/svg+xml,%3Csvg xmlns=%22http://www.w3.org/2000/svg%22/%3E')
+        self.assertEqual(response.status_code, 201)
+        icon = self.client.get(response.json()['icon_url'])
+        self.assertEqual(icon['Content-Type'], 'image/svg+xml')
+        self.assertIn('sandbox', icon['Content-Security-Policy'])
+        self.assertEqual(icon['X-Content-Type-Options'], 'nosniff')
+
+
+class Worker:
+    """An event loop in its own thread, standing in for a worker process"""
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    def run(self, coroutine, timeout=5):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result(timeout)
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(5)
+        self.loop.close()
+
+
+class DatabaseChannelLayerTests(TransactionTestCase):
+    """Messages reach consumers of every worker sharing the database"""
+
+    def setUp(self):
+        self.workers = []
+        for _ in range(2):
+            worker = Worker()
+            worker.layer = DatabaseChannelLayer(poll_interval=0.02)
+            self.workers.append(worker)
+
+    def tearDown(self):
+        for worker in self.workers:
+            worker.run(worker.layer.close())
+            worker.stop()
+
+    def join(self, worker, group='topology_positions'):
+        channel = worker.run(worker.layer.new_channel())
+        worker.run(worker.layer.group_add(group, channel))
+        return channel
+
+    def test_group_send_reaches_other_worker_once(self):
+        a, b = self.workers
+        channel_a = self.join(a)
+        channel_b = self.join(b)
+        message = {'type': 'position_update', 'origin': 'a', 'frames': {'msgpack': b'\x81\x00'}}
+
+        a.run(a.layer.group_send('topology_positions', message))
+
+        self.assertEqual(b.run(b.layer.receive(channel_b)), message)
+        self.assertEqual(a.run(a.layer.receive(channel_a)), message)
+        # Neither worker gets its own or the other's copy twice
+        for worker, channel in ((a, channel_a), (b, channel_b)):
+            with self.assertRaises(asyncio.TimeoutError):
+                worker.run(asyncio.wait_for(worker.layer.receive(channel), 0.3))
+
+    def test_send_to_channel_of_other_worker(self):
+        a, b = self.workers
+        channel_b = self.join(b)
+
+        a.run(a.layer.send(channel_b, {'type': 'refresh'}))
+
+        self.assertEqual(b.run(b.layer.receive(channel_b)), {'type': 'refresh'})
+
+    def test_unshared_group_stays_in_process(self):
+        a, b = self.workers
+        channel_a = self.join(a, 'topology_updates')
+        channel_b = self.join(b, 'topology_updates')
+
+        a.run(a.layer.group_send('topology_updates', {'type': 'topology_patch'}))
+
+        self.assertEqual(a.run(a.layer.receive(channel_a)), {'type': 'topology_patch'})
+        with self.assertRaises(asyncio.TimeoutError):
+            b.run(asyncio.wait_for(b.layer.receive(channel_b), 0.3))
+        self.assertFalse(ChannelMessage.objects.exists())
+
+    def test_late_commit_is_delivered(self):
+        b = self.workers[1]
+        channel_b = self.join(b)
+        start = (ChannelMessage.objects.order_by('-id').values_list('id', flat=True).first() or 0) + 1
+
+        # id `start` was handed out first but commits after `start + 1`
+        ChannelMessage.objects.create(id=start + 1, origin='other', group='topology_positions',
+                                      payload='{"type": "second"}')
+        self.assertEqual(b.run(b.layer.receive(channel_b)), {'type': 'second'})
+        ChannelMessage.objects.create(id=start, origin='other', group='topology_positions',
+                                      payload='{"type": "first"}')
+        self.assertEqual(b.run(b.layer.receive(channel_b)), {'type': 'first'})
+
+
+class TopologyNoticesTests(TestCase):
+    """Other workers' database changes reach this process's caches"""
+
+    def setUp(self):
+        self.notices = TopologyNotices()
+        self.listener = mock.Mock()
+        self.notices.add_listener(self.listener)
+
+    def test_structure_notice_from_other_worker(self):
+        generation = topology_cache.generation
+        self.notices.handle({'origin': 'other', 'kinds': ['structure']})
+        self.assertGreater(topology_cache.generation, generation)
+        self.listener.assert_called_once_with()
+
+    def test_positions_notice_only_invalidates(self):
+        generation = topology_cache.generation
+        self.notices.handle({'origin': 'other', 'kinds': [POSITIONS]})
+        self.assertGreater(topology_cache.generation, generation)
+        self.listener.assert_not_called()
+
+    def test_changed_on_event_loop(self):
+        with mock.patch('api.notices.get_channel_layer') as get_layer:
+            get_layer.return_value.group_send = mock.AsyncMock()
+
+            async def flush():
+                self.notices.changed(POSITIONS)
+                await asyncio.sleep(0)
+            asyncio.run(flush())
+
+        get_layer.return_value.group_send.assert_awaited_once_with('topology_changes', {
+            'type': 'topology_changed', 'origin': topology_log.origin, 'kinds': [POSITIONS]
+        })
+
+    def test_own_notice_is_ignored(self):
+        generation = topology_cache.generation
+        self.notices.handle({'origin': topology_log.origin, 'kinds': ['structure']})
+        self.assertEqual(topology_cache.generation, generation)
+        self.listener.assert_not_called()
+
+
+def log_edge(edge_id, inbound=0, capacity=1000, target=2, age=None):
+    return {
+        'id': edge_id, 'source': 1, 'target': target,
+        'bandwidth': {'inbound': inbound, 'outbound': 0, 'capacity': capacity, 'utilization': 0},
+        'metrics_age': age, 'metrics_stale': False
+    }
+
+
+def log_topology(nodes, edges):
+    return {'nodes': [{'id': node_id, 'label': label} for node_id, label in nodes], 'edges': edges, 'timestamp': 1}
+
+
+class TopologyLogTests(SimpleTestCase):
+    def setUp(self):
+        self.log = TopologyLog(max_entries=3)
+        self.start, _, _ = self.log.publish(log_topology([(1, 'a'), (2, 'b')], [log_edge('e1')]))
+
+    def test_patch_ops(self):
+        revision, base, ops = self.log.publish(log_topology(
+            [(1, 'a'), (2, 'renamed'), (3, 'c')],
+            [log_edge('e1', inbound=50, age=3.0), log_edge('e2', target=3)]
+        ))
+        self.assertEqual((base, revision), (self.start, self.start + 1))
+        self.assertEqual(ops, [
+            {'op': 'node_changed', 'node': {'id': 2, 'label': 'renamed'}},
+            {'op': 'node_added', 'node': {'id': 3, 'label': 'c'}},
+            {'op': 'edge_metrics', 'id': 'e1', 'bandwidth': log_edge('e1', inbound=50)['bandwidth'],
+             'metrics_age': 3.0, 'metrics_stale': False},
+            {'op': 'edge_added', 'edge': log_edge('e2', target=3)},
+        ])
+
+        _, _, ops = self.log.publish(log_topology([(1, 'a'), (3, 'c')], [log_edge('e2', target=3, capacity=10000)]))
+        self.assertEqual(ops, [
+            {'op': 'node_removed', 'id': 2},
+            {'op': 'edge_removed', 'id': 'e1'},
+            {'op': 'edge_changed', 'edge': log_edge('e2', target=3, capacity=10000)},
+        ])
+
+    def test_revision_only_moves_on_change(self):
+        # Only the age of the metrics moved on: nothing to send
+        revision, base, ops = self.log.publish(log_topology([(1, 'a'), (2, 'b')], [log_edge('e1', age=30.0)]))
+        self.assertEqual((revision, base, ops), (self.start, self.start, []))
+        revision, _, _ = self.log.publish(log_topology([(1, 'a')], []))
+        self.assertEqual(revision, self.start + 1)
+        self.assertEqual(self.log.snapshot(), (self.start + 1, log_topology([(1, 'a')], [])))
+
+    def test_since_replays_patches(self):
+        for inbound in (1, 2, 3):
+            self.log.publish(log_topology([(1, 'a'), (2, 'b')], [log_edge('e1', inbound=inbound)]))
+
+        self.assertEqual(self.log.since(self.start + 3), [])
+        replay = self.log.since(self.start + 1)
+        self.assertEqual([revision for revision, _ in replay], [self.start + 2, self.start + 3])
+        self.assertEqual(replay[-1][1][0]['bandwidth']['inbound'], 3)
+        # The oldest patch of a full log is still replayable from its base
+        self.assertEqual(len(self.log.since(self.start)), 3)
+
+    def test_since_falls_back_to_snapshot(self):
+        for inbound in (1, 2, 3, 4):
+            self.log.publish(log_topology([(1, 'a'), (2, 'b')], [log_edge('e1', inbound=inbound)]))
+        # Only three patches are kept
+        self.assertIsNone(self.log.since(self.start))
+        self.assertIsNone(self.log.since(self.start + 5))
+        self.assertIsNone(TopologyLog().since(0))
+        self.assertEqual(len(self.log.since(self.start + 1)), 3)
+
+
+@mock.patch('api.views.collector.get_snapshot', return_value={})
+class TopologySinceTests(TestCase):
+    def test_since_returns_patch_or_full_topology(self, _):
+        make_topology(devices=3, links_per_device=1)
+        url = reverse('get_topology')
+        revision = self.client.get(url).json()['revision']
+
+        Device.objects.filter(name='dev-0').update(position_x=500)
+        topology_cache.invalidate()
+        patch = self.client.get(url, {'since': revision}).json()
+        self.assertEqual(patch['base'], revision)
+        self.assertEqual([op['op'] for op in patch['ops']], ['node_changed'])
+        self.assertEqual(patch['ops'][0]['node']['position']['x'], 500)
+
+        full = self.client.get(url, {'since': revision - 1000}).json()
+        self.assertNotIn('ops', full)
+        self.assertEqual(full['revision'], patch['revision'])
+        self.assertEqual(len(full['nodes']), 3)
+        self.assertEqual(self.client.get(url, {'since': 'latest'}).status_code, 400)
+
+
+def decode_frame(frame, encoding):
+    if encoding == 'msgpack':
+        return msgpack.unpackb(frame)
+    if encoding == 'deflate':
+        frame = zlib.decompress(frame).decode()
+    return json.loads(frame)
+
+
+class FrameEncodingTests(TransactionTestCase):
+    """Broadcasts are encoded once per encoding in use, not once per client"""
+
+    MESSAGE = {'type': 'topology_patch', 'revision': 2, 'base': 1, 'ops': [{'op': 'node_removed', 'id': 7}]}
+
+    def setUp(self):
+        self.metrics = {}
+        patcher = mock.patch('api.views.collector.get_snapshot', side_effect=lambda: dict(self.metrics))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('api.views.collector.aget_snapshot', new=mock.AsyncMock(side_effect=lambda: dict(self.metrics)))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        topology_cache.invalidate()
+
+    def test_frames_decode_to_the_message(self):
+        frames = encode_frames(self.MESSAGE, ['json', 'deflate', 'msgpack'])
+        self.assertIsInstance(frames['json'], str)
+        for encoding, frame in frames.items():
+            self.assertEqual(decode_frame(frame, encoding), self.MESSAGE, encoding)
+        self.assertEqual(frame_for({'json': frames['json']}, 'deflate'), frames['deflate'])
+        # Nobody connected: JSON only, which held patches are merged from
+        self.assertEqual(list(encode_frames(self.MESSAGE)), ['json'])
+
+    def test_missing_msgpack_falls_back_to_json(self):
+        with mock.patch('api.encoding.msgpack', None):
+            self.assertNotIn('msgpack', available_encodings())
+            encoding = negotiate('msgpack')
+        release(encoding)
+        self.assertEqual(encoding, 'json')
+
+    async def test_broadcast_encodes_once_per_encoding(self):
+        a = await Device.objects.acreate(name='a', device_type='switch', ip_address='10.0.0.1', prometheus_instance='a')
+        b = await Device.objects.acreate(name='b', device_type='switch', ip_address='10.0.0.2')
+        link = await Link.objects.acreate(source_device=a, target_device=b, source_interface='ge-0/0/0',
+                                          target_interface='ge-0/0/1', bandwidth_capacity=1000)
+        topology_cache.invalidate()
+        clients = []
+        for encoding in ('msgpack', 'msgpack', 'deflate', 'deflate', 'json'):
+            client = WebsocketCommunicator(TopologyConsumer.as_asgi(), f'/ws/topology/?encoding={encoding}')
+            await client.connect()
+            snapshot = decode_frame(await client.receive_from(), encoding)
+            self.assertEqual(snapshot['type'], 'topology_update')
+            clients.append((client, encoding))
+
+        self.metrics = {link.metric_key: {'inbound': 5, 'outbound': 0, 'timestamp': None,
+                                          'fetched_at': 0, 'stale': False}}
+        with mock.patch('api.encoding.msgpack.packb', wraps=msgpack.packb) as packb, \
+                mock.patch('api.encoding.zlib.compress', wraps=zlib.compress) as compress:
+            await apublish_topology(await aget_topology_data())
+            patches = [decode_frame(await client.receive_from(), encoding) for client, encoding in clients]
+        self.assertEqual(packb.call_count, 1)
+        self.assertEqual(compress.call_count, 1)
+        self.assertEqual(len({json.dumps(patch, sort_keys=True) for patch in patches}), 1)
+        self.assertEqual(patches[0]['ops'][0]['op'], 'edge_metrics')
+        for client, _ in clients:
+            await client.disconnect()
+        self.assertEqual(encodings_in_use(), ['json'])
+
+
+@mock.patch('api.views.collector.get_snapshot', return_value={})
+class TopologyHttpTests(TestCase):
+    def setUp(self):
+        make_topology(devices=5, links_per_device=2)
+        topology_cache.invalidate()
+        self.url = reverse('get_topology')
+
+    def test_gzip(self, _):
+        response = self.client.get(self.url, HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response['Vary'])
+        self.assertEqual(len(json.loads(gzip.decompress(response.content))['nodes']), 5)
+
+        response = self.client.get(self.url, HTTP_ACCEPT_ENCODING='br;q=0, gzip;q=0')
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(len(response.json()['nodes']), 5)
+
+    @skipUnless(brotli, 'needs brotli')
+    def test_brotli_preferred(self, _):
+        response = self.client.get(self.url, HTTP_ACCEPT_ENCODING='gzip, br')
+        self.assertEqual(response['Content-Encoding'], 'br')
+        self.assertEqual(len(json.loads(brotli.decompress(response.content))['nodes']), 5)
+
+    def test_small_bodies_stay_uncompressed(self, _):
+        self.assertEqual(compress_body(b'{}', 'gzip, br'), (b'{}', None))
+
+    def test_etag_changes_after_write(self, _):
+        first = self.client.get(self.url)
+        etag = first['ETag']
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        response = self.client.post(reverse('create_device'), {
+            'name': 'new', 'device_type': 'switch', 'ip_address': '10.9.9.9'
+        }, content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        second = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(second.status_code, 200)
+        self.assertNotEqual(second['ETag'], etag)
+        self.assertEqual(len(second.json()['nodes']), 6)
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=second['ETag']).status_code, 304)
+
+
+class BandwidthHistoryTests(SimpleTestCase):
+    A = ('r1', 'ge-0/0/1')
+    B = ('r1', 'ge-0/0/2')
+
+    def sample(self, value, stale=False):
+        return {'inbound': value, 'outbound': value * 2, 'stale': stale}
+
+    def test_ring_wraps_oldest_first(self):
+        history = BandwidthHistory(size=4)
+        for n in range(1, 7):
+            history.record({self.A: self.sample(n)}, 1000 + n)
+        timestamps, series = history.series([self.A])
+        self.assertEqual(timestamps, [1003, 1004, 1005, 1006])
+        self.assertEqual(series[self.A], ([3, 4, 5, 6], [6, 8, 10, 12]))
+
+    def test_gaps_for_missing_and_stale_samples(self):
+        history = BandwidthHistory(size=4)
+        history.record({self.A: self.sample(1), self.B: self.sample(1)}, 1001)
+        history.record({self.A: self.sample(2)}, 1002)
+        history.record({self.A: self.sample(3), self.B: self.sample(9, stale=True)}, 1003)
+        _, series = history.series([self.A, self.B, ('r9', 'unknown')])
+        self.assertEqual(series[self.B][0], [1, None, None])
+        self.assertNotIn(('r9', 'unknown'), series)
+
+    def test_points_average_buckets(self):
+        history = BandwidthHistory(size=4)
+        for n in range(1, 5):
+            history.record({self.A: self.sample(n)}, 1000 + n)
+        timestamps, series = history.series([self.A], points=2)
+        self.assertEqual(timestamps, [1002, 1004])
+        self.assertEqual(series[self.A][0], [1.5, 3.5])
+
+    def test_unseen_interfaces_free_their_slots(self):
+        history = BandwidthHistory(size=3, max_keys=1)
+        history.record({self.A: self.sample(1)}, 1001)
+        # No room for a second interface while the first is still in the ring
+        history.record({self.B: self.sample(1)}, 1002)
+        self.assertEqual(len(history), 1)
+        history.record({}, 1003)
+        history.record({}, 1004)
+        self.assertEqual(len(history), 0)
+        history.record({self.B: self.sample(7)}, 1005)
+        _, series = history.series([self.A, self.B])
+        self.assertEqual(list(series), [self.B])
+        self.assertEqual(series[self.B][0], [None, None, 7])
+
+
+class DownsamplingTests(SimpleTestCase):
+    def test_lttb_keeps_endpoints_and_count(self):
+        rng = random.Random(4)
+        points = [(t, rng.random() * 100) for t in range(1000)]
+        for threshold in (3, 50, 333, 999):
+            sampled = lttb(points, threshold)
+            self.assertEqual(len(sampled), threshold)
+            self.assertEqual((sampled[0], sampled[-1]), (points[0], points[-1]))
+            self.assertEqual([t for t, _ in sampled], sorted({t for t, _ in sampled}))
+            self.assertTrue(set(sampled) <= set(points))
+
+    def test_lttb_short_series(self):
+        points = [(0, 1), (1, 2), (2, 3)]
+        self.assertEqual(lttb(points, 10), points)
+        self.assertEqual(lttb(points, 2), [(0, 1), (2, 3)])
+        self.assertEqual(lttb([], 10), [])
+
+    def test_lttb_keeps_spikes(self):
+        points = [(t, 0.0) for t in range(500)]
+        points[137] = (137, 900.0)
+        points[380] = (380, -50.0)
+        sampled = lttb(points, 20)
+        self.assertIn((137, 900.0), sampled)
+        self.assertIn((380, -50.0), sampled)
+
+    def test_downsample_drops_nan(self):
+        self.assertEqual(downsample([(1.5, 1.23456), (2, NAN), (3, 2)], 10), [[1, 1.235], [3, 2]])
+
+    def test_parse_duration(self):
+        for value, seconds in (('90', 90), ('15m', 900), ('6h', 21600), ('30d', 2592000), ('2w', 1209600), ('0', 0)):
+            self.assertEqual(parse_duration(value), seconds, value)
+        for value in (None, '', 'm', '-5m', '1.5h', '15 m', ' 15m', '15x', '15M', '1h30m', '１５'):
+            self.assertIsNone(parse_duration(value), value)
+
+
+class HistoryRangeTests(TestCase):
+    def test_bad_durations_are_rejected(self):
+        url = reverse('link_history_range')
+        for params in ({'window': '0'}, {'window': 'abc'}, {'window': '-1d'}, {'step': '5 m'}, {'points': 'many'}):
+            response = self.client.get(url, params)
+            self.assertEqual(response.status_code, 400, params)
+
+
+def edge_metrics(edge_id, inbound):
+    return {'op': 'edge_metrics', 'id': edge_id, 'inbound': inbound, 'outbound': 0}
+
+
+class MailboxTests(SimpleTestCase):
+    """Patches held for a slow client merge into one, or into a resync"""
+
+    def test_metrics_keep_latest_per_edge(self):
+        mailbox = Mailbox(1, max_ops=10)
+        mailbox.add_patch(2, [edge_metrics('e1', 1), edge_metrics('e2', 1)])
+        mailbox.add_patch(3, [edge_metrics('e1', 2)])
+
+        self.assertEqual((mailbox.base, mailbox.revision), (1, 3))
+        self.assertFalse(mailbox.resync)
+        self.assertEqual(mailbox.patch_ops(), [edge_metrics('e1', 2), edge_metrics('e2', 1)])
+
+    def test_structural_ops_stay_in_order(self):
+        mailbox = Mailbox(1, max_ops=10)
+        added = {'op': 'edge_added', 'edge': {'id': 'e1', 'inbound': 5}}
+        mailbox.add_patch(2, [edge_metrics('e1', 1), {'op': 'node_added', 'node': {'id': 1}}])
+        mailbox.add_patch(3, [added, {'op': 'node_removed', 'id': 2}])
+
+        # The added edge carries its own metrics, older ones are dropped
+        self.assertEqual(mailbox.patch_ops(), [
+            {'op': 'node_added', 'node': {'id': 1}}, added, {'op': 'node_removed', 'id': 2}
+        ])
+
+    def test_positions_keep_latest_per_device(self):
+        mailbox = Mailbox(1, max_ops=10)
+        mailbox.add_positions([{'id': 1, 'x': 0, 'y': 0}, {'id': 2, 'x': 5, 'y': 5}])
+        mailbox.add_positions([{'id': 1, 'x': 10, 'y': 20}])
+
+        self.assertEqual(list(mailbox.positions.values()), [{'id': 1, 'x': 10, 'y': 20}, {'id': 2, 'x': 5, 'y': 5}])
+
+    def test_too_many_ops_needs_resync(self):
+        mailbox = Mailbox(1, max_ops=2)
+        mailbox.add_patch(2, [{'op': 'node_removed', 'id': i} for i in range(3)])
+        mailbox.add_patch(3, [edge_metrics('e1', 1)])
+
+        self.assertTrue(mailbox.resync)
+        self.assertEqual(mailbox.revision, 3)
+        self.assertEqual(mailbox.patch_ops(), [])
+
+    def test_missing_patch_needs_resync(self):
+        mailbox = Mailbox(1, max_ops=10)
+        mailbox.add_patch(2, [edge_metrics('e1', 1)])
+        mailbox.skip_to(5)
+
+        self.assertTrue(mailbox.resync)
+        self.assertEqual(mailbox.revision, 5)
+        self.assertEqual(mailbox.patch_ops(), [])
+
+
+@override_settings(WEBSOCKET_MAX_IN_FLIGHT=1, WEBSOCKET_MAX_PENDING_OPS=3)
+class BackpressureTests(TransactionTestCase):
+    """A client behind on acks gets one merged patch, or a snapshot"""
+
+    def setUp(self):
+        self.metrics = {}
+        patcher = mock.patch('api.views.collector.get_snapshot', side_effect=lambda: dict(self.metrics))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('api.views.collector.aget_snapshot', new=self.aget_snapshot)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        topology_cache.invalidate()
+
+    async def aget_snapshot(self):
+        return dict(self.metrics)
+
+    async def publish(self):
+        await apublish_topology(await aget_topology_data())
+
+    async def receive(self, client):
+        return json.loads(await client.receive_from())
+
+    async def test_merge_then_resync(self):
+        a = await Device.objects.acreate(name='a', device_type='switch', ip_address='10.0.0.1', prometheus_instance='a')
+        b = await Device.objects.acreate(name='b', device_type='switch', ip_address='10.0.0.2')
+        link = await Link.objects.acreate(source_device=a, target_device=b, source_interface='ge-0/0/0',
+                                          target_interface='ge-0/0/1', bandwidth_capacity=1000)
+        topology_cache.invalidate()
+        client = WebsocketCommunicator(TopologyConsumer.as_asgi(), '/ws/topology/')
+        await client.connect()
+        snapshot = await self.receive(client)
+        await client.send_to(text_data=json.dumps({'action': 'ack', 'revision': snapshot['revision']}))
+        await client.receive_nothing(0.1)
+
+        for inbound in range(1, 5):
+            self.metrics = {link.metric_key: {'inbound': inbound, 'outbound': 0, 'timestamp': None,
+                                              'fetched_at': 0, 'stale': False}}
+            await self.publish()
+        first = await self.receive(client)
+        self.assertEqual(first['base'], snapshot['revision'])
+        # The rest waits for the ack, then goes out as one patch
+        self.assertTrue(await client.receive_nothing(0.2))
+        await client.send_to(text_data=json.dumps({'action': 'ack', 'revision': first['revision']}))
+        merged = await self.receive(client)
+        self.assertEqual(merged['type'], 'topology_patch')
+        self.assertEqual(merged['base'], first['revision'])
+        self.assertEqual(len(merged['ops']), 1)
+        self.assertEqual(merged['ops'][0]['op'], 'edge_metrics')
+
+        for i in range(5):
+            await Device.objects.acreate(name=f'new-{i}', device_type='switch', ip_address='10.0.1.1')
+            topology_cache.invalidate()
+            await self.publish()
+        self.assertTrue(await client.receive_nothing(0.2))
+        await client.send_to(text_data=json.dumps({'action': 'ack', 'revision': merged['revision']}))
+        resync = await self.receive(client)
+        self.assertEqual(resync['type'], 'topology_update')
+        self.assertEqual(len(resync['data']['nodes']), 7)
+        await client.disconnect()
+
+
+class CollapseDirectionTests(SimpleTestCase):
+    """Merged edges add up traffic in one direction, whichever end measured it"""
+
+    def node(self, node_id, site):
+        return {'id': node_id, 'site': site, 'rack': '', 'position': {'x': 0, 'y': 0}}
+
+    def edge(self, edge_id, source, target, side, inbound, outbound):
+        return {
+            'id': edge_id, 'source': source, 'target': target, 'source_interface': 'a',
+            'target_interface': 'b', 'metric_side': side, 'metrics_age': None, 'metrics_stale': False,
+            'bandwidth': {'inbound': inbound, 'outbound': outbound, 'capacity': 1000, 'utilization': 0}
+        }
+
+    def test_measuring_side_decides_direction(self):
+        nodes = [self.node(1, 'east'), self.node(2, 'west'), self.node(3, 'west')]
+        edges = [
+            # 10 Mbps east -> west, seen leaving the east switch
+            self.edge(1, 1, 2, 'source', 0, 10),
+            # 20 Mbps east -> west, seen arriving at the west switch
+            self.edge(2, 1, 3, 'target', 20, 0),
+            # 30 Mbps east -> west on a link drawn the other way, seen at the west end
+            self.edge(3, 3, 1, 'source', 30, 0),
+        ]
+
+        merged, = collapse_topology({'nodes': nodes, 'edges': edges}, 'site')['edges']
+
+        self.assertEqual((merged['source'], merged['target']), ('site:east', 'site:west'))
+        self.assertEqual(merged['bandwidth']['inbound'], 0)
+        self.assertEqual(merged['bandwidth']['outbound'], 60)
+
+
+class ImporterTests(TestCase):
+    def test_read_csv_and_json(self):
+        rows = list(importer.read_rows('Name,Role\ncore1,Core Router\n', 'csv'))
+        self.assertEqual(rows, [{'Name': 'core1', 'Role': 'Core Router'}])
+        page = json.dumps({'results': [{'name': 'core1'}, {'name': 'leaf1'}]})
+        self.assertEqual([row['name'] for row in importer.read_rows(page, 'json')], ['core1', 'leaf1'])
+        lines = '{"name": "core1"}\n{"name": "leaf1"}\n'
+        self.assertEqual(len(list(importer.read_rows(lines.encode(), 'json'))), 2)
+        with self.assertRaises(ValueError):
+            list(importer.read_rows('[1, 2]', 'json'))
+
+    def test_rows_become_devices_and_links(self):
+        topology = importer.TopologyImport()
+        topology.add_rows(importer.read_rows(
+            'Name,Role,Primary IP,Site\ncore1,Core Router,10.0.0.1/24,ams1\nleaf1,Leaf,bogus,ams1\n', 'csv'
+        ))
+        topology.add_rows([{
+            'a_terminations': [{'object': {'device': {'name': 'core1'}, 'name': 'et-0/0/1'}}],
+            'b_terminations': [{'object': {'device': {'name': 'leaf1'}, 'name': 'eth1'}}],
+            'speed': '10000'
+        }])
+        self.assertEqual(topology.devices['core1'], {'device_type': 'router', 'ip_address': '10.0.0.1', 'site': 'ams1'})
+        self.assertEqual(topology.errors, [{'row': 2, 'error': 'invalid IP address: bogus'}])
+        link = topology.links[importer.link_key('leaf1', 'eth1', 'core1', 'et-0/0/1')]
+        self.assertEqual(link['capacity'], 10000)
+
+    def test_matches_existing_rows_by_name_and_endpoints(self):
+        core = Device.objects.create(name='core1', device_type='router', ip_address='10.0.0.1', site='ams1')
+        leaf = Device.objects.create(name='leaf1', device_type='switch', ip_address='10.0.0.2')
+        Link.objects.create(source_device=core, source_interface='et-0/0/1',
+                            target_device=leaf, target_interface='eth1', bandwidth_capacity=1000)
+        topology = importer.TopologyImport()
+        topology.add_rows([
+            {'name': 'core1', 'site': 'ams1'},
+            {'name': 'leaf1', 'site': 'fra2'},
+            # The existing cable, seen from the other end
+            {'side_a': 'leaf1', 'termination_a': 'eth1', 'side_b': 'core1', 'termination_b': 'et-0/0/1', 'speed': 10000},
+            {'side_a': 'leaf1', 'termination_a': 'eth2', 'side_b': 'spine1', 'termination_b': 'eth9'},
+        ])
+        self.assertEqual(topology.summary(), {
+            'rows': 4,
+            'devices': {'create': 1, 'update': 1, 'unchanged': 1},
+            'links': {'create': 1, 'update': 1, 'unchanged': 0},
+            'errors': 0
+        })
+        self.assertEqual(list(topology.diff()), [
+            '+ device spine1 (switch, 0.0.0.0)',
+            "~ device leaf1: site '' -> 'fra2'",
+            '+ link leaf1:eth2 <-> spine1:eth9 (1000 Mbps)',
+            '~ link leaf1:eth1 <-> core1:et-0/0/1: capacity 1000 -> 10000',
+        ])
+
+    def test_dry_run_writes_nothing(self):
+        rows = [
+            {'name': 'core1'},
+            {'side_a': 'core1', 'termination_a': 'et-0/0/1', 'side_b': 'leaf1', 'termination_b': 'eth1'}
+        ]
+        url = reverse('import_topology')
+        response = self.client.post(url, {'format': 'json', 'data': rows, 'dry_run': True}, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['status'], 'dry_run')
+        self.assertEqual(len(response.json()['changes']), 3)
+        self.assertFalse(Device.objects.exists())
+
+        response = self.client.post(url, {'format': 'json', 'data': rows}, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Device.objects.count(), 2)
+        self.assertEqual(Link.objects.count(), 1)
+
+    def test_rows_that_are_not_objects_are_errors(self):
+        response = self.client.post(
+            reverse('import_topology'), {'format': 'json', 'data': [1, 'x', {'name': 'core1'}], 'dry_run': True},
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([error['row'] for error in response.json()['errors']], [1, 2])
+        self.assertEqual(response.json()['summary']['devices']['create'], 1)
+
+    def test_apply_writes_in_chunks(self):
+        topology = importer.TopologyImport(batch_size=2)
+        topology.add_rows([
+            {'side_a': f'leaf{i}', 'termination_a': 'eth1', 'side_b': 'spine1', 'termination_b': f'eth{i}'}
+            for i in range(5)
+        ])
+        with CaptureQueriesContext(connection) as queries:
+            created = topology.apply()
+        inserts = [query['sql'] for query in queries if query['sql'].startswith('INSERT')]
+        # 6 devices and 5 links, two rows per statement
+        self.assertEqual(len(inserts), 3 + 3)
+        self.assertEqual(created, set(Device.objects.values_list('id', flat=True)))
+        self.assertEqual(Link.objects.count(), 5)
+        self.assertEqual(topology.summary()['links'], {'create': 0, 'update': 0, 'unchanged': 5})
+
+
+@skipUnless(layout.available(), 'needs numpy')
+class LayoutTests(SimpleTestCase):
+    """Server-side layouts place only the new devices, reproducibly"""
+
+    TYPES = ('isp', 'firewall', 'router', 'switch', 'server')
+
+    def topology(self, count=40):
+        # Two arranged devices, the rest new at 0,0; a ring plus a few chords
+        nodes = [(1, 0, 0, 'isp'), (2, 300, 0, 'firewall')]
+        nodes += [(i, 0, 0, self.TYPES[i % len(self.TYPES)]) for i in range(3, count + 1)]
+        edges = [(i, i % count + 1) for i in range(1, count + 1)] + [(1, 20), (5, 30)]
+        return nodes, edges, set(range(3, count + 1))
+
+    def assert_placed(self, positions, movable):
+        self.assertEqual(set(positions), movable)
+        for x, y in positions.values():
+            self.assertTrue(math.isfinite(x) and math.isfinite(y))
+
+    def test_force_is_deterministic(self):
+        nodes, edges, movable = self.topology()
+        first = layout.compute_layout(nodes, edges, movable, 'force', seed=3)
+
+        self.assert_placed(first, movable)
+        self.assertEqual(layout.compute_layout(nodes, edges, movable, 'force', seed=3), first)
+        self.assertNotEqual(layout.compute_layout(nodes, edges, movable, 'force', seed=4), first)
+        # New devices are spread out rather than stacked
+        self.assertGreater(len(set(first.values())), len(movable) * 0.9)
+
+    def test_layered_rows_follow_tiers(self):
+        nodes, edges, movable = self.topology()
+        positions = layout.compute_layout(nodes, edges, movable, 'layered')
+
+        self.assert_placed(positions, movable)
+        rows = {}
+        for node_id, _, _, device_type in nodes:
+            if node_id in movable:
+                rows.setdefault(layout.TIERS[device_type], set()).add(positions[node_id][1])
+        # One row per tier, ordered from the edge inwards, below the arranged devices
+        self.assertTrue(all(len(ys) == 1 for ys in rows.values()))
+        ys = [rows[tier].pop() for tier in sorted(rows)]
+        self.assertEqual(ys, sorted(ys))
+        self.assertGreater(ys[0], 0)
+        self.assertEqual(len(set(ys)), len(ys))
+
+    def test_unknown_algorithm(self):
+        nodes, edges, movable = self.topology()
+        with self.assertRaises(ValueError):
+            layout.compute_layout(nodes, edges, movable, 'circle')
+
+
+class BruteForceGraph:
+    """Reference answers for GraphIndex, straight from the database"""
+
+    def __init__(self):
+        self.devices = set(Device.objects.values_list('id', flat=True))
+        self.links = {link_id: (source, target) for link_id, source, target in
+                      Link.objects.values_list('id', 'source_device_id', 'target_device_id')}
+
+    def reachable(self, starts, failed_devices=(), failed_links=(), max_hops=None):
+        adjacent = {device_id: [] for device_id in self.devices}
+        for link_id, (source, target) in self.links.items():
+            if link_id not in failed_links:
+                adjacent[source].append(target)
+                adjacent[target].append(source)
+        distance = {start: 0 for start in starts if start in self.devices and start not in failed_devices}
+        queue = deque(distance)
+        while queue:
+            u = queue.popleft()
+            if max_hops is not None and distance[u] >= max_hops:
+                continue
+            for v in adjacent[u]:
+                if v not in distance and v not in failed_devices:
+                    distance[v] = distance[u] + 1
+                    queue.append(v)
+        return distance
+
+    def components(self, failed_devices=(), failed_links=()):
+        return len(self._components(failed_devices, failed_links))
+
+    def _components(self, failed_devices, failed_links):
+        remaining = self.devices - set(failed_devices)
+        found = []
+        while remaining:
+            component = set(self.reachable([next(iter(remaining))], failed_devices, failed_links))
+            remaining -= component
+            found.append(component)
+        return found
+
+    def articulation_points(self):
+        base = self.components()
+        points = {device_id for device_id in self.devices if self.components(failed_devices={device_id}) > base}
+        bridges = {link_id for link_id in self.links if self.components(failed_links={link_id}) > base}
+        return points, bridges
+
+
+@mock.patch('api.views.collector.get_snapshot', return_value={})
+class GraphIndexTests(TestCase):
+    """GraphIndex agrees with a brute-force search through incremental changes and compactions"""
+
+    def setUp(self):
+        graph_index.reload()
+        self.random = random.Random(24)
+        self.interfaces = 0
+
+    def add_device(self):
+        return Device.objects.create(name=f'dev-{Device.objects.count()}-{self.random.random()}',
+                                     device_type='switch', ip_address='10.0.0.1').id
+
+    def add_link(self, devices):
+        # Parallel links are allowed, self loops are not
+        source, target = self.random.sample(devices, 2)
+        self.interfaces += 1
+        return Link.objects.create(source_device_id=source, target_device_id=target, bandwidth_capacity=1000,
+                                   source_interface=f'ge-{self.interfaces}', target_interface=f'ge-{self.interfaces}')
+
+    def mutate(self):
+        devices = list(Device.objects.values_list('id', flat=True))
+        links = list(Link.objects.all())
+        choice = self.random.random()
+        if choice < 0.15 or len(devices) < 3:
+            self.add_device()
+        elif choice < 0.5 or not links:
+            self.add_link(devices)
+        elif choice < 0.75:
+            self.random.choice(links).delete()
+        elif choice < 0.9:
+            link = self.random.choice(links)
+            link.target_device_id = self.random.choice([d for d in devices if d != link.source_device_id])
+            link.save()
+        else:
+            Device.objects.filter(id=self.random.choice(devices)).delete()
+
+    def check(self, reference):
+        devices = sorted(reference.devices)
+        links = sorted(reference.links)
+        for _ in range(5):
+            source = self.random.choice(devices)
+            failed_devices = set(self.random.sample(devices, min(2, len(devices) - 1))) - {source}
+            failed_links = set(self.random.sample(links, min(2, len(links)))) | {10 ** 9}
+            max_hops = self.random.choice([None, 1, 2])
+            self.assertEqual(
+                graph_index.reachable([source], failed_devices, failed_links, max_hops),
+                set(reference.reachable([source], failed_devices, failed_links, max_hops))
+            )
+
+            target = self.random.choice(devices)
+            path = graph_index.shortest_path(source, target)
+            distance = reference.reachable([source]).get(target)
+            if distance is None:
+                self.assertIsNone(path)
+                continue
+            nodes, path_links, cost = path
+            self.assertEqual(cost, distance)
+            self.assertEqual((nodes[0], nodes[-1]), (source, target))
+            for u, v, link_id in zip(nodes, nodes[1:], path_links):
+                self.assertIn(reference.links[link_id], ((u, v), (v, u)))
+
+            roots = {source}
+            unreachable = set(devices) - failed_devices - set(
+                reference.reachable(roots, failed_devices, failed_links)
+            )
+            impact = graph_index.impact(failed_devices, failed_links, roots)
+            self.assertEqual(set(impact['unreachable']), unreachable if source not in failed_devices else set())
+
+        self.assertEqual(graph_index.articulation_points(), reference.articulation_points())
+
+    def test_matches_brute_force(self, _snapshot):
+        devices = [self.add_device() for _ in range(15)]
+        for _ in range(25):
+            self.add_link(devices)
+        # Compact after a handful of changes, so both paths are covered
+        with mock.patch.object(graph_index, 'compact_ratio', 0.005):
+            for step in range(60):
+                self.mutate()
+                if step % 3 == 0:
+                    self.check(BruteForceGraph())
+        self.assertEqual(graph_index.stats()['links'], Link.objects.count())
+
+    def test_unknown_failed_link(self, _snapshot):
+        source = self.add_device()
+        response = self.client.get(reverse('graph_reachable'), {'source': source, 'failed_links': '99999'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['devices'], [source])
+
+
+class SnapshotTests(TestCase):
+    """Snapshots round-trip the topology and notice any database change"""
+
+    def setUp(self):
+        self.firewall = Device.objects.create(name='fw', device_type='firewall', ip_address='10.0.0.1',
+                                              prometheus_instance='fw:9100', site='s1', position_x=-5,
+                                              position_y=7, icon='🔥')
+        self.isp = Device.objects.create(name='isp', device_type='isp', ip_address='10.0.0.2', is_monitored=False,
+                                         position_x=40, position_y=-3)
+        Link.objects.create(source_device=self.isp, target_device=self.firewall, source_interface='eth0',
+                            target_interface='ge-0/0/1', bandwidth_capacity=1000)
+        topology_cache.invalidate()
+        self.metrics = {('fw:9100', 'ge-0/0/1'): {'inbound': 1.5, 'outbound': 2.5, 'timestamp': None,
+                                                   'fetched_at': 1000.0, 'stale': False}}
+        patcher = mock.patch.multiple(collector, _snapshot=self.metrics, _updated_at=1000.0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(topology_cache.invalidate)
+
+    def test_encode_decode(self):
+        decoded = snapshot.decode(snapshot.capture())
+
+        self.assertEqual(decoded.structure(), get_topology_structure())
+        self.assertEqual(decoded.fingerprint, snapshot.fingerprint())
+        self.assertEqual(decoded.metrics_at, 1000.0)
+        metrics = decoded.stale_metrics()[('fw:9100', 'ge-0/0/1')]
+        self.assertEqual((metrics['inbound'], metrics['outbound'], metrics['stale']), (1.5, 2.5, True))
+
+    def test_corrupt_snapshot(self):
+        data = bytearray(snapshot.capture())
+        data[-1] ^= 1
+        with self.assertRaises(snapshot.SnapshotError):
+            snapshot.decode(bytes(data))
+        with self.assertRaises(snapshot.SnapshotError):
+            snapshot.decode(b'garbage')
+
+    def test_swapped_positions_change_fingerprint(self):
+        before = snapshot.fingerprint()
+        # Same sums, no updated_at change
+        Device.objects.filter(id=self.firewall.id).update(position_x=40, position_y=-3)
+        Device.objects.filter(id=self.isp.id).update(position_x=-5, position_y=7)
+        self.assertNotEqual(snapshot.fingerprint(), before)
+
+    def test_restore(self):
+        data = snapshot.capture()
+        before = get_topology_structure()
+        Link.objects.all().delete()
+        self.isp.delete()
+        Device.objects.filter(id=self.firewall.id).update(position_x=1, name='renamed')
+        Device.objects.create(name='extra', device_type='switch', ip_address='10.0.0.9')
+
+        decoded = snapshot.decode(data)
+        counts = snapshot.restore(decoded, dry_run=True)
+        self.assertEqual(counts['devices'], {'create': 1, 'update': 1, 'delete': 1})
+        self.assertEqual(counts['links'], {'create': 1, 'update': 0, 'delete': 0})
+        snapshot.restore(decoded)
+        topology_cache.invalidate()
+
+        self.assertEqual(get_topology_structure(), before)
+        counts = snapshot.restore(decoded)
+        self.assertEqual(counts['devices'], {'create': 0, 'update': 0, 'delete': 0})
+
+    def test_restore_link_of_deleted_device(self):
+        Device.objects.all().delete()
+        first = Device.objects.create(id=1001, name='a', device_type='switch', ip_address='10.0.0.1')
+        second = Device.objects.create(id=1002, name='b', device_type='switch', ip_address='10.0.0.2')
+        Link.objects.create(id=1005, source_device=first, target_device=second, source_interface='ge-0/0/1',
+                            target_interface='ge-0/0/1', bandwidth_capacity=1000)
+        data = snapshot.capture()
+        # Same link id, now to a device the snapshot does not have
+        second.delete()
+        other = Device.objects.create(id=1009, name='c', device_type='switch', ip_address='10.0.0.9')
+        Link.objects.create(id=1005, source_device=first, target_device=other, source_interface='ge-0/0/1',
+                            target_interface='ge-0/0/1', bandwidth_capacity=1000)
+
+        counts = snapshot.restore(snapshot.decode(data))
+
+        self.assertEqual(counts['links'], {'create': 1, 'update': 0, 'delete': 0})
+        self.assertEqual(list(Link.objects.values_list('id', 'source_device_id', 'target_device_id')),
+                         [(1005, 1001, 1002)])
+
+
+class PositionScopeTests(TransactionTestCase):
+    """Live positions only reach clients whose view shows the device"""
+
+    def setUp(self):
+        patcher = mock.patch('api.views.collector.get_snapshot', return_value={})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('api.views.collector.aget_snapshot', new=mock.AsyncMock(return_value={}))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        topology_cache.invalidate()
+
+    async def connect(self, query=''):
+        client = WebsocketCommunicator(TopologyConsumer.as_asgi(), f'/ws/topology/{query}')
+        await client.connect()
+        await client.receive_from()
+        return client
+
+    async def test_positions_follow_view(self):
+        east = await Device.objects.acreate(name='e', device_type='switch', ip_address='10.0.0.1', site='east')
+        west = await Device.objects.acreate(name='w', device_type='switch', ip_address='10.0.0.2', site='west')
+        whole = await self.connect()
+        scoped = await self.connect('?site=east')
+        collapsed = await self.connect('?level=site')
+
+        await sync_to_async(position_stream.relay)([
+            {'id': east.id, 'x': 1, 'y': 1}, {'id': west.id, 'x': 2, 'y': 2}
+        ])
+
+        message = json.loads(await whole.receive_from())
+        self.assertEqual([position['id'] for position in message['positions']], [east.id, west.id])
+        message = json.loads(await scoped.receive_from())
+        self.assertEqual(message['positions'], [{'id': east.id, 'x': 1, 'y': 1}])
+        # Both devices are collapsed into their site's node
+        self.assertTrue(await collapsed.receive_nothing(0.2))
+        for client in (whole, scoped, collapsed):
+            await client.disconnect()
+
+
+class PositionStreamTests(TransactionTestCase):
+    def setUp(self):
+        self.stream = PositionStream(throttle=60, flush_interval=60)
+        self.sent = mock.AsyncMock()
+        patcher = mock.patch.object(self.stream, '_send', new=self.sent)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def submit(self, *positions, sender='a'):
+        await self.stream.submit(list(positions), sender)
+        # Don't leave timers behind on the test loop
+        if self.stream._send_handle is not None:
+            self.stream._send_handle.cancel()
+            self.stream._send_handle = None
+        if self.stream._flush_task is not None:
+            self.stream._flush_task.cancel()
+
+    async def test_throttle_sends_first_and_latest(self):
+        await self.submit({'id': 1, 'x': 0, 'y': 0})
+        await self.submit({'id': 1, 'x': 5, 'y': 5})
+        await self.submit({'id': 1, 'x': 9, 'y': 9}, {'id': 2, 'x': 'bad', 'y': 0})
+        self.sent.assert_awaited_once_with([{'id': 1, 'x': 0, 'y': 0}], 'a')
+
+        await self.stream._send_pending()
+        self.assertEqual(self.sent.await_args, mock.call([{'id': 1, 'x': 9, 'y': 9}], 'a'))
+        self.assertEqual(self.stream._pending_send, {})
+
+    async def test_flush_writes_latest_positions_in_one_batch(self):
+        first = await Device.objects.acreate(name='a', device_type='switch', ip_address='10.0.0.1')
+        second = await Device.objects.acreate(name='b', device_type='switch', ip_address='10.0.0.2')
+        await self.submit({'id': first.id, 'x': 1, 'y': 1}, {'id': second.id, 'x': 2, 'y': 2})
+        await self.submit({'id': first.id, 'x': 3, 'y': 4}, {'id': 999, 'x': 0, 'y': 0})
+
+        with mock.patch('api.positions.topology_notices') as notices, \
+                mock.patch.object(Device.objects, 'bulk_update', wraps=Device.objects.bulk_update) as bulk_update:
+            await self.stream.flush()
+            await self.stream.flush()
+        bulk_update.assert_called_once()
+        notices.changed.assert_called_once_with(POSITIONS)
+        positions = {device.id: (device.position_x, device.position_y) async for device in Device.objects.all()}
+        self.assertEqual(positions, {first.id: (3, 4), second.id: (2, 2)})
+
+
+class UpdatePositionTests(TestCase):
+    def test_position_update_is_not_a_structure_change(self):
+        device = Device.objects.create(name='a', device_type='switch', ip_address='10.0.0.1')
+        with mock.patch('api.views.topology_notices') as view_notices, \
+                mock.patch('api.signals.topology_notices') as signal_notices, \
+                mock.patch('api.views.position_stream.relay') as relay:
+            response = self.client.post(
+                reverse('update_device_position', args=[device.id]), {'x': 10, 'y': 20}, content_type='application/json'
+            )
+        self.assertEqual(response.status_code, 200)
+        view_notices.changed.assert_called_once_with(POSITIONS)
+        signal_notices.changed.assert_not_called()
+        relay.assert_called_once_with([{'id': device.id, 'x': 10, 'y': 20}])
+        device.refresh_from_db()
+        self.assertEqual((device.position_x, device.position_y), (10, 20))
+
+        response = self.client.post(
+            reverse('update_device_position', args=[device.id]), {'x': 'left'}, content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 400)
+
+
+class SubscriptionsTests(TestCase):
+    def test_site_subscribers_narrow_fetches(self):
+        subscriptions = Subscriptions()
+        self.assertIsNone(subscriptions.wanted_sites())
+        self.assertFalse(subscriptions.subscribe(('ams1',)))
+        self.assertEqual(subscriptions.wanted_sites(), {'ams1'})
+        self.assertFalse(subscriptions.subscribe(('ams1',), 'rack'))
+        self.assertTrue(subscriptions.subscribe(('fra2',)))
+
+    def test_whole_map_readers_keep_every_link(self):
+        subscriptions = Subscriptions(reader_timeout=60)
+        subscriptions.subscribe(('ams1',))
+        with mock.patch('api.scopes.time.monotonic', return_value=1000):
+            self.assertTrue(subscriptions.read())
+            self.assertIsNone(subscriptions.wanted_sites())
+        with mock.patch('api.scopes.time.monotonic', return_value=1059):
+            self.assertIsNone(subscriptions.wanted_sites())
+        with mock.patch('api.scopes.time.monotonic', return_value=1061):
+            self.assertEqual(subscriptions.wanted_sites(), {'ams1'})
+
+    def test_site_readers_add_their_sites(self):
+        subscriptions = Subscriptions(reader_timeout=60)
+        subscriptions.subscribe(('ams1',))
+        self.assertTrue(subscriptions.read(('fra2',)))
+        self.assertEqual(subscriptions.wanted_sites(), {'ams1', 'fra2'})
+        self.assertFalse(subscriptions.read(('ams1',)))
+
+    def test_http_topology_reads_the_whole_map(self):
+        with mock.patch('api.views.subscriptions.read', return_value=True) as read, \
+                mock.patch('api.views.collector.wake') as wake, \
+                mock.patch('api.views.collector.get_snapshot', return_value={}):
+            self.client.get(reverse('get_topology'))
+            self.client.get(reverse('get_topology'), {'site': 'ams1'})
+        self.assertEqual(read.call_args_list, [mock.call(None), mock.call(('ams1',))])
+        self.assertEqual(wake.call_count, 2)
@@ -5,12 +5,25 @@ urlpatterns = [
     path('topology/', views.get_topology, name='get_topology'),
     path('devices/', views.list_devices, name='list_devices'),
     path('devices/create/', views.create_device, name='create_device'),
+    path('devices/bulk/', views.bulk_devices, name='bulk_devices'),
+    path('devices/positions/', views.bulk_update_positions, name='bulk_update_positions'),
+    path('devices/layout/', views.auto_layout, name='auto_layout'),
     path('devices/<int:device_id>/delete/', views.delete_device, name='delete_device'),
     path('links/', views.list_links, name='list_links'),
     path('links/create/', views.create_link, name='create_link'),
+    path('links/bulk/', views.bulk_links, name='bulk_links'),
+    path('links/history/', views.link_history, name='link_history'),
+    path('links/history/range/', views.link_history_range, name='link_history_range'),
     path('links/<int:link_id>/delete/', views.delete_link, name='delete_link'),
     path('device/<int:device_id>/position/', views.update_device_position, name='update_device_position'),
     path('devices/<int:device_id>/update/', views.update_device, name='update_device'),
     path('links/<int:link_id>/update/', views.update_link, name='update_link'),
     path('links/<int:link_id>/', views.get_link, name='get_link'),
+    path('graph/path/', views.graph_path, name='graph_path'),
+    path('graph/reachable/', views.graph_reachable, name='graph_reachable'),
+    path('graph/impact/', views.graph_impact, name='graph_impact'),
+    path('graph/articulation/', views.graph_articulation, name='graph_articulation'),
+    path('import/', views.import_topology, name='import_topology'),
+    path('snapshot/', views.topology_snapshot, name='topology_snapshot'),
+    path('icons/<str:icon_hash>/', views.get_icon, name='get_icon'),
 ]
@@ -1,26 +1,54 @@
+import csv
+import math
+import re
+import time
+from datetime import datetime
+from functools import lru_cache
+from django.db import transaction, IntegrityError
+from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date
+from django.http import HttpResponse, HttpResponseNotModified, Http404, JsonResponse
 from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET, require_http_methods
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
 from rest_framework import status
 from django.conf import settings
-from .models import Device, Link
-from .serializers import DeviceSerializer, LinkSerializer
-from .prometheus_client import PrometheusClient
+from .models import Device, Link, Icon
+from .icons import make_thumbnail, THUMBNAIL_MIN_SIZE, THUMBNAIL_MAX_SIZE
+from .serializers import DeviceSerializer, LinkSerializer, BulkDeviceSerializer, BulkLinkSerializer
+from .collector import collector
+from .cache import topology_cache
+from .graph import graph_index
+from .changelog import topology_log
+from .scopes import subscriptions, scope_group, parse_sites, view_topology
+from .aggregate import parse_level
+from .encoding import encode_frames, encode_json, compress_body
+from .broadcast import BroadcastScheduler
+from .positions import position_stream
+from .notices import topology_notices, POSITIONS
+from .history import bandwidth_history, range_cache, lttb
+from . import importer, layout, snapshot
+from .snapshot import snapshot_writer
+from .prometheus_client import PrometheusUnavailable
+from .instrumentation import (
+    registry, count_queries, topology_build_seconds, topology_build_queries, broadcast_seconds, payload_bytes
+)
 
 # WebSocket imports
 from channels.layers import get_channel_layer
 from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
 
-prom = PrometheusClient(settings.PROMETHEUS_URL)
 
-
-def get_topology_data():
+def get_topology_structure():
     """
-    Helper function to extract topology data.
-    Used by both HTTP endpoint and WebSocket consumer.
+    Build nodes and edges from the database without any metrics.
+    Runs a fixed number of queries regardless of topology size.
     """
     devices = Device.objects.all()
-    links = Link.objects.all()
+    links = Link.objects.select_related('source_device', 'target_device')
 
     # Build nodes
     nodes = []
@@ -32,84 +60,313 @@ def get_topology_data():
             'ip': device.ip_address,
             'is_monitored': device.is_monitored,
             'prometheus_instance': device.prometheus_instance,
+            'site': device.site,
+            'rack': device.rack,
             'icon': device.icon,
+            'icon_url': device.icon_url,
             'position': {'x': device.position_x, 'y': device.position_y}
         })
 
-    # Build edges with real-time bandwidth
+    # Build edges, remembering where each link's bandwidth comes from
     edges = []
-    metrics_timestamp = None
-    
     for link in links:
-        # Get metrics from whichever device is monitored
+        edges.append({
+            'id': link.id,
+            'source': link.source_device_id,
+            'target': link.target_device_id,
+            'source_interface': link.source_interface,
+            'target_interface': link.target_interface,
+            'capacity': link.bandwidth_capacity,
+            'metric_key': link.metric_key,
+            'metric_side': link.metric_side
+        })
+
+    return nodes, edges
+
+
+def apply_metrics(nodes, edges, snapshot):
+    """
+    Combine topology structure with a metrics snapshot into the API payload.
+    """
+    now = time.time()
+    edge_data = []
+
+    for edge in edges:
         metrics = {'inbound': 0, 'outbound': 0, 'timestamp': None}
         utilization = 0
+        age = None
+        stale = False
+        capacity = edge['capacity']
 
-        if link.source_device.is_monitored and link.source_device.prometheus_instance:
-            # Query source device
-            metrics = prom.get_interface_bandwidth(
-                link.source_device.prometheus_instance,
-                link.source_interface
-            )
+        if edge['metric_key'] in snapshot:
+            metrics = snapshot[edge['metric_key']]
             total_bandwidth = metrics['inbound'] + metrics['outbound']
-            utilization = (total_bandwidth / (link.bandwidth_capacity * 2)) * 100 if link.bandwidth_capacity > 0 else 0
-            metrics_timestamp = metrics.get('timestamp')
-        elif link.target_device.is_monitored and link.target_device.prometheus_instance:
-            # Query target device (for dummy source nodes like ISP)
-            metrics = prom.get_interface_bandwidth(
-                link.target_device.prometheus_instance,
-                link.target_interface
-            )
-            total_bandwidth = metrics['inbound'] + metrics['outbound']
-            utilization = (total_bandwidth / (link.bandwidth_capacity * 2)) * 100 if link.bandwidth_capacity > 0 else 0
-            metrics_timestamp = metrics.get('timestamp')
+            utilization = (total_bandwidth / (capacity * 2)) * 100 if capacity > 0 else 0
+            age = round(now - metrics['fetched_at'], 1)
+            stale = metrics['stale']
 
-        edges.append({
-            'id': link.id,
-            'source': link.source_device.id,
-            'target': link.target_device.id,
-            'source_interface': link.source_interface,
-            'target_interface': link.target_interface,
+        edge_data.append({
+            'id': edge['id'],
+            'source': edge['source'],
+            'target': edge['target'],
+            'source_interface': edge['source_interface'],
+            'target_interface': edge['target_interface'],
+            # Inbound and outbound are as seen by this end's interface
+            'metric_side': edge['metric_side'],
             'bandwidth': {
                 'inbound': metrics['inbound'],
                 'outbound': metrics['outbound'],
-                'capacity': link.bandwidth_capacity,
+                'capacity': capacity,
                 'utilization': round(utilization, 1)
-            }
+            },
+            'metrics_age': age,
+            'metrics_stale': stale
         })
 
     return {
         'nodes': nodes,
-        'edges': edges,
-        'timestamp': metrics_timestamp
+        'edges': edge_data,
+        'timestamp': collector.updated_at
     }
 
 
-def broadcast_topology_update():
+def get_topology_data():
+    """
+    Helper function to extract topology data.
+    Used by both HTTP endpoint and WebSocket consumer.
+    """
+    with topology_build_seconds.time(mode='sync'):
+        nodes, edges = get_cached_structure()
+        return apply_metrics(nodes, edges, collector.get_snapshot())
+
+
+async def aget_topology_data():
+    """
+    Async counterpart of get_topology_data() for the Channels path.
+    Only the ORM read runs in the thread pool; metrics are awaited.
     """
-    Broadcast topology update to all connected WebSocket clients.
-    Call this after any device or link changes.
+    with topology_build_seconds.time(mode='async'):
+        structure = topology_cache.peek()
+        if structure is None:
+            structure = await database_sync_to_async(get_cached_structure)()
+        else:
+            topology_build_queries.observe(0)
+        nodes, edges = structure
+        snapshot = await collector.aget_snapshot()
+        return apply_metrics(nodes, edges, snapshot)
+
+
+def get_cached_structure():
+    """Cached topology structure, recording how many queries it took"""
+    with count_queries() as queries:
+        structure = topology_cache.get(get_topology_structure)
+    topology_build_queries.observe(queries[0])
+    return structure
+
+
+def patch_message(revision, base, ops):
+    """
+    Channel layer event carrying one topology patch.
+    The patch is encoded once per frame encoding in use here, so consumers
+    only forward prepared frames instead of serializing it per client.
+    """
+    return {
+        'type': 'topology_patch',
+        'origin': topology_log.origin,
+        'revision': revision,
+        'base': base,
+        'frames': encode_frames({
+            'type': 'topology_patch',
+            'revision': revision,
+            'base': base,
+            'ops': ops
+        })
+    }
+
+
+def record_topology(data, source=None):
+    """
+    Record a topology build in the change log and in the log of every view
+    (sites, detail level) clients subscribed to. Returns (revision, [(group, message), ...])
+    with the patches to send.
+    """
+    revision, base, ops = topology_log.publish(data, source)
+    messages = []
+    if ops:
+        messages.append((scope_group(None), patch_message(revision, base, ops)))
+    for sites, level, view_revision, view_base, view_ops in subscriptions.publish(data):
+        if view_ops:
+            messages.append((scope_group(sites, level), patch_message(view_revision, view_base, view_ops)))
+    for group, message in messages:
+        # Revisions are only comparable within one group
+        message['group'] = group
+    return revision, messages
+
+
+def publish_topology(data, source=None):
+    """
+    Record a topology build and send any resulting patches to the connected
+    WebSocket clients. Returns the current revision.
     """
+    revision, messages = record_topology(data, source)
     channel_layer = get_channel_layer()
-    if channel_layer:
-        try:
-            topology_data = get_topology_data()
-            async_to_sync(channel_layer.group_send)(
-                'topology_updates',
-                {
-                    'type': 'topology_update',
-                    'data': topology_data
-                }
-            )
-        except Exception as e:
-            print(f"Error broadcasting topology update: {e}")
+    if messages and channel_layer:
+        with broadcast_seconds.time(type='topology_patch'):
+            for group, message in messages:
+                async_to_sync(channel_layer.group_send)(group, message)
+    return revision
+
+
+async def apublish_topology(data, source=None):
+    """Async counterpart of publish_topology()"""
+    revision, messages = record_topology(data, source)
+    channel_layer = get_channel_layer()
+    if messages and channel_layer:
+        with broadcast_seconds.time(type='topology_patch'):
+            for group, message in messages:
+                await channel_layer.group_send(group, message)
+    return revision
+
+
+def topology_state():
+    """
+    What a topology build is made from: the structure cache generation, the
+    metrics snapshot time and the set of subscribed views. While it stays
+    the same, so does the published topology.
+    """
+    return topology_cache.generation, collector.updated_at, subscriptions.version
+
+
+def publish_current():
+    """
+    Build and publish the topology if anything it is made from changed since
+    the last publish, so idle polling costs no rebuild. Returns the revision.
+    """
+    # Without a running collector this refreshes stale metrics first
+    collector.get_snapshot()
+    state = topology_state()
+    if state == topology_log.source:
+        return topology_log.revision
+    return publish_topology(get_topology_data(), state)
+
+
+async def apublish_current():
+    """Async counterpart of publish_current()"""
+    await collector.aget_snapshot()
+    state = topology_state()
+    if state == topology_log.source:
+        return topology_log.revision
+    return await apublish_topology(await aget_topology_data(), state)
+
+
+def broadcast_topology_update():
+    """
+    Broadcast topology changes to all connected WebSocket clients.
+    Views should call schedule_topology_update() instead.
+    """
+    try:
+        publish_current()
+    except Exception as e:
+        print(f"Error broadcasting topology update: {e}")
+
+
+async def abroadcast_topology_update():
+    """Push metric changes after each background collector refresh"""
+    await apublish_current()
+
+
+collector.add_listener(abroadcast_topology_update)
+collector.add_listener(snapshot_writer.on_refresh)
+
+broadcast_scheduler = BroadcastScheduler(
+    abroadcast_topology_update,
+    broadcast_topology_update,
+    window=settings.BROADCAST_DEBOUNCE,
+    max_delay=settings.BROADCAST_MAX_DELAY
+)
+
+# Another worker changed devices or links: push the result to our clients too
+topology_notices.add_listener(broadcast_scheduler.mark_dirty)
+
+
+def schedule_topology_update():
+    """
+    Mark the topology dirty after device or link changes.
+    Bursts of changes are merged into one broadcast, sent outside the request.
+    """
+    # Bulk writes bypass model signals, so drop the cached structure here too
+    topology_cache.invalidate()
+    topology_notices.changed()
+    broadcast_scheduler.mark_dirty()
+
+
+def read_metrics(sites=None):
+    """Keep the collector fetching `sites` (None: every link) for an HTTP or internal reader"""
+    if subscriptions.read(sites):
+        # Their links were not being fetched, don't wait for the next refresh
+        collector.wake()
 
 
 @api_view(['GET'])
 def get_topology(request):
-    """Return network topology with real-time metrics"""
-    data = get_topology_data()
-    return Response(data)
+    """
+    Return network topology with real-time metrics.
+
+    Responses carry the topology revision as ETag, so polling clients get
+    304 Not Modified until something changes. ?since=<revision> returns just
+    the patch ops published after that revision, or the full topology if
+    they are no longer retained.
+
+    ?site=a,b limits the topology to those sites' devices and the links
+    touching them, ?level=site or ?level=rack collapses each group into one
+    node with merged links between groups; with ?since these return the
+    full view whenever anything changed.
+    """
+    since = request.GET.get('since')
+    if since is not None:
+        try:
+            since = int(since)
+        except ValueError:
+            return Response({'error': 'since must be a revision number'}, status=status.HTTP_400_BAD_REQUEST)
+    sites = parse_sites(request.GET.get('site'))
+    try:
+        level = parse_level(request.GET.get('level'))
+    except ValueError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    read_metrics(sites)
+
+    # Only rebuilds when the structure or metrics moved on since the last publish
+    publish_current()
+    revision, data = topology_log.snapshot()
+    modified_at = topology_log.modified_at
+
+    # Weak, as the same revision is served gzip, brotli or uncompressed
+    etag = f'W/"{revision}"'
+    response = get_conditional_response(request, etag=etag, last_modified=int(modified_at))
+    if response is None:
+        whole_map = sites is None and level is None
+        entries = topology_log.since(since) if since is not None and whole_map else None
+        if not whole_map:
+            payload = dict(view_topology(data, sites, level), revision=revision)
+        elif entries is None:
+            payload = dict(data, revision=revision)
+        else:
+            payload = {'revision': revision, 'base': since, 'ops': [op for _, ops in entries for op in ops]}
+
+        body, content_encoding = compress_body(
+            encode_json(payload).encode(), request.headers.get('Accept-Encoding', '')
+        )
+        payload_bytes.observe(len(body), type='topology_http', encoding=content_encoding or 'identity')
+        response = HttpResponse(body, content_type='application/json')
+        if content_encoding:
+            response['Content-Encoding'] = content_encoding
+
+    patch_vary_headers(response, ['Accept-Encoding'])
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(modified_at)
+    # Let browsers keep the response but always revalidate it
+    response['Cache-Control'] = 'no-cache'
+    return response
 
 
 @csrf_exempt
@@ -117,13 +374,21 @@ def get_topology(request):
 def update_device_position(request, device_id):
     """Save device position when dragged"""
     try:
-        device = Device.objects.get(id=device_id)
-        device.position_x = request.data.get('x', device.position_x)
-        device.position_y = request.data.get('y', device.position_y)
-        device.save()
-        return Response({'status': 'ok'})
+        device = Device.objects.only('position_x', 'position_y').get(id=device_id)
     except Device.DoesNotExist:
         return Response({'error': 'Device not found'}, status=status.HTTP_404_NOT_FOUND)
+    try:
+        x = int(request.data.get('x', device.position_x))
+        y = int(request.data.get('y', device.position_y))
+    except (TypeError, ValueError):
+        return Response({'error': 'x and y must be integers'}, status=status.HTTP_400_BAD_REQUEST)
+
+    # update() skips post_save, which would announce a structure change
+    Device.objects.filter(pk=device.pk).update(position_x=x, position_y=y)
+    topology_cache.invalidate()
+    topology_notices.changed(POSITIONS)
+    position_stream.relay([{'id': device.pk, 'x': x, 'y': y}])
+    return Response({'status': 'ok'})
 
 
 @csrf_exempt
@@ -137,13 +402,16 @@ def update_device(request, device_id):
         device.ip_address = request.data.get('ip_address', device.ip_address)
         device.prometheus_instance = request.data.get('prometheus_instance', device.prometheus_instance)
         device.is_monitored = request.data.get('is_monitored', device.is_monitored)
+        device.site = request.data.get('site', device.site)
+        device.rack = request.data.get('rack', device.rack)
 
-        # Handle icon updates
+        # Handle icon updates (data URLs are moved to Icon on save)
         if 'icon' in request.data:
             device.icon = request.data.get('icon')
+            device.icon_hash = ''
 
         device.save()
-        broadcast_topology_update()
+        schedule_topology_update()
         
         serializer = DeviceSerializer(device)
         return Response(serializer.data)
@@ -162,7 +430,7 @@ def list_devices(request):
 @api_view(['GET'])
 def list_links(request):
     """List all links"""
-    links = Link.objects.all()
+    links = Link.objects.select_related('source_device', 'target_device')
     serializer = LinkSerializer(links, many=True)
     return Response(serializer.data)
 
@@ -173,7 +441,7 @@ def create_device(request):
     serializer = DeviceSerializer(data=request.data)
     if serializer.is_valid():
         serializer.save()
-        broadcast_topology_update()
+        schedule_topology_update()
         return Response(serializer.data, status=status.HTTP_201_CREATED)
     return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
@@ -184,7 +452,7 @@ def create_link(request):
     serializer = LinkSerializer(data=request.data)
     if serializer.is_valid():
         serializer.save()
-        broadcast_topology_update()
+        schedule_topology_update()
         return Response(serializer.data, status=status.HTTP_201_CREATED)
     return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
@@ -195,7 +463,7 @@ def delete_device(request, device_id):
     try:
         device = Device.objects.get(id=device_id)
         device.delete()
-        broadcast_topology_update()
+        schedule_topology_update()
         return Response({'status': 'deleted'}, status=status.HTTP_204_NO_CONTENT)
     except Device.DoesNotExist:
         return Response({'error': 'Device not found'}, status=status.HTTP_404_NOT_FOUND)
@@ -207,7 +475,7 @@ def delete_link(request, link_id):
     try:
         link = Link.objects.get(id=link_id)
         link.delete()
-        broadcast_topology_update()
+        schedule_topology_update()
         return Response({'status': 'deleted'}, status=status.HTTP_204_NO_CONTENT)
     except Link.DoesNotExist:
         return Response({'error': 'Link not found'}, status=status.HTTP_404_NOT_FOUND)
@@ -222,7 +490,7 @@ def update_link(request, link_id):
         link.target_interface = request.data.get('target_interface', link.target_interface)
         link.bandwidth_capacity = request.data.get('bandwidth_capacity', link.bandwidth_capacity)
         link.save()
-        broadcast_topology_update()
+        schedule_topology_update()
         
         serializer = LinkSerializer(link)
         return Response(serializer.data)
@@ -234,8 +502,757 @@ def update_link(request, link_id):
 def get_link(request, link_id):
     """Get a single link"""
     try:
-        link = Link.objects.get(id=link_id)
+        link = Link.objects.select_related('source_device', 'target_device').get(id=link_id)
         serializer = LinkSerializer(link)
         return Response(serializer.data)
     except Link.DoesNotExist:
         return Response({'error': 'Link not found'}, status=status.HTTP_404_NOT_FOUND)
+
+
+def link_metric_keys(request):
+    """
+    {link_id: (instance, ifName)} for ?ids=1,2,3 (all links when omitted),
+    read from the cached topology structure. None if ids are malformed.
+    """
+    _, edges = topology_cache.get(get_topology_structure)
+    keys = {edge['id']: edge['metric_key'] for edge in edges if edge['metric_key']}
+    ids = request.GET.get('ids')
+    if not ids:
+        return keys
+    try:
+        wanted = {int(link_id) for link_id in ids.split(',') if link_id}
+    except ValueError:
+        return None
+    return {link_id: key for link_id, key in keys.items() if link_id in wanted}
+
+
+@api_view(['GET'])
+def link_history(request):
+    """
+    Recent bandwidth samples for many links, for sparklines.
+    ?ids=1,2,3 selects links and ?points=N downsamples each series.
+    Served from memory, no Prometheus queries.
+    """
+    keys = link_metric_keys(request)
+    if keys is None:
+        return Response({'error': 'ids must be a comma separated list of link ids'}, status=status.HTTP_400_BAD_REQUEST)
+    try:
+        points = max(1, int(request.GET.get('points', 30)))
+    except ValueError:
+        return Response({'error': 'points must be an integer'}, status=status.HTTP_400_BAD_REQUEST)
+
+    read_metrics()
+    timestamps, series = bandwidth_history.series(set(keys.values()), points)
+    links = {}
+    for link_id, key in keys.items():
+        if key in series:
+            inbound, outbound = series[key]
+            links[link_id] = {'in': inbound, 'out': outbound}
+    return Response({'timestamps': timestamps, 'links': links})
+
+
+DURATION_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+# Prometheus returns about this many raw points per downsampled point
+RAW_POINTS_PER_POINT = 10
+# Prometheus refuses range queries over 11,000 points per series
+MAX_RANGE_POINTS = 11000
+
+
+def parse_duration(value):
+    """Seconds in a duration like 90, 15m, 6h or 30d, or None if malformed"""
+    match = re.fullmatch(r'([0-9]+)([smhdw]?)', value or '')
+    if not match:
+        return None
+    return int(match.group(1)) * DURATION_UNITS[match.group(2) or 's']
+
+
+def downsample(values, points):
+    """[[t, v], ...] with at most `points` points, NaN samples dropped"""
+    values = [(t, v) for t, v in values if not math.isnan(v)]
+    return [[int(t), round(v, 3)] for t, v in lttb(values, points)]
+
+
+@api_view(['GET'])
+def link_history_range(request):
+    """
+    Bandwidth history for many links over ?window=30d (default 1d), fetched
+    with batched query_range calls and downsampled with LTTB to ?points=N.
+    ?step= sets the Prometheus resolution. Repeat views are served from cache.
+    """
+    keys = link_metric_keys(request)
+    if keys is None:
+        return Response({'error': 'ids must be a comma separated list of link ids'}, status=status.HTTP_400_BAD_REQUEST)
+    window = parse_duration(request.GET.get('window', '1d'))
+    step = parse_duration(request.GET.get('step', '0'))
+    if not window or step is None:
+        return Response({'error': 'window and step must be durations like 90, 15m, 6h or 30d'},
+                        status=status.HTTP_400_BAD_REQUEST)
+    try:
+        points = min(max(3, int(request.GET.get('points', 300))), 2000)
+    except ValueError:
+        return Response({'error': 'points must be an integer'}, status=status.HTTP_400_BAD_REQUEST)
+
+    if not step:
+        step = max(60, math.ceil(window / (points * RAW_POINTS_PER_POINT)))
+    step = max(step, math.ceil(window / MAX_RANGE_POINTS))
+    # Align to the step so repeat views within one step hit the cache
+    end = int(time.time()) // step * step
+    start = end - window
+
+    pairs = tuple(sorted(set(keys.values())))
+    cache_key = (pairs, window, step, points, end)
+    series = range_cache.get(cache_key)
+    if series is None:
+        try:
+            history = collector.client.get_bulk_interface_history(pairs, start, end, step)
+        except PrometheusUnavailable as e:
+            return Response({'error': f'Prometheus unavailable: {e}'}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        series = {
+            key: {'in': downsample(values['inbound'], points), 'out': downsample(values['outbound'], points)}
+            for key, values in history.items()
+        }
+        range_cache.set(cache_key, series)
+
+    return Response({
+        'start': start,
+        'end': end,
+        'step': step,
+        'links': {link_id: series[key] for link_id, key in keys.items() if key in series}
+    })
+
+
+# Fields each bulk update may change, matching the single-object update views
+DEVICE_UPDATE_FIELDS = ['name', 'device_type', 'ip_address', 'prometheus_instance', 'is_monitored', 'site', 'rack', 'icon']
+LINK_UPDATE_FIELDS = ['source_interface', 'target_interface', 'bandwidth_capacity']
+
+
+def bulk_items(request):
+    """Return the list of items in a bulk request body, or None if malformed"""
+    items = request.data.get('items') if isinstance(request.data, dict) else request.data
+    if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+        return None
+    return items
+
+
+def bulk_ids(request):
+    ids = request.data.get('ids') if isinstance(request.data, dict) else request.data
+    if not isinstance(ids, list):
+        return None
+    try:
+        return [int(i) for i in ids]
+    except (TypeError, ValueError):
+        return None
+
+
+def duplicate_errors(items, key, message):
+    """Per-item errors for items whose key() repeats an earlier item in the batch"""
+    seen = {}
+    errors = []
+    for index, item in enumerate(items):
+        value = key(item)
+        if value is None:
+            continue
+        if value in seen:
+            errors.append({'index': index, 'errors': {'non_field_errors': [message]}})
+        seen.setdefault(value, index)
+    return errors
+
+
+def chunked(values, size=500):
+    values = list(values)
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+
+def check_device_names(validated):
+    """
+    Errors for items whose name another device already has, with one query
+    per 500 names rather than a unique validator query per item.
+    validated: [(index, data, instance or None), ...]
+    """
+    names = {data['name'] for _, data, _ in validated if 'name' in data}
+    owners = {}
+    for chunk in chunked(names):
+        owners.update(Device.objects.filter(name__in=chunk).order_by().values_list('name', 'id'))
+    return [
+        {'index': index, 'errors': {'name': ['device with this name already exists.']}}
+        for index, data, instance in validated
+        if data.get('name') in owners and (instance is None or owners[data['name']] != instance.id)
+    ]
+
+
+def check_links(validated):
+    """
+    Resolve link endpoints with one in_bulk and check unique_together with
+    one query per 500 source devices, instead of three queries per item.
+    New items get their Device objects in place of the ids.
+    """
+    ids = {data[end] for _, data, instance in validated if instance is None
+           for end in ('source_device', 'target_device')}
+    devices = Device.objects.in_bulk(ids) if ids else {}
+    errors, keys = [], {}
+    for index, data, instance in validated:
+        if instance is None:
+            missing = {
+                end: [f'Invalid pk "{data[end]}" - object does not exist.']
+                for end in ('source_device', 'target_device') if data[end] not in devices
+            }
+            if missing:
+                errors.append({'index': index, 'errors': missing})
+                continue
+            data['source_device'] = devices[data['source_device']]
+            data['target_device'] = devices[data['target_device']]
+            source, target = data['source_device'].id, data['target_device'].id
+        else:
+            source, target = instance.source_device_id, instance.target_device_id
+        keys[index] = (
+            source, data.get('source_interface', getattr(instance, 'source_interface', None)),
+            target, data.get('target_interface', getattr(instance, 'target_interface', None))
+        )
+
+    existing = {}
+    for chunk in chunked({key[0] for key in keys.values()}):
+        existing.update(
+            (key[1:], key[0]) for key in Link.objects.filter(source_device_id__in=chunk).order_by().values_list(
+                'id', 'source_device_id', 'source_interface', 'target_device_id', 'target_interface'
+            )
+        )
+    message = 'The fields source_device, source_interface, target_device, target_interface must make a unique set.'
+    for index, data, instance in validated:
+        key = keys.get(index)
+        if key in existing and (instance is None or existing[key] != instance.id):
+            errors.append({'index': index, 'errors': {'non_field_errors': [message]}})
+    return errors
+
+
+def bulk_create_objects(request, model, serializer_class, item_serializer_class, check_batch,
+                        unique_key=None, unique_message=''):
+    """
+    Validate every item, then create them all with one bulk_create.
+    Items are validated without database lookups; check_batch() does those
+    for the whole batch at once.
+    """
+    items = bulk_items(request)
+    if items is None:
+        return Response({'error': 'Expected a list of objects'}, status=status.HTTP_400_BAD_REQUEST)
+
+    validated, errors = [], []
+    for index, item in enumerate(items):
+        serializer = item_serializer_class(data=item)
+        if serializer.is_valid():
+            validated.append((index, dict(serializer.validated_data), None))
+        else:
+            errors.append({'index': index, 'errors': serializer.errors})
+    errors += check_batch(validated)
+    if unique_key:
+        errors += duplicate_errors(items, unique_key, unique_message)
+    if errors:
+        return Response({'errors': sorted(errors, key=lambda e: e['index'])}, status=status.HTTP_400_BAD_REQUEST)
+
+    objects = [model(**data) for _, data, _ in validated]
+    try:
+        with transaction.atomic():
+            for obj in objects:
+                if isinstance(obj, Device):
+                    obj.store_icon()
+            created = model.objects.bulk_create(objects)
+    except IntegrityError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    # bulk_create sends no signals
+    graph_index.reload()
+
+    schedule_topology_update()
+    return Response(serializer_class(created, many=True).data, status=status.HTTP_201_CREATED)
+
+
+def bulk_update_objects(request, model, serializer_class, item_serializer_class, check_batch, allowed_fields):
+    """Validate partial updates for every item, then write them with one bulk_update"""
+    items = bulk_items(request)
+    if items is None:
+        return Response({'error': 'Expected a list of objects'}, status=status.HTTP_400_BAD_REQUEST)
+
+    # With link endpoints joined, so the response needs no further queries
+    instances = model.objects.select_related().in_bulk(
+        [item.get('id') for item in items if isinstance(item.get('id'), int)]
+    )
+    validated, errors = [], duplicate_errors(items, lambda item: item.get('id'), 'Duplicate id in this request')
+    duplicates = {error['index'] for error in errors}
+    for index, item in enumerate(items):
+        if index in duplicates:
+            continue
+        instance = instances.get(item.get('id'))
+        if instance is None:
+            errors.append({'index': index, 'errors': {'id': [f'{model.__name__} not found']}})
+            continue
+        changes = {field: item[field] for field in allowed_fields if field in item}
+        serializer = item_serializer_class(instance, data=changes, partial=True)
+        if not serializer.is_valid():
+            errors.append({'index': index, 'errors': serializer.errors})
+            continue
+        validated.append((index, dict(serializer.validated_data), instance))
+    errors += check_batch(validated)
+    if errors:
+        return Response({'errors': sorted(errors, key=lambda e: e['index'])}, status=status.HTTP_400_BAD_REQUEST)
+
+    objects, fields = [], set()
+    for index, data, instance in validated:
+        for field, value in data.items():
+            setattr(instance, field, value)
+            fields.add(field)
+        if isinstance(instance, Device) and 'icon' in items[index]:
+            instance.icon_hash = ''
+            instance.store_icon()
+            fields.add('icon_hash')
+        objects.append(instance)
+
+    if fields:
+        # bulk_update skips auto_now, so stamp updated_at ourselves
+        now = timezone.now()
+        for obj in objects:
+            obj.updated_at = now
+        try:
+            with transaction.atomic():
+                model.objects.bulk_update(objects, sorted(fields | {'updated_at'}), batch_size=500)
+        except IntegrityError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        schedule_topology_update()
+
+    return Response(serializer_class(objects, many=True).data)
+
+
+def bulk_delete_objects(request, model):
+    ids = bulk_ids(request)
+    if ids is None:
+        return Response({'error': 'Expected a list of ids'}, status=status.HTTP_400_BAD_REQUEST)
+
+    with transaction.atomic():
+        existing = set(model.objects.filter(id__in=ids).values_list('id', flat=True))
+        model.objects.filter(id__in=existing).delete()
+
+    if existing:
+        schedule_topology_update()
+    return Response({
+        'status': 'deleted',
+        'deleted': sorted(existing),
+        'not_found': sorted(set(ids) - existing)
+    })
+
+
+@csrf_exempt
+@api_view(['POST', 'PUT', 'DELETE'])
+def bulk_devices(request):
+    """Create (POST), update (PUT) or delete (DELETE) many devices in one transaction"""
+    if request.method == 'POST':
+        return bulk_create_objects(
+            request, Device, DeviceSerializer, BulkDeviceSerializer, check_device_names,
+            unique_key=lambda item: item.get('name'),
+            unique_message='Duplicate device name in this request'
+        )
+    if request.method == 'PUT':
+        return bulk_update_objects(
+            request, Device, DeviceSerializer, BulkDeviceSerializer, check_device_names, DEVICE_UPDATE_FIELDS
+        )
+    return bulk_delete_objects(request, Device)
+
+
+@csrf_exempt
+@api_view(['POST', 'PUT', 'DELETE'])
+def bulk_links(request):
+    """Create (POST), update (PUT) or delete (DELETE) many links in one transaction"""
+    if request.method == 'POST':
+        return bulk_create_objects(
+            request, Link, LinkSerializer, BulkLinkSerializer, check_links,
+            unique_key=lambda item: (
+                item.get('source_device'), item.get('source_interface'),
+                item.get('target_device'), item.get('target_interface')
+            ),
+            unique_message='Duplicate link in this request'
+        )
+    if request.method == 'PUT':
+        return bulk_update_objects(
+            request, Link, LinkSerializer, BulkLinkSerializer, check_links, LINK_UPDATE_FIELDS
+        )
+    return bulk_delete_objects(request, Link)
+
+
+@csrf_exempt
+@api_view(['POST'])
+def bulk_update_positions(request):
+    """Save positions for many dragged devices: [{"id": 1, "x": 10, "y": 20}, ...]"""
+    items = bulk_items(request)
+    if items is None:
+        return Response({'error': 'Expected a list of objects'}, status=status.HTTP_400_BAD_REQUEST)
+
+    devices = Device.objects.in_bulk([item.get('id') for item in items if isinstance(item.get('id'), int)])
+    errors = duplicate_errors(items, lambda item: item.get('id'), 'Duplicate id in this request')
+    duplicates = {error['index'] for error in errors}
+    for index, item in enumerate(items):
+        if index in duplicates:
+            continue
+        device = devices.get(item.get('id'))
+        if device is None:
+            errors.append({'index': index, 'errors': {'id': ['Device not found']}})
+            continue
+        try:
+            device.position_x = int(item.get('x', device.position_x))
+            device.position_y = int(item.get('y', device.position_y))
+        except (TypeError, ValueError):
+            errors.append({'index': index, 'errors': {'position': ['x and y must be integers']}})
+    if errors:
+        return Response({'errors': sorted(errors, key=lambda e: e['index'])}, status=status.HTTP_400_BAD_REQUEST)
+
+    with transaction.atomic():
+        Device.objects.bulk_update(devices.values(), ['position_x', 'position_y'], batch_size=500)
+    # Only positions changed: relay them instead of rebuilding the topology
+    topology_cache.invalidate()
+    topology_notices.changed(POSITIONS)
+    position_stream.relay([
+        {'id': device.id, 'x': device.position_x, 'y': device.position_y}
+        for device in devices.values()
+    ])
+    return Response({'status': 'ok', 'updated': len(devices)})
+
+
+@csrf_exempt
+@api_view(['POST'])
+def auto_layout(request):
+    """
+    Lay out devices on the server and save their positions in one bulk update.
+
+    Body (all optional): {"algorithm": "force" or "layered", "devices": [ids]
+    or "all", "iterations": n, "spacing": px}. By default only new devices
+    (still at 0,0) are placed, around the others which stay where they are.
+    """
+    data = request.data if isinstance(request.data, dict) else {}
+    algorithm = data.get('algorithm', 'force')
+    if algorithm not in layout.ALGORITHMS:
+        return Response({'error': f"algorithm must be one of {', '.join(layout.ALGORITHMS)}"},
+                        status=status.HTTP_400_BAD_REQUEST)
+    try:
+        spacing = int(data.get('spacing', settings.LAYOUT_SPACING))
+        iterations = int(data['iterations']) if data.get('iterations') is not None else None
+    except (TypeError, ValueError):
+        return Response({'error': 'spacing and iterations must be integers'}, status=status.HTTP_400_BAD_REQUEST)
+    if spacing <= 0 or (iterations is not None and not 0 < iterations <= 1000):
+        return Response({'error': 'spacing must be positive and iterations between 1 and 1000'},
+                        status=status.HTTP_400_BAD_REQUEST)
+    if not layout.available():
+        return Response({'error': 'Server-side layout needs numpy: pip install numpy'},
+                        status=status.HTTP_501_NOT_IMPLEMENTED)
+
+    devices = Device.objects.in_bulk()
+    selected = data.get('devices')
+    if selected == 'all':
+        movable = set(devices)
+    elif isinstance(selected, list):
+        movable = {device_id for device_id in selected if device_id in devices}
+    else:
+        movable = {device.id for device in devices.values() if device.position_x == 0 and device.position_y == 0}
+    if not movable:
+        return Response({'status': 'ok', 'algorithm': algorithm, 'moved': 0, 'seconds': 0})
+
+    started = time.perf_counter()
+    moved = place_devices(devices, movable, algorithm, spacing, iterations)
+    return Response({
+        'status': 'ok',
+        'algorithm': algorithm,
+        'moved': moved,
+        'seconds': round(time.perf_counter() - started, 3)
+    })
+
+
+def place_devices(devices, movable, algorithm='force', spacing=None, iterations=None):
+    """Lay out the `movable` ids among `devices` ({id: Device}), save and relay their positions"""
+    positions = layout.compute_layout(
+        [(device.id, device.position_x, device.position_y, device.device_type) for device in devices.values()],
+        Link.objects.values_list('source_device_id', 'target_device_id'),
+        movable,
+        algorithm=algorithm,
+        spacing=spacing or settings.LAYOUT_SPACING,
+        iterations=iterations
+    )
+    moved = []
+    for device_id, (x, y) in positions.items():
+        device = devices[device_id]
+        device.position_x, device.position_y = x, y
+        moved.append(device)
+
+    with transaction.atomic():
+        Device.objects.bulk_update(moved, ['position_x', 'position_y'], batch_size=500)
+    topology_cache.invalidate()
+    topology_notices.changed(POSITIONS)
+    position_stream.relay([{'id': device.id, 'x': device.position_x, 'y': device.position_y} for device in moved])
+    return len(moved)
+
+
+@csrf_exempt
+@api_view(['POST'])
+def import_topology(request):
+    """
+    Import devices and links from LLDP neighbours in Prometheus or a NetBox
+    style export, matched against existing rows by name and link endpoints.
+
+    JSON body: {"source": "lldp"} or {"format": "json" or "csv", "data": rows
+    or CSV text}, or a multipart upload with a "file" field. Options:
+    "dry_run" (only report the diff), "layout" ("force" or "layered", to place
+    the new devices), "default_type" and "default_capacity" for rows without.
+    """
+    data = request.data if isinstance(request.data, dict) else {'data': request.data}
+    upload = request.FILES.get('file')
+    source = data.get('source', 'lldp' if upload is None and 'data' not in data else 'netbox')
+    format = data.get('format') or ('csv' if upload is not None and upload.name.endswith('.csv') else 'json')
+    dry_run = str(data.get('dry_run', '')).lower() in ('1', 'true', 'yes')
+    algorithm = data.get('layout') or None
+    if source not in ('lldp', 'netbox'):
+        return Response({'error': 'source must be lldp or netbox'}, status=status.HTTP_400_BAD_REQUEST)
+    if format not in importer.FORMATS:
+        return Response({'error': f"format must be one of {', '.join(importer.FORMATS)}"},
+                        status=status.HTTP_400_BAD_REQUEST)
+    if algorithm is not None and algorithm not in layout.ALGORITHMS:
+        return Response({'error': f"layout must be one of {', '.join(layout.ALGORITHMS)}"},
+                        status=status.HTTP_400_BAD_REQUEST)
+    if algorithm is not None and not layout.available():
+        return Response({'error': 'Server-side layout needs numpy: pip install numpy'},
+                        status=status.HTTP_501_NOT_IMPLEMENTED)
+    default_type = data.get('default_type', 'switch')
+    if default_type not in dict(Device.DEVICE_TYPES):
+        return Response({'error': 'default_type is not a device type'}, status=status.HTTP_400_BAD_REQUEST)
+    try:
+        default_capacity = int(data.get('default_capacity', 1000))
+    except (TypeError, ValueError):
+        return Response({'error': 'default_capacity must be an integer'}, status=status.HTTP_400_BAD_REQUEST)
+
+    started = time.perf_counter()
+    topology = importer.TopologyImport(default_type=default_type, default_capacity=default_capacity)
+    try:
+        if source == 'lldp':
+            topology.add_lldp(collector.client)
+        else:
+            rows = upload.read() if upload is not None else data.get('data')
+            if isinstance(rows, list):
+                topology.add_rows(rows)
+            else:
+                topology.add_rows(importer.read_rows(rows or '', format))
+    except PrometheusUnavailable as e:
+        return Response({'error': f'Prometheus unavailable: {e}'}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+    except (ValueError, UnicodeDecodeError, csv.Error) as e:
+        return Response({'error': f'Could not read import: {e}'}, status=status.HTTP_400_BAD_REQUEST)
+
+    result = {
+        'status': 'dry_run' if dry_run else 'ok',
+        'summary': topology.summary(),
+        'changes': list(topology.diff()),
+        'errors': topology.errors
+    }
+    if not dry_run:
+        try:
+            created = topology.apply()
+        except IntegrityError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        if created and algorithm:
+            result['placed'] = place_devices(Device.objects.in_bulk(), created, algorithm)
+        schedule_topology_update()
+    result['seconds'] = round(time.perf_counter() - started, 3)
+    return Response(result)
+
+
+@csrf_exempt
+@require_http_methods(['GET', 'POST'])
+def topology_snapshot(request):
+    """
+    GET: the whole topology and last metrics in the compact binary snapshot
+    format (see api/snapshot.py). POST the same bytes, as the body or a
+    "file" upload, to make devices and links match it, ids included;
+    ?dry_run=1 only reports the counts.
+    """
+    if request.method == 'GET':
+        read_metrics()
+        data = snapshot.capture()
+        body, encoding = compress_body(data, request.headers.get('Accept-Encoding', ''))
+        response = HttpResponse(body, content_type='application/octet-stream')
+        if encoding:
+            response['Content-Encoding'] = encoding
+        patch_vary_headers(response, ['Accept-Encoding'])
+        response['Content-Disposition'] = f'attachment; filename="netmap-{time.strftime("%Y%m%d-%H%M%S")}.snapshot"'
+        return response
+
+    started = time.perf_counter()
+    upload = request.FILES.get('file')
+    data = upload.read() if upload is not None else request.body
+    dry_run = request.GET.get('dry_run', '').lower() in ('1', 'true', 'yes')
+    try:
+        restored = snapshot.decode(data)
+    except snapshot.SnapshotError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    try:
+        counts = snapshot.restore(restored, dry_run=dry_run)
+    except IntegrityError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    if not dry_run:
+        graph_index.reload()
+        schedule_topology_update()
+    return JsonResponse({
+        'status': 'dry_run' if dry_run else 'ok',
+        'created_at': datetime.fromtimestamp(restored.created_at).isoformat(),
+        **counts,
+        'seconds': round(time.perf_counter() - started, 3)
+    })
+
+
+def parse_ids(value):
+    """'1,2,3' -> {1, 2, 3}, raising ValueError if malformed"""
+    return {int(item) for item in (value or '').split(',') if item.strip()}
+
+
+def utilization_costs():
+    """
+    Link costs for utilization weighted paths: 1 when idle, rising as
+    1 / (1 - utilization) so busy links are avoided (100 at 99% and above)
+    """
+    read_metrics()
+    _, edges = get_cached_structure()
+    snapshot = collector.get_snapshot()
+    costs = {}
+    for edge in edges:
+        metrics = snapshot.get(edge['metric_key'])
+        if metrics is None or edge['capacity'] <= 0:
+            continue
+        utilization = min((metrics['inbound'] + metrics['outbound']) / (edge['capacity'] * 2), 0.99)
+        costs[edge['id']] = 1 / (1 - utilization)
+    return costs
+
+
+@api_view(['GET'])
+def graph_path(request):
+    """
+    Shortest path between two devices: ?source=1&target=2, by hop count or
+    with &weight=utilization around busy links.
+    """
+    weight = request.GET.get('weight', 'hops')
+    if weight not in ('hops', 'utilization'):
+        return Response({'error': 'weight must be hops or utilization'}, status=status.HTTP_400_BAD_REQUEST)
+    try:
+        source, target = int(request.GET['source']), int(request.GET['target'])
+    except (KeyError, ValueError):
+        return Response({'error': 'source and target must be device ids'}, status=status.HTTP_400_BAD_REQUEST)
+    for device_id in (source, target):
+        if not graph_index.has_device(device_id):
+            return Response({'error': f'Device {device_id} not found'}, status=status.HTTP_404_NOT_FOUND)
+
+    path = graph_index.shortest_path(source, target, utilization_costs() if weight == 'utilization' else None)
+    if path is None:
+        return Response({'error': f'No path between {source} and {target}'}, status=status.HTTP_404_NOT_FOUND)
+    devices, links, cost = path
+    return Response({
+        'source': source,
+        'target': target,
+        'weight': weight,
+        'hops': len(links),
+        'cost': cost,
+        'devices': devices,
+        'links': links
+    })
+
+
+@api_view(['GET'])
+def graph_reachable(request):
+    """
+    Devices reachable from ?source=1, optionally with &failed_devices=2,3
+    and &failed_links=4 down and within &max_hops=N
+    """
+    try:
+        source = int(request.GET['source'])
+        failed_devices = parse_ids(request.GET.get('failed_devices'))
+        failed_links = parse_ids(request.GET.get('failed_links'))
+        max_hops = int(request.GET['max_hops']) if request.GET.get('max_hops') else None
+    except (KeyError, ValueError):
+        return Response({'error': 'source, failed_devices, failed_links and max_hops must be integers'},
+                        status=status.HTTP_400_BAD_REQUEST)
+    if not graph_index.has_device(source):
+        return Response({'error': f'Device {source} not found'}, status=status.HTTP_404_NOT_FOUND)
+
+    devices = graph_index.reachable([source], failed_devices, failed_links, max_hops)
+    return Response({'source': source, 'count': len(devices), 'devices': sorted(devices)})
+
+
+@api_view(['GET'])
+def graph_impact(request):
+    """
+    Blast radius of a failure: ?failed_devices=1,2&failed_links=3. Devices
+    cut off from the ISP devices (or ?roots=...) are reported unreachable;
+    without either, everything outside the largest remaining part is.
+    """
+    try:
+        failed_devices = parse_ids(request.GET.get('failed_devices'))
+        failed_links = parse_ids(request.GET.get('failed_links'))
+        roots = parse_ids(request.GET.get('roots'))
+    except ValueError:
+        return Response({'error': 'failed_devices, failed_links and roots must be comma separated ids'},
+                        status=status.HTTP_400_BAD_REQUEST)
+    if not roots:
+        roots = set(Device.objects.filter(device_type='isp').values_list('id', flat=True))
+
+    impact = graph_index.impact(failed_devices, failed_links, roots)
+    return Response({
+        'failed_devices': sorted(failed_devices),
+        'failed_links': sorted(failed_links),
+        'roots': sorted(roots),
+        'unreachable': impact['unreachable'],
+        'links_down': impact['links_down']
+    })
+
+
+@api_view(['GET'])
+def graph_articulation(request):
+    """Single points of failure: devices (cut vertices) and links (bridges) whose loss splits the network"""
+    devices, links = graph_index.articulation_points()
+    return Response({'devices': sorted(devices), 'links': sorted(links)})
+
+
+@lru_cache(maxsize=256)
+def load_icon(icon_hash, size):
+    """Icon bytes and content type, downscaled when size is given. Icons never change."""
+    icon = Icon.objects.get(hash=icon_hash)
+    data = bytes(icon.data)
+    if size:
+        thumbnail = make_thumbnail(data, size)
+        if thumbnail is not None:
+            return thumbnail, 'image/png'
+    return data, icon.content_type
+
+
+@require_GET
+def get_icon(request, icon_hash):
+    """Serve an icon by content hash, optionally as a ?size=N thumbnail"""
+    try:
+        size = int(request.GET.get('size', 0))
+    except ValueError:
+        size = 0
+    if size:
+        size = max(THUMBNAIL_MIN_SIZE, min(size, THUMBNAIL_MAX_SIZE))
+
+    etag = f'"{icon_hash}-{size}"' if size else f'"{icon_hash}"'
+    cache_control = 'public, max-age=31536000, immutable'
+
+    if etag in request.headers.get('If-None-Match', ''):
+        response = HttpResponseNotModified()
+    else:
+        try:
+            data, content_type = load_icon(icon_hash, size)
+        except Icon.DoesNotExist:
+            raise Http404('Icon not found')
+        response = HttpResponse(data, content_type=content_type)
+
+    response['ETag'] = etag
+    response['Cache-Control'] = cache_control
+    # Never let an icon (SVG in particular) run script on NetMap's origin
+    response['Content-Security-Policy'] = "default-src 'none'; style-src 'unsafe-inline'; sandbox"
+    response['X-Content-Type-Options'] = 'nosniff'
+    return response
+
+
+@require_GET
+def metrics(request):
+    """NetMap's own metrics in the Prometheus text format, for this process"""
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
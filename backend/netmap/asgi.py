@@ -20,12 +20,15 @@ django_asgi_app = get_asgi_application()
 from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.auth import AuthMiddlewareStack
 import api.routing
+from api.middleware import BackgroundServicesMiddleware
 
-application = ProtocolTypeRouter({
+# BackgroundServicesMiddleware runs the shared metrics collector and the
+# broadcast scheduler on the server's event loop
+application = BackgroundServicesMiddleware(ProtocolTypeRouter({
     "http": django_asgi_app,
     "websocket": AuthMiddlewareStack(
         URLRouter(
             api.routing.websocket_urlpatterns
         )
     ),
-})
+}))
@@ -95,10 +95,16 @@ CHANNEL_LAYERS = {
         # For production with multiple workers, use Redis:
         # 'BACKEND': 'channels_redis.core.RedisChannelLayer',
         # 'CONFIG': {'hosts': [('127.0.0.1', 6379)]},
-        'BACKEND': 'channels.layers.InMemoryChannelLayer'
+        # or, without Redis, pass messages through the database:
+        # CHANNEL_LAYER_BACKEND=api.layers.DatabaseChannelLayer
+        'BACKEND': os.environ.get('CHANNEL_LAYER_BACKEND', 'channels.layers.InMemoryChannelLayer')
     }
 }
 
+# Seconds between checks for other workers' messages with the database
+# channel layer (PostgreSQL is woken by LISTEN/NOTIFY instead)
+CHANNEL_LAYER_POLL_INTERVAL = float(os.environ.get('CHANNEL_LAYER_POLL_INTERVAL', '0.1'))
+
 
 # Database
 # https://docs.djangoproject.com/en/6.0/ref/settings/#databases
@@ -167,6 +173,68 @@ REST_FRAMEWORK = {
 # Prometheus URL (from environment or default)
 PROMETHEUS_URL = os.environ.get('PROMETHEUS_URL', 'http://localhost:9090')
 
+# Seconds between background refreshes of link metrics from Prometheus
+METRICS_REFRESH_INTERVAL = int(os.environ.get('METRICS_REFRESH_INTERVAL', '30'))
+
+# Prometheus clients: connection pool size, in-flight query cap (async),
+# per-query timeout and retries
+PROMETHEUS_MAX_CONNECTIONS = int(os.environ.get('PROMETHEUS_MAX_CONNECTIONS', '20'))
+PROMETHEUS_MAX_CONCURRENCY = int(os.environ.get('PROMETHEUS_MAX_CONCURRENCY', '10'))
+PROMETHEUS_QUERY_TIMEOUT = float(os.environ.get('PROMETHEUS_QUERY_TIMEOUT', '5'))
+PROMETHEUS_RETRIES = int(os.environ.get('PROMETHEUS_RETRIES', '2'))
+
+# Total seconds one metrics refresh may spend on Prometheus before giving up
+PROMETHEUS_BUILD_BUDGET = float(os.environ.get('PROMETHEUS_BUILD_BUDGET', '15'))
+
+# Circuit breaker: open after N consecutive failures, retry after M seconds.
+# While open, last known values are served marked stale.
+PROMETHEUS_BREAKER_THRESHOLD = int(os.environ.get('PROMETHEUS_BREAKER_THRESHOLD', '5'))
+PROMETHEUS_BREAKER_RESET = float(os.environ.get('PROMETHEUS_BREAKER_RESET', '30'))
+
+# Bandwidth samples kept in memory per link for sparklines (one per refresh),
+# for at most METRICS_HISTORY_MAX_LINKS links; uses about size * links * 8 bytes
+METRICS_HISTORY_SIZE = int(os.environ.get('METRICS_HISTORY_SIZE', '120'))
+METRICS_HISTORY_MAX_LINKS = int(os.environ.get('METRICS_HISTORY_MAX_LINKS', '50000'))
+
+# Downsampled history views kept for repeat requests
+HISTORY_RANGE_CACHE_SIZE = int(os.environ.get('HISTORY_RANGE_CACHE_SIZE', '256'))
+
+# Number of topology patches kept so reconnecting clients can catch up
+TOPOLOGY_LOG_SIZE = int(os.environ.get('TOPOLOGY_LOG_SIZE', '500'))
+
+# Topology changes within BROADCAST_DEBOUNCE seconds of each other are merged
+# into one broadcast, sent at most BROADCAST_MAX_DELAY seconds after the first
+BROADCAST_DEBOUNCE = float(os.environ.get('BROADCAST_DEBOUNCE', '0.25'))
+BROADCAST_MAX_DELAY = float(os.environ.get('BROADCAST_MAX_DELAY', '2'))
+
+# Live dragging: each device's position is relayed to other clients at most
+# once per POSITION_THROTTLE seconds and saved every POSITION_FLUSH_INTERVAL
+POSITION_THROTTLE = float(os.environ.get('POSITION_THROTTLE', '0.05'))
+POSITION_FLUSH_INTERVAL = float(os.environ.get('POSITION_FLUSH_INTERVAL', '1'))
+
+# Default distance in pixels between neighbouring devices placed by
+# /api/devices/layout/ (server-side layout requires numpy)
+LAYOUT_SPACING = int(os.environ.get('LAYOUT_SPACING', '150'))
+
+# Compact binary snapshot of the topology and last metrics, rewritten at most
+# every TOPOLOGY_SNAPSHOT_INTERVAL seconds and read on startup so clients get a
+# warm (stale-marked) view immediately. Set the path empty to disable.
+TOPOLOGY_SNAPSHOT_PATH = os.environ.get('TOPOLOGY_SNAPSHOT_PATH', str(BASE_DIR / 'topology.snapshot'))
+TOPOLOGY_SNAPSHOT_INTERVAL = int(os.environ.get('TOPOLOGY_SNAPSHOT_INTERVAL', '300'))
+
+# WebSocket frame encodings clients may request with ?encoding=<name>.
+# 'json' text frames are always available; 'deflate' sends zlib-compressed JSON
+# and 'msgpack' MessagePack binary frames (msgpack, from requirements.txt).
+WEBSOCKET_ENCODINGS = os.environ.get('WEBSOCKET_ENCODINGS', 'json,deflate,msgpack').split(',')
+WEBSOCKET_COMPRESSION_LEVEL = int(os.environ.get('WEBSOCKET_COMPRESSION_LEVEL', '6'))
+
+# Flow control for clients that acknowledge frames: once WEBSOCKET_MAX_IN_FLIGHT
+# frames are unacknowledged, further patches are merged per client (latest
+# metrics win) and a client that falls more than WEBSOCKET_MAX_PENDING_OPS
+# structural changes behind gets a fresh snapshot instead
+WEBSOCKET_MAX_IN_FLIGHT = int(os.environ.get('WEBSOCKET_MAX_IN_FLIGHT', '8'))
+WEBSOCKET_MAX_PENDING_OPS = int(os.environ.get('WEBSOCKET_MAX_PENDING_OPS', '5000'))
+
 # Django REST Framework settings
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [],
@@ -4,3 +4,6 @@
 SECRET_KEY = 'your-secret-key-here'
 ALLOWED_HOSTS = ['your-server-ip', 'your-domain.com']
 PROMETHEUS_URL = 'http://your-prometheus-server:9090'
+
+# Seconds between background metric refreshes (one Prometheus fetch shared by all clients)
+# METRICS_REFRESH_INTERVAL = 30
@@ -17,9 +17,11 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path, include
 from django.views.generic import TemplateView
+from api import views as api_views
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/', include('api.urls')),
+    path('metrics', api_views.metrics, name='metrics'),
     path('', TemplateView.as_view(template_name='index.html'), name='home'),
 ]